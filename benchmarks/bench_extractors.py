@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+'''
+Micro-benchmark of the extractors of image urls on saved result pages.
+
+> python3 benchmarks/bench_extractors.py [html files...]
+
+Prints pages/second of each extractor. The pages of tests/fixtures are
+used if no file is given.
+'''
+
+import glob
+import os
+import sys
+import time
+from typing import List, Text
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from extractors import get_extractor
+
+def bench(name: Text, pages: List[Text], min_seconds: float=1.0):
+    '''run an extractor on `pages` repeatedly for at least `min_seconds`
+    :return: (pages per second, no. of urls of one round)
+    '''
+    extractor = get_extractor(name)
+    num_urls = sum(len(extractor.extract(p)) for p in pages) # warm up, and import parsers
+    num_pages = 0
+    start = time.perf_counter()
+    while True:
+        for page in pages:
+            extractor.extract(page)
+        num_pages += len(pages)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return num_pages / elapsed, num_urls
+
+def main(paths: List[Text], names: List[Text], min_seconds: float=1.0):
+    pages = []
+    for path in paths:
+        with open(path) as f:
+            pages.append(f.read())
+    print('{} pages, {:,} bytes'.format(len(pages), sum(map(len, pages))))
+    for name in names:
+        pages_per_sec, num_urls = bench(name, pages, min_seconds=min_seconds)
+        print('{:<6s}: {:10,.1f} pages/sec ({} urls)'.format(name, pages_per_sec, num_urls))
+
+
+if __name__ == '__main__':
+    import argparse
+    psr = argparse.ArgumentParser()
+    psr.add_argument('pages', help='html files of result pages', nargs='*')
+    psr.add_argument('-e', '--extractors', help='extractors to compare', nargs='+', default=['scan', 'lxml', 'soup', 'auto'])
+    psr.add_argument('-t', '--seconds', help='min seconds to run each extractor', type=float, default=1.0)
+    a = psr.parse_args()
+    fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests', 'fixtures', '*.html')
+    main(a.pages or sorted(glob.glob(fixtures)), a.extractors, min_seconds=a.seconds)
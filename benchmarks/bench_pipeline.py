@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark of the whole collection pipeline (search, download, save) without network.
+
+A fake search engine and image host (fake_server.py) runs in another
+process, and `image_collector_cui.main` collects images from it.
+
+> python3 benchmarks/bench_pipeline.py --images 500 --workers 16 --latency 0.05 --bandwidth 2000000
+
+Prints images/second, p50/p99 latency of each image and peak RSS of the
+collecting process.
+'''
+
+import contextlib
+import io
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import image_collector_cui
+from http_client import PooledHttpClient
+from retry import RetryPolicy
+from fake_server import FakeServer
+
+def serve(conn, server_kwargs: Dict):
+    server = FakeServer(**server_kwargs)
+    conn.send(server.search_url)
+    server.httpd.serve_forever()
+
+def peak_rss_bytes() -> int:
+    # kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def run(search_url: str, images: int, queries: int=1, workers: int=8, query_workers: int=1,
+        validate: bool=False, retry_base_delay: float=0.05) -> Dict:
+    '''collect images from the fake server
+    :return: results of the run
+    '''
+    latencies: List[float] = []
+    download = image_collector_cui.download_img_with_retry
+
+    def timed_download(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return download(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    client = PooledHttpClient(pool_size=max(10, workers * query_workers))
+    retry_policy = RetryPolicy(base_delay=retry_base_delay, max_delay=retry_base_delay * 4)
+    image_collector_cui.download_img_with_retry = timed_download
+    try:
+        with tempfile.TemporaryDirectory() as save_dir:
+            query_file = os.path.join(save_dir, 'queries.txt')
+            with open(query_file, 'w') as f:
+                f.writelines('query {}\n'.format(i) for i in range(queries))
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                image_collector_cui.main(
+                    [None, query_file if queries > 1 else 'query 0', images, os.path.join(save_dir, 'out')],
+                    workers=workers, query_workers=query_workers, client=client, retry_policy=retry_policy,
+                    validate=validate, validate_workers=1, search_url=search_url)
+            elapsed = time.perf_counter() - start
+            saved = sum(len(files) for _, _, files in os.walk(os.path.join(save_dir, 'out', 'images')))
+    finally:
+        image_collector_cui.download_img_with_retry = download
+        client.close()
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        'images': saved,
+        'seconds': elapsed,
+        'images_per_sec': saved / elapsed if elapsed > 0 else 0.0,
+        'p50_ms': float(np.percentile(latencies_ms, 50)) if len(latencies_ms) else 0.0,
+        'p99_ms': float(np.percentile(latencies_ms, 99)) if len(latencies_ms) else 0.0,
+        'peak_rss_mb': peak_rss_bytes() / 1024 ** 2,
+        }
+
+def main(images: int, queries: int, workers: List[int], query_workers: int=1, validate: bool=False, **server_kwargs):
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(child, server_kwargs), daemon=True)
+    server.start()
+    search_url = parent.recv()
+    print('fake server:', search_url, server_kwargs)
+    try:
+        for w in workers:
+            r = run(search_url, images, queries=queries, workers=w, query_workers=query_workers, validate=validate)
+            print('workers {:3d}: {:5d} images in {:6.2f}s, {:8.1f} images/sec, p50 {:7.1f}ms, p99 {:7.1f}ms, peak RSS {:6.1f}MB'.format(
+                w, r['images'], r['seconds'], r['images_per_sec'], r['p50_ms'], r['p99_ms'], r['peak_rss_mb']))
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    import argparse
+    psr = argparse.ArgumentParser()
+    psr.add_argument('-n', '--images', help='images to collect for each query', type=int, default=300)
+    psr.add_argument('-q', '--queries', help='the no. of queries', type=int, default=1)
+    psr.add_argument('-w', '--workers', help='download workers to compare', type=int, nargs='+', default=[1, 8, 32])
+    psr.add_argument('--query-workers', help='the no. of queries run at the same time', type=int, default=1)
+    psr.add_argument('--validate', help='run the validation stage', action='store_true')
+    psr.add_argument('--latency', help='seconds before responding an image', type=float, default=0.02)
+    psr.add_argument('--bandwidth', help='bytes/second of each image response, no limit if 0', type=float, default=0.0)
+    psr.add_argument('--error-rate', help='ratio of image urls answering 503', type=float, default=0.0)
+    psr.add_argument('--min-size', help='min bytes of an image', type=int, default=20000)
+    psr.add_argument('--max-size', help='max bytes of an image', type=int, default=200000)
+    a = psr.parse_args()
+    main(a.images, a.queries, a.workers, query_workers=a.query_workers, validate=a.validate,
+         pages=(a.images + 99) // 100 + 1, latency=a.latency, bandwidth=a.bandwidth, error_rate=a.error_rate,
+         min_size=a.min_size, max_size=a.max_size)
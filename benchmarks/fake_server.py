@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+'''
+Local fake of the image search and the image hosts, for benchmarks without network.
+
+  /search?q=[keyword]&tbm=isch&ijn=[page]
+      result page in the ".rg_meta" format parsed by `Google.image_search`,
+      `per_page` image urls on each of `pages` pages, then empty pages
+  /img/[keyword]/[page]/[i].jpg
+      JPEG of a size between `min_size` and `max_size` (deterministic per url),
+      sent after `latency` seconds at `bandwidth` bytes/second per connection.
+      `error_rate` of the urls answer 503. ETag and Last-Modified are sent, and
+      a conditional request with the same ETag is answered 304 Not Modified.
+
+> python3 benchmarks/fake_server.py --port 8000 --latency 0.05 --bandwidth 1000000
+> python3 image_collector_cui.py dog 100 out --search-url http://127.0.0.1:8000/search --no-search-cache
+'''
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import html
+import io
+import json
+import threading
+import time
+import urllib.parse
+import zlib
+from typing import Text
+
+def make_jpeg(size: int, seed: int) -> bytes:
+    '''a valid JPEG of about `size` bytes, padded with comment segments
+    '''
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new('RGB', (8, 8), (seed % 256, (seed >> 8) % 256, (seed >> 16) % 256)).save(buf, format='JPEG')
+    jpeg = buf.getvalue()
+    padding = []
+    remaining = size - len(jpeg)
+    while remaining > 4:
+        n = min(remaining - 4, 65533)
+        padding.append(b'\xff\xfe' + (n + 2).to_bytes(2, 'big') + b'\x00' * n)
+        remaining -= n + 4
+    # comments right after SOI
+    return jpeg[:2] + b''.join(padding) + jpeg[2:]
+
+def result_page(base_url: Text, keyword: Text, page: int, num_urls: int) -> Text:
+    metas = ''.join(
+        '<div class="rg_meta notranslate">{}</div>'.format(json.dumps({
+            'id': '{}-{}'.format(page, i),
+            'ou': '{}/img/{}/{}/{}.jpg'.format(base_url, urllib.parse.quote(keyword), page, i),
+            'ity': 'jpg'}))
+        for i in range(num_urls))
+    return '<!doctype html><html><head><title>{} - search</title></head><body>{}</body></html>'.format(
+        html.escape(keyword), metas)
+
+class FakeServer:
+    def __init__(self, host: Text='127.0.0.1', port: int=0, pages: int=10, per_page: int=100,
+                 latency: float=0.0, bandwidth: float=0.0, error_rate: float=0.0,
+                 min_size: int=20000, max_size: int=200000):
+        '''
+        :param port: 0 for a free port
+        :param latency: seconds before responding an image
+        :param bandwidth: bytes/second of each image response, no limit if 0
+        :param error_rate: ratio of image urls answering 503
+        '''
+        self.pages = pages
+        self.per_page = per_page
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.min_size = min_size
+        self.max_size = max_size
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                if url.path == '/search':
+                    params = urllib.parse.parse_qs(url.query)
+                    page = int(params.get('ijn', ['0'])[0])
+                    num_urls = server.per_page if page < server.pages else 0
+                    body = result_page(server.base_url, params.get('q', [''])[0], page, num_urls).encode()
+                    self.respond(200, 'text/html; charset=UTF-8', body)
+                elif url.path.startswith('/img/'):
+                    key = zlib.crc32(url.path.encode())
+                    time.sleep(server.latency)
+                    if key % 10000 < server.error_rate * 10000:
+                        self.respond(503, 'text/html', b'<html>503 Service Unavailable</html>')
+                        return
+                    etag = '"{:08x}"'.format(key)
+                    if self.headers.get('If-None-Match') == etag:
+                        self.respond(304, None, b'', headers={'ETag': etag})
+                        return
+                    size = server.min_size + key % max(1, server.max_size - server.min_size + 1)
+                    self.respond(200, 'image/jpeg', make_jpeg(size, key), throttle=True,
+                                 headers={'ETag': etag, 'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'})
+                else:
+                    self.respond(404, 'text/plain', b'not found')
+
+            def respond(self, status, content_type, body, throttle=False, headers=None):
+                self.send_response(status)
+                if content_type is not None:
+                    self.send_header('Content-Type', content_type)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                chunk_size = 64 * 1024
+                for i in range(0, len(body), chunk_size):
+                    self.wfile.write(body[i:i + chunk_size])
+                    if throttle and server.bandwidth > 0:
+                        time.sleep(min(chunk_size, len(body) - i) / server.bandwidth)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.base_url = 'http://{}:{}'.format(*self.httpd.server_address[:2])
+        self.search_url = self.base_url + '/search'
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == '__main__':
+    import argparse
+    psr = argparse.ArgumentParser()
+    psr.add_argument('--port', type=int, default=8000)
+    psr.add_argument('--pages', help='result pages of each keyword', type=int, default=10)
+    psr.add_argument('--latency', help='seconds before responding an image', type=float, default=0.0)
+    psr.add_argument('--bandwidth', help='bytes/second of each image response, no limit if 0', type=float, default=0.0)
+    psr.add_argument('--error-rate', help='ratio of image urls answering 503', type=float, default=0.0)
+    psr.add_argument('--min-size', help='min bytes of an image', type=int, default=20000)
+    psr.add_argument('--max-size', help='max bytes of an image', type=int, default=200000)
+    a = psr.parse_args()
+    server = FakeServer(port=a.port, pages=a.pages, latency=a.latency, bandwidth=a.bandwidth,
+                        error_rate=a.error_rate, min_size=a.min_size, max_size=a.max_size)
+    print('search url:', server.search_url)
+    server.httpd.serve_forever()
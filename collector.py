@@ -0,0 +1,305 @@
+'''
+In-process API of image collection, for running many queries in one long-lived process
+
+>>> from collector import Collector, CollectorConfig
+>>> with Collector(CollectorConfig('dataset', workers=8)) as c:
+...     result = c.collect('dog', 100)
+...     for result in c.iter_collect([('cat', 100), ('bird', 50)], on_progress=print):
+...         print(result.query, result.downloaded)
+
+or with asyncio
+
+>>> async with Collector(CollectorConfig('dataset')) as c:
+...     async for event in c.aiter_collect([('cat', 100)], progress=True):
+...         print(event)  # `Progress` of each image and `QueryResult` of each query
+
+The HTTP client, rate limiter, retry policy, search cache, duplicate index,
+url database, metrics and process pool are created once and shared by all the queries,
+as by image_collector_cui.py run with a query file.
+
+Importing this module is cheap: image_collector_cui (requests) is imported
+when the first `Collector` is created, and the parsers of result pages
+(lxml, bs4) when the first page is parsed.
+'''
+
+import os
+import threading
+import time
+import urllib.parse
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Text, Tuple, Union
+
+from search_cache import DEFAULT_CACHE_DIR
+
+class CollectorConfig(NamedTuple):
+    '''options of `Collector`, the same as the command line options of image_collector_cui.py
+    '''
+    save_dir: Text
+    workers: int = 1
+    query_workers: int = 1
+    host_rate: Optional[float] = None
+    host_burst: Optional[float] = None
+    search_rate: float = 1.0
+    pool_size: Optional[int] = None
+    max_bytes: Optional[int] = 20 * 1024 * 1024
+    max_seconds: Optional[float] = 120
+    retry_base_delay: float = 1.0
+    retry_max_delay: float = 30.0
+    breaker_threshold: int = 5
+    breaker_reset: float = 60.0
+    extractor: Text = 'auto'
+    dedup: Text = 'report'
+    validate: bool = True
+    validate_workers: Optional[int] = None
+    url_db: bool = True
+    dead_after: int = 3
+    search_url: Optional[Text] = None
+    search_cache: bool = True
+    search_cache_dir: Text = DEFAULT_CACHE_DIR
+    search_cache_ttl: float = 7 * 24 * 3600
+    search_cache_size: int = 100000
+    metrics: bool = True
+    # AIMD limit of downloads in flight between `min_workers` and `workers` * `query_workers`
+    adaptive: bool = False
+    min_workers: int = 1
+    # budgets of the collector (from its creation) and of each query, no limit if None
+    run_seconds: Optional[float] = None
+    run_bytes: Optional[int] = None
+    query_seconds: Optional[float] = None
+    query_bytes: Optional[int] = None
+    # resize and re-encode images to "[save_dir]/normalized" after each query, not resized if `max_edge` is None
+    normalize: bool = False
+    max_edge: Optional[int] = 1024
+    normalize_format: Text = 'JPEG'
+    normalize_quality: int = 90
+
+class Job(NamedTuple):
+    query: Text
+    number: int
+    dirname: Optional[Text] = None
+    resume: bool = False
+    refresh: bool = False
+
+class Progress(NamedTuple):
+    '''an image of a query downloaded or failed
+    '''
+    query: Text
+    dirname: Text
+    done: int
+    number: int
+    row: Dict
+
+class QueryResult(NamedTuple):
+    query: Text
+    dirname: Text
+    image_dir: Text
+    manifest: Text
+    rows: List[Dict]
+    downloaded: int
+    failed: int
+    duplicates: int
+    invalid: int
+    seconds: float
+    # which budget stopped the query, None if it finished
+    exhausted: Optional[Text] = None
+
+JobLike = Union[Job, Tuple]
+
+class Collector:
+    def __init__(self, config: CollectorConfig):
+        import image_collector_cui
+        from dedup import ContentIndex
+        from extractors import get_extractor
+        from http_client import PooledHttpClient
+        from metrics import Metrics
+        from normalize_images import Settings
+        from retry import CircuitBreaker, RetryPolicy
+        from scheduler import AdaptiveConcurrency, Budget, HostRateLimiter
+        from search_cache import SearchCache
+        from url_db import DB_FILE, UrlDB
+        from validate_images import process_pool
+        self._cui = image_collector_cui
+        self.config = config
+        search_url = config.search_url if config.search_url is not None else image_collector_cui.GOOGLE_SEARCH_URL
+
+        self.rate_limiter = None
+        if config.host_rate is not None:
+            search_host = urllib.parse.urlparse(search_url).netloc
+            self.rate_limiter = HostRateLimiter(
+                config.host_rate, capacity=config.host_burst, host_rates={search_host: config.search_rate})
+        # keep at least one connection alive for each worker
+        pool_size = config.pool_size if config.pool_size is not None else max(10, config.workers * config.query_workers)
+        self.client = PooledHttpClient(pool_size=pool_size)
+        self.retry_policy = RetryPolicy(
+            base_delay=config.retry_base_delay, max_delay=config.retry_max_delay,
+            breaker=CircuitBreaker(failure_threshold=config.breaker_threshold, reset_seconds=config.breaker_reset))
+        self.extractor = get_extractor(config.extractor)
+        self.search_cache = None
+        if config.search_cache:
+            cache_dir = config.search_cache_dir
+            if search_url != image_collector_cui.GOOGLE_SEARCH_URL:
+                # results of other search endpoints are cached separately
+                cache_dir = os.path.join(cache_dir, urllib.parse.urlparse(search_url).netloc.replace(':', '_'))
+            self.search_cache = SearchCache(cache_dir, ttl=config.search_cache_ttl, max_entries=config.search_cache_size)
+        self.content_index = None
+        if config.dedup != 'off':
+            self.content_index = ContentIndex(config.save_dir, action=config.dedup).load_manifests()
+        self.url_db = None
+        if config.url_db:
+            self.url_db = UrlDB(os.path.join(config.save_dir, DB_FILE), dead_after=config.dead_after)
+        self.metrics = None
+        if config.metrics:
+            metrics_dir = os.path.join(config.save_dir, 'metrics')
+            self.metrics = Metrics(os.path.join(metrics_dir, 'events.jsonl'), os.path.join(metrics_dir, 'metrics.prom'))
+        self.search_url = search_url
+        self.concurrency = None
+        if config.adaptive:
+            self.concurrency = AdaptiveConcurrency(
+                min_limit=min(config.min_workers, config.workers), max_limit=max(1, config.workers * config.query_workers))
+        self.run_budget = None
+        if config.run_seconds is not None or config.run_bytes is not None:
+            self.run_budget = Budget(config.run_seconds, config.run_bytes)
+        self.normalize = None
+        if config.normalize:
+            self.normalize = Settings(config.max_edge or None, config.normalize_format, config.normalize_quality)
+        # processes are started once for all the queries, not by the download threads of each query
+        self.process_pool = None
+        if (config.validate or config.normalize) and config.validate_workers != 1:
+            self.process_pool = process_pool(config.validate_workers)
+
+    def main_kwargs(self) -> Dict:
+        '''keyword arguments of `image_collector_cui.main` and `collect` with the shared objects
+        '''
+        c = self.config
+        return dict(
+            workers=c.workers, rate_limiter=self.rate_limiter, client=self.client,
+            max_bytes=c.max_bytes, max_seconds=c.max_seconds, retry_policy=self.retry_policy,
+            extractor=self.extractor, search_cache=self.search_cache, content_index=self.content_index,
+            validate=c.validate, validate_workers=c.validate_workers, url_db=self.url_db,
+            search_url=self.search_url, metrics=self.metrics, concurrency=self.concurrency,
+            run_budget=self.run_budget, query_seconds=c.query_seconds, query_bytes=c.query_bytes,
+            normalize=self.normalize, process_pool=self.process_pool)
+
+    def collect(self, query: Text, number: int, dirname: Optional[Text]=None, resume: bool=False,
+                refresh: bool=False, on_progress: Optional[Callable[[Progress], None]]=None) -> QueryResult:
+        '''search and download images of a query
+        :param query: search query
+        :param number: the no. of images to download
+        :param dirname: class directory name, `query` with "_" for spaces if None
+        :param resume: continue from the url manifest of the previous run
+        :param refresh: request the saved images again with conditional requests instead of searching
+        :param on_progress: called with `Progress` of each image, in the download threads
+        '''
+        image_dir, manifest = self._cui.class_paths(self.config.save_dir, query, dirname)
+        dirname = os.path.basename(image_dir)
+        on_row = None
+        if on_progress is not None:
+            lock = threading.Lock()
+            done = [0]
+
+            def on_row(row):
+                with lock:
+                    done[0] += 1
+                    n = done[0]
+                on_progress(Progress(query, dirname, n, number, row))
+
+        start = time.perf_counter()
+        exhausted = None
+        try:
+            rows = self._cui.collect(query, number, self.config.save_dir, dirname, resume=resume, refresh=refresh,
+                                     on_row=on_row, **self.main_kwargs())
+        except self._cui.BudgetExhausted as e:
+            # the manifest is written, continued with `resume=True`
+            rows, exhausted = e.rows, e.reason
+        return QueryResult(
+            query, dirname, image_dir, manifest, rows,
+            downloaded=self._cui.num_downloaded(rows),
+            failed=sum(1 for row in rows if not row['is_downloaded']),
+            duplicates=sum(1 for row in rows if row.get('duplicate_of')),
+            invalid=sum(1 for row in rows if row.get('is_valid') == 0),
+            seconds=time.perf_counter() - start, exhausted=exhausted)
+
+    def iter_collect(self, jobs: Iterable[JobLike], on_progress: Optional[Callable[[Progress], None]]=None
+                     ) -> Iterator[QueryResult]:
+        '''run queries, `config.query_workers` at once
+        :param jobs: `Job` or (query, number[, dirname[, resume[, refresh]]])
+        :return: results in the order the queries finish
+        '''
+        from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+        jobs = iter(Job(*job) for job in jobs)
+        workers = max(1, self.config.query_workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # submit lazily so that a long job list is not held in memory
+            running = set()
+            for job in jobs:
+                running.add(executor.submit(self.collect, *job, on_progress=on_progress))
+                if len(running) < workers:
+                    continue
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                for f in finished:
+                    yield f.result()
+            while running:
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                for f in finished:
+                    yield f.result()
+
+    async def acollect(self, query: Text, number: int, dirname: Optional[Text]=None, resume: bool=False,
+                       refresh: bool=False) -> QueryResult:
+        '''`collect` in a thread of the default executor of the running event loop
+        '''
+        import asyncio
+        import functools
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self.collect, query, number, dirname, resume, refresh))
+
+    async def aiter_collect(self, jobs: Iterable[JobLike], progress: bool=False):
+        '''async iterator form of `iter_collect`
+        :param progress: also yield `Progress` of each image before the `QueryResult` of its query
+        :return: async iterator of `QueryResult` (and `Progress`)
+        '''
+        import asyncio
+        loop = asyncio.get_running_loop()
+        events: asyncio.Queue = asyncio.Queue()
+        done = object()
+
+        def put(event):
+            loop.call_soon_threadsafe(events.put_nowait, event)
+
+        def run():
+            try:
+                for result in self.iter_collect(jobs, on_progress=put if progress else None):
+                    put(result)
+            except BaseException as e:
+                put(e)
+            finally:
+                put(done)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        while True:
+            event = await events.get()
+            if event is done:
+                break
+            if isinstance(event, BaseException):
+                raise event
+            yield event
+
+    def close(self):
+        if self.metrics is not None:
+            self.metrics.export()
+        if self.url_db is not None:
+            self.url_db.close()
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+        self.client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
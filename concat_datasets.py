@@ -1,14 +1,21 @@
 import glob
 import os
-import re
 import shutil
-from typing import Dict, Set, Text
+from typing import Dict, List, Set, Text, Tuple
+
+from dataset_index import scan_dataset
+from file_links import HARDLINK, STRATEGIES, link_files
+from hash_index import HashIndex
+from manifest import Manifest, row_file_name
 
 def main(
         mode: Text,
         main_set_dir: Text,
         second_set_dir: Text,
-        dest_path: Text
+        dest_path: Text,
+        strategy: Text=HARDLINK,
+        workers: int=16,
+        use_hash: bool=True
         ):
     '''concatenate two datasets into one new dataset
     Four modes are supported:
@@ -21,6 +28,11 @@ def main(
     :param main_set_dir: main dataset directory path
     :param second_set_dir: second dataset directory path
     :param dest_path: directory path to new dataset
+    :param strategy: how to put image files in the new dataset, "hardlink", "reflink" or "copy".
+        Each falls back to the next one, e.g. if the datasets are on different file systems.
+    :param workers: the no. of files linked (and hashed) at the same time
+    :param use_hash: compare images by content (SHA-256) instead of file names in merge, add_image and replace.
+        Hashes are cached in "[dataset]/.hash_index.csv".
     '''
 
     # constants
@@ -33,6 +45,8 @@ def main(
     # validate args
     if not mode in MODES:
         raise RuntimeError('invalid `mode`, {} are supported.'.format(MODES))
+    if not strategy in STRATEGIES:
+        raise RuntimeError('invalid `strategy`, {} are supported.'.format(STRATEGIES))
 
     if not os.path.isdir(main_set_dir):
         raise RuntimeError('main set directory does not exist or is not direcotry, "{}"'.format(main_set_dir))
@@ -57,7 +71,7 @@ def main(
     #   3. get the same info of second set
     #   4. concatenate
 
-    concator = DatasetConcatenator(main_set_dir, second_set_dir, dest_path)
+    concator = DatasetConcatenator(main_set_dir, second_set_dir, dest_path, strategy=strategy, workers=workers, use_hash=use_hash)
 
     if mode == ADD_CLASS:
         concator.add_class()
@@ -83,15 +97,11 @@ def read_dataset_path(dir_path: Text):
       |    |--img1 file
       |    |--img2 file
     jpg
+    :return: class dir path -> image file paths
     '''
-    def glob_img(d):
-        '''get all image file path
-        '''
-        return set([p for p in glob.glob(os.path.join(d, '*')) if re.fullmatch(r'.*\.(BMP|GIF|JPG|JPEG|PNG|TIF|TIFF)', p.upper())])
-
-    class_dirs = [d for d in glob.glob(os.path.join(dir_path, '*')) if os.path.isdir(d)]
-    dataset = {class_dir:glob_img(class_dir) for class_dir in class_dirs}
-    return dataset
+    return {
+        os.path.join(dir_path, name): set(os.path.join(dir_path, name, f) for f in files)
+        for name, files in scan_dataset(dir_path).items()}
 
 def list_dirnames(dir_paths: Text):
     '''get all dir names (equal to class labels)
@@ -101,9 +111,12 @@ def list_dirnames(dir_paths: Text):
 class Dataset:
     def __init__(self, dir_path):
         self.__root_dir = dir_path
-        self.__images_paths: Dict[Text, Set[Text]] = read_dataset_path(self.images_dir())
-        self.__images_infos: Dict[Text, List[Text, int]] = {os.path.split(d)[1]:[d, len(vs)] for d, vs in self.__images_paths.items()}
-        self.__urls_paths: Dict[Text, Text] = {os.path.splitext(os.path.split(d)[1])[0]:d for d in glob.glob(os.path.join(self.urls_dir(), '*'))}
+        self.__files: Dict[Text, List[Text]] = scan_dataset(self.images_dir())
+        self.__images_paths: Dict[Text, Set[Text]] = {
+            os.path.join(self.images_dir(), label): set(os.path.join(self.images_dir(), label, f) for f in files)
+            for label, files in self.__files.items()}
+        self.__images_infos: Dict[Text, List] = {os.path.split(d)[1]:[d, len(vs)] for d, vs in self.__images_paths.items()}
+        self.__urls_paths: Dict[Text, Text] = {os.path.splitext(os.path.split(d)[1])[0]:d for d in glob.glob(os.path.join(self.urls_dir(), '*.csv'))}
 
     def images_dir(self):
         return os.path.join(self.__root_dir, 'images')
@@ -120,6 +133,35 @@ class Dataset:
     def urls_paths(self):
         return self.__urls_paths
 
+    def files(self, label):
+        '''image file names of a class, sorted
+        '''
+        return self.__files.get(label, [])
+
+    def rows(self, label):
+        '''rows of the url manifest of a class, [] if there is no manifest
+        '''
+        urls_file = self.urls_file(label)
+        return Manifest(urls_file).read() if urls_file is not None else []
+
+    def hashes(self, workers: int=8):
+        '''SHA-256 of all the images, cached in "[dataset]/.hash_index.csv"
+        :return: (class label, file name) -> SHA-256
+        '''
+        known = {}
+        for label in self.class_labels():
+            for row in self.rows(label):
+                if row['is_downloaded'] and row.get('sha256') and not row.get('duplicate_of'):
+                    # recorded while downloading
+                    known[os.path.join('images', label, row_file_name(row))] = row['sha256']
+        rel_paths = {
+            os.path.join('images', label, f): (label, f)
+            for label, files in self.__files.items() for f in files}
+        index = HashIndex(self.__root_dir, workers=workers)
+        hashes = index.hashes(rel_paths, known=known)
+        print('{}: {:,} images, {:,} hashed'.format(self.__root_dir, len(hashes), index.num_hashed))
+        return {rel_paths[rel_path]: sha256 for rel_path, sha256 in hashes.items()}
+
     def num_samples(self, label):
         try:
             return self.__images_infos[label][1]
@@ -138,39 +180,84 @@ class Dataset:
         except KeyError as e:
             return None
 
+def free_name(file_name: Text, taken: Set[Text]) -> Text:
+    '''rename "0001.jpg" to "0001_2.jpg", "0001_2_2.jpg", ... until it is not in `taken`
+    '''
+    stem, ext = os.path.splitext(file_name)
+    while file_name in taken:
+        stem += '_2'
+        file_name = stem + ext
+    return file_name
+
 class DatasetConcatenator:
-    def __init__(self, main_set_dir: Text, second_set_dir: Text, dest_path: Text):
+    def __init__(self, main_set_dir: Text, second_set_dir: Text, dest_path: Text,
+                 strategy: Text=HARDLINK, workers: int=16, use_hash: bool=True):
+        '''
+        :param strategy: how to put image files in the new dataset, "hardlink", "reflink" or "copy"
+            (see file_links.py)
+        :param workers: the no. of files linked (and hashed) at the same time
+        :param use_hash: compare images by content instead of file names
+        '''
         self.main_set_dir = main_set_dir
         self.second_set_dir = second_set_dir
         self.dest_path = dest_path
         self.dest_images_path = os.path.join(self.dest_path, 'images')
         self.dest_urls_path = os.path.join(self.dest_path, 'urls')
+        self.strategy = strategy
+        self.workers = workers
+        self.use_hash = use_hash
 
         self.main_set = Dataset(self.main_set_dir)
         self.second_set = Dataset(self.second_set_dir)
 
+        # (source path, destination path) of image files
+        self.pairs: List[Tuple[Text, Text]] = []
+        # class label in the new dataset -> [(row of the url manifest, dataset of the row)]
+        self.manifests: Dict[Text, List[Tuple[Dict, Dataset]]] = {}
+        # (id of dataset, relative path in the dataset) -> relative path in the new dataset
+        self.moved: Dict[Tuple[int, Text], Text] = {}
+        self.main_hashes: Dict[Tuple[Text, Text], Text] = {}
+        self.second_hashes: Dict[Tuple[Text, Text], Text] = {}
+
+    def load_hashes(self):
+        '''hash both sets (in parallel, resuming from the cache) if comparing by content
+        '''
+        if self.use_hash:
+            self.main_hashes = self.main_set.hashes(workers=self.workers)
+            self.second_hashes = self.second_set.hashes(workers=self.workers)
+
     def add_class(self):
-        raise RuntimeError('need update')
-        # copy main set to dest
-        shutil.copytree(self.main_set_dir, self.dest_path)
-        print('copy main set {}\n  to {}\n  done'.format(self.main_set_dir, self.dest_path))
-
-        ## copy second set to dest with renaming dir name if exists in main
-        #for class_dir in self.second_set.paths().keys():
-        #    dir_name = os.path.split(class_dir)[1]
-        #    while dir_name in self.main_set.class_labels():
-        #        dir_name += '_2'
-        #    save_dir = os.path.join(self.dest_path, dir_name)
-        #    shutil.copytree(class_dir, save_dir)
-        #    print('copy {}\n  in second set to\n  {}\n  done'.format(class_dir, save_dir))
+        '''concatenate two dataset with "add_class" mode
+        classes of the second set are renamed to "[label]_2" if the main set has the label
+        '''
+        for label in sorted(self.main_set.class_labels()):
+            self.add_files(self.main_set, label, label, self.main_set.files(label), self.main_set.rows(label))
+        taken = set(self.main_set.class_labels())
+        for label in sorted(self.second_set.class_labels()):
+            dest_label = label
+            while dest_label in taken:
+                dest_label += '_2'
+            taken.add(dest_label)
+            self.add_files(self.second_set, label, dest_label, self.second_set.files(label), self.second_set.rows(label))
+        self.run()
 
     def merge(self):
-        # to be implemented
-        pass
+        '''concatenate two dataset with "merge" mode
+        images of the second set are skipped if the class of the main set has the same contents
+        (or the same file names without `use_hash`), or the same file names
+        '''
+        self.load_hashes()
+        self.merge_classes(rename=False)
+        self.run()
 
     def add_image(self):
-        # to be implemented
-        pass
+        '''concatenate two dataset with "add_image" mode
+        images of the second set are skipped if the class of the main set has the same contents
+        (with `use_hash`), and renamed if it has the same file names
+        '''
+        self.load_hashes()
+        self.merge_classes(rename=True)
+        self.run()
 
     def replace(self):
         '''concatenate two dataset with "replace" mode
@@ -179,35 +266,129 @@ class DatasetConcatenator:
           2. compare the no. of samples in main and in second
           3. adopt set that has larger number of samples
         '''
+        self.load_hashes()
         union_classes = set(self.main_set.class_labels()).union(self.second_set.class_labels())
-        for class_name in union_classes:
-            print('copy {} class...'.format(class_name))
-            class_dir, urls_file = self.select_larger(class_name)
-            print('class_dir:{}, urls_file:{}'.format(class_dir, urls_file))
-            dest_dir = os.path.join(self.dest_images_path, class_name)
-            dest_url_file = os.path.join(self.dest_urls_path, os.path.split(urls_file)[1])
-            shutil.copytree(class_dir, dest_dir)
-            shutil.copy(urls_file, dest_url_file)
-            print('copy {}\n  to\n  {}\n  done'.format(class_dir, dest_dir))
-            print('copy {}\n  to\n  {}\n  done'.format(urls_file, dest_url_file))
+        for class_name in sorted(union_classes):
+            dataset = self.select_larger(class_name)
+            self.add_files(dataset, class_name, class_name, dataset.files(class_name), dataset.rows(class_name))
+        self.run()
 
     def select_larger(self, class_name):
-        num_main_samples = self.main_set.num_samples(class_name)
-        num_second_samples = self.second_set.num_samples(class_name)
-        print('main: {}, second: {}'.format(num_main_samples, num_second_samples))
+        if self.use_hash:
+            # the no. of different images
+            num_main_samples = len(set(self.main_hashes[(class_name, f)] for f in self.main_set.files(class_name)))
+            num_second_samples = len(set(self.second_hashes[(class_name, f)] for f in self.second_set.files(class_name)))
+        else:
+            num_main_samples = self.main_set.num_samples(class_name)
+            num_second_samples = self.second_set.num_samples(class_name)
+        print('{}: main: {}, second: {}'.format(class_name, num_main_samples, num_second_samples))
         if num_main_samples >= num_second_samples:
-            return self.main_set.class_path(class_name), self.main_set.urls_file(class_name)
+            return self.main_set
         else:
-            return self.second_set.class_path(class_name), self.second_set.urls_file(class_name)
+            return self.second_set
 
+    def merge_classes(self, rename: bool):
+        '''merge images of the classes of the same labels
+        :param rename: rename images of the second set of the same names as the main set, otherwise skip them
+        '''
+        union_classes = set(self.main_set.class_labels()).union(self.second_set.class_labels())
+        for label in sorted(union_classes):
+            main_files = self.main_set.files(label)
+            main_rows = self.main_set.rows(label)
+            self.add_files(self.main_set, label, label, main_files, main_rows)
+            # content -> relative path in the new dataset
+            contents = {}
+            for f in main_files:
+                if (label, f) in self.main_hashes:
+                    contents.setdefault(self.main_hashes[(label, f)], os.path.join('images', label, f))
+
+            second_rows = self.second_set.rows(label)
+            rows_by_file = {row_file_name(row): row for row in second_rows if row['is_downloaded']}
+            used_nos = set(row['No.'] for row in main_rows)
+            next_no = max([row['No.'] for row in main_rows + second_rows], default=0) + 1
+            taken = set(main_files)
+            files = []
+            rows = []
+            for f in self.second_set.files(label):
+                sha256 = self.second_hashes.get((label, f))
+                if sha256 is not None and sha256 in contents:
+                    # same image, rows of the second set refering to it follow the kept one
+                    self.moved[(id(self.second_set), os.path.join('images', label, f))] = contents[sha256]
+                    continue
+                dest_name = f
+                if f in taken:
+                    if not rename:
+                        continue
+                    dest_name = free_name(f, taken)
+                taken.add(dest_name)
+                if sha256 is not None:
+                    contents[sha256] = os.path.join('images', label, dest_name)
+                files.append((f, dest_name))
+                row = rows_by_file.get(f)
+                if row is not None:
+                    # keep "No." unique in the class
+                    row = dict(row, file=dest_name)
+                    if row['No.'] in used_nos:
+                        row['No.'] = next_no
+                        next_no += 1
+                    used_nos.add(row['No.'])
+                    rows.append(row)
+            self.add_files(self.second_set, label, label, files, rows)
+
+    def add_files(self, dataset: Dataset, label: Text, dest_label: Text, files: List, rows: List[Dict]):
+        '''plan to put images of a class in the new dataset
+        :param files: file names, or (file name, file name in the new dataset)
+        :param rows: rows of the url manifest of the files
+        '''
+        dest_dir = os.path.join(self.dest_images_path, dest_label)
+        hashes = self.main_hashes if dataset is self.main_set else self.second_hashes
+        for f in files:
+            src_name, dest_name = (f, f) if isinstance(f, str) else f
+            self.pairs.append((os.path.join(dataset.class_path(label), src_name), os.path.join(dest_dir, dest_name)))
+            self.moved[(id(dataset), os.path.join('images', label, src_name))] = os.path.join('images', dest_label, dest_name)
+        for row in rows:
+            sha256 = hashes.get((label, row_file_name(row)))
+            if sha256 is not None and not row.get('duplicate_of'):
+                row = dict(row, sha256=sha256)
+            self.manifests.setdefault(dest_label, []).append((row, dataset))
+        self.manifests.setdefault(dest_label, [])
+
+    def run(self):
+        '''link the images and write the url manifests
+        '''
+        for dest_dir in set(os.path.dirname(dst) for _, dst in self.pairs):
+            os.makedirs(dest_dir, exist_ok=True)
+        used = link_files(self.pairs, strategy=self.strategy, workers=self.workers)
+        print('{:,} images: {}'.format(len(self.pairs), ', '.join('{} {:,}'.format(k, v) for k, v in used.items())))
+
+        # rebuild the manifests to match the images kept
+        kept = set(os.path.relpath(dst, self.dest_path) for _, dst in self.pairs)
+        for dest_label, rows in self.manifests.items():
+            if not rows:
+                continue
+            new_rows = []
+            for row, dataset in rows:
+                if row.get('duplicate_of'):
+                    # follow the original, forget it if the original is not in the new dataset
+                    row = dict(row, duplicate_of=self.moved.get((id(dataset), row['duplicate_of']), ''))
+                elif row['is_downloaded'] and os.path.join('images', dest_label, row_file_name(row)) not in kept:
+                    # e.g. deleted by hand
+                    continue
+                new_rows.append(row)
+            Manifest(os.path.join(self.dest_urls_path, dest_label + '.csv')).write(
+                sorted(new_rows, key=lambda row: row['No.']))
 
 
 if __name__ == '__main__':
     import argparse
     psr = argparse.ArgumentParser()
-    psr.add_argument('--mode', help='mode of concatenation. merge, add_image, select, and add_class are supported.', required=True)
+    psr.add_argument('--mode', help='mode of concatenation', choices=['merge', 'add_image', 'replace', 'add_class'], required=True)
     psr.add_argument('--main_set', help='main dataset directory path', required=True)
     psr.add_argument('--second_set', help='second dataset directory path', required=True)
     psr.add_argument('--dest', help='directory path to new dataset', required=True)
+    psr.add_argument('--link', help='how to put image files in the new dataset, falls back to the next one if not possible',
+                     choices=['hardlink', 'reflink', 'copy'], default='hardlink')
+    psr.add_argument('-w', '--workers', help='the no. of files linked (and hashed) at the same time', type=int, default=16)
+    psr.add_argument('--no-hash', help='compare images by file names instead of contents', action='store_true')
     a = psr.parse_args()
-    main(a.mode, a.main_set, a.second_set, a.dest)
+    main(a.mode, a.main_set, a.second_set, a.dest, strategy=a.link, workers=a.workers, use_hash=not a.no_hash)
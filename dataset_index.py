@@ -0,0 +1,123 @@
+'''
+Scanner of image files in a dataset, shared by stats.py and concat_datasets.py.
+
+Class directories are listed with `os.scandir` in a thread pool (listing
+is I/O bound, and slow on network file systems). The file names of each
+class are saved in an index with the mtime of the class directory. The
+index is kept in "~/.cache/image-collector/datasets", one file per dataset
+keyed by its absolute path, so the dataset directory is not modified. Adding, removing or renaming a file
+changes the mtime of its directory, so classes whose mtime is the same
+as in the index are read from the index without listing them again.
+
+Directories modified in the last `min_age` seconds are not indexed,
+because a file added in the same timestamp tick would not change the mtime.
+'''
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import time
+from typing import Dict, List, Optional, Text
+
+IMG_EXTS = ['.BMP', '.GIF', '.JPG', '.JPEG', '.PNG', '.TIF', '.TIFF', '.WEBP']
+DEFAULT_INDEX_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'image-collector', 'datasets')
+INDEX_VERSION = 1
+
+def is_img_file(fpath: Text) -> bool:
+    return os.path.splitext(fpath)[1].upper() in IMG_EXTS
+
+def list_images(class_dir: Text) -> List[Text]:
+    '''image file names in a directory, sorted
+    '''
+    with os.scandir(class_dir) as it:
+        return sorted(e.name for e in it if is_img_file(e.name) and e.is_file())
+
+def default_index_path(dataset_dir: Text) -> Text:
+    '''index file of a dataset in `DEFAULT_INDEX_DIR`
+    '''
+    key = hashlib.sha1(os.path.realpath(dataset_dir).encode()).hexdigest()
+    return os.path.join(DEFAULT_INDEX_DIR, key + '.json')
+
+class DatasetIndex:
+    def __init__(self, dataset_dir: Text, index_path: Optional[Text]=None,
+                 workers: int=8, min_age: float=2.0):
+        '''
+        :param dataset_dir: directory including a directory for each class
+        :param index_path: index file, `default_index_path(dataset_dir)` by default.
+            no index if empty string.
+        :param workers: the no. of directories listed at the same time
+        :param min_age: directories modified in this seconds are listed every time
+        '''
+        self.dataset_dir = dataset_dir
+        self.index_path = default_index_path(dataset_dir) if index_path is None else index_path
+        self.workers = workers
+        self.min_age = min_age
+        # the no. of directories listed by the last `scan`
+        self.num_listed = 0
+
+    def load(self) -> Dict[Text, Dict]:
+        '''class name -> {"mtime_ns", "files"}, {} if there is no valid index
+        '''
+        if not self.index_path:
+            return {}
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if index.get('version') != INDEX_VERSION:
+            return {}
+        return index.get('classes', {})
+
+    def save(self, classes: Dict[Text, Dict]):
+        if not self.index_path:
+            return
+        tmp_path = self.index_path + '.tmp'
+        try:
+            if os.path.dirname(self.index_path):
+                os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump({'version': INDEX_VERSION, 'classes': classes}, f, separators=(',', ':'))
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            # e.g. read-only cache, scan without index
+            pass
+
+    def scan(self) -> 'OrderedDict[Text, List[Text]]':
+        '''
+        :return: class name -> image file names, sorted by class name
+        '''
+        with os.scandir(self.dataset_dir) as it:
+            class_mtimes = {e.name: e.stat().st_mtime_ns for e in it if e.is_dir()}
+        cached = self.load()
+        to_list = [
+            name for name, mtime_ns in class_mtimes.items()
+            if name not in cached or cached[name]['mtime_ns'] != mtime_ns]
+
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            listed = dict(zip(to_list, executor.map(
+                lambda name: list_images(os.path.join(self.dataset_dir, name)), to_list)))
+        self.num_listed = len(to_list)
+
+        classes = OrderedDict()
+        index = {}
+        now_ns = time.time_ns()
+        for name in sorted(class_mtimes):
+            files = listed[name] if name in listed else cached[name]['files']
+            classes[name] = files
+            if now_ns - class_mtimes[name] >= self.min_age * 1e9:
+                index[name] = {'mtime_ns': class_mtimes[name], 'files': files}
+        if to_list or len(index) != len(cached):
+            self.save(index)
+        return classes
+
+def scan_dataset(dataset_dir: Text, use_index: bool=True, workers: int=8) -> 'OrderedDict[Text, List[Text]]':
+    '''image file names of each class
+    :param dataset_dir: directory including a directory for each class
+    :param use_index: read unchanged classes from and save the index
+    :param workers: the no. of directories listed at the same time
+    :return: class name -> image file names, sorted by class name
+    '''
+    return DatasetIndex(dataset_dir, index_path=None if use_index else '', workers=workers).scan()
@@ -0,0 +1,91 @@
+'''
+Content-addressed index of downloaded images.
+
+Image search often returns the same bytes under different urls, also for
+related queries. The SHA-256 of each image is computed while it is
+downloaded, and the index detects exact duplicates inside a class and
+across classes as they arrive.
+
+Actions for duplicates:
+  report: keep the file and record the original in the url manifest
+  skip: delete the file
+  hardlink: replace the file with a hard link to the original
+'''
+
+import glob
+import os
+import threading
+from typing import Dict, Optional, Text
+
+from manifest import Manifest, row_file_name
+
+REPORT = 'report'
+SKIP = 'skip'
+HARDLINK = 'hardlink'
+ACTIONS = [REPORT, SKIP, HARDLINK]
+
+class ContentIndex:
+    '''SHA-256 -> path of the first image with the content (thread-safe)
+
+    Paths are relative to `root` (the save dir), e.g. "images/dog/0001.jpg".
+    '''
+    def __init__(self, root: Text, action: Text=REPORT):
+        '''
+        :param root: save dir
+        :param action: what to do with duplicates, "report", "skip" or "hardlink"
+        '''
+        if action not in ACTIONS:
+            raise RuntimeError('invalid dedup action, "{}". {} are supported.'.format(action, ACTIONS))
+        self.root = root
+        self.action = action
+        self.paths: Dict[Text, Text] = {}
+        self.lock = threading.Lock()
+
+    def load_manifests(self):
+        '''add images recorded in "[root]/urls/*.csv" by previous runs
+        '''
+        for urls_file in sorted(glob.glob(os.path.join(self.root, 'urls', '*.csv'))):
+            class_name = os.path.splitext(os.path.basename(urls_file))[0]
+            for row in Manifest(urls_file).read():
+                if row['is_downloaded'] and row.get('sha256') and not row.get('duplicate_of') and row.get('is_valid') != 0:
+                    path = os.path.join('images', class_name, row_file_name(row))
+                    self.paths.setdefault(row['sha256'], path)
+        return self
+
+    def add(self, sha256: Text, path: Text) -> Optional[Text]:
+        '''register an image
+        :param sha256: hex digest of the content
+        :param path: path of the image file
+        :return: relative path of the original if the content is already known, otherwise None
+        '''
+        rel_path = os.path.relpath(path, self.root)
+        with self.lock:
+            original = self.paths.setdefault(sha256, rel_path)
+        return original if original != rel_path else None
+
+    def resolve(self, path: Text, original: Text):
+        '''apply the action to the duplicate at `path`
+        :param original: relative path of the original returned by `add`
+        '''
+        if self.action == SKIP:
+            os.remove(path)
+        elif self.action == HARDLINK:
+            tmp_path = path + '.link'
+            try:
+                os.link(os.path.join(self.root, original), tmp_path)
+            except OSError:
+                # e.g. other file system, keep the copy
+                return
+            os.replace(tmp_path, path)
+
+    def rename(self, paths: Dict[Text, Text]):
+        '''follow renamed originals
+        :param paths: old relative path -> new relative path
+        '''
+        with self.lock:
+            for sha256, path in self.paths.items():
+                if path in paths:
+                    self.paths[sha256] = paths[path]
+
+    def __len__(self):
+        return len(self.paths)
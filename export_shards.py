@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+'''
+Pack a dataset into large shards for training
+
+Reading millions of small files is slow on network file systems and object
+stores. This packs the images into a few large files:
+
+[output dir]
+  |--shard-00000.bin: image files concatenated as they are (no re-encoding)
+  |--shard-00001.bin
+  |--...
+  |--index.npy: one record per image, (shard, offset, length, label)
+  |--labels.txt: class names, the label is the line no. (0-origin)
+  |--keys.txt: image paths relative to the dataset dir, in the order of index.npy
+  |--meta.json: no. of images and shards
+
+Shards of a previous export into the same directory are removed.
+
+index.npy is a NumPy structured array that can be memory-mapped, and
+shards are memory-mapped by `ShardReader`, so an image is a zero-copy
+slice of its shard. Shards are written in parallel.
+
+Which data can be dealt with?
+- same as stats.py, each class has one directory including all samples
+
+> python3 export_shards.py [save dir]/images [output dir]
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import mmap
+import os
+import random
+import re
+from typing import Dict, Iterator, List, Optional, Text, Tuple
+
+import numpy as np
+
+from dataset_index import scan_dataset
+
+INDEX_DTYPE = np.dtype([('shard', '<u4'), ('offset', '<u8'), ('length', '<u4'), ('label', '<u4')])
+
+SHARD_PATTERN = re.compile(r'shard-\d{5,}\.bin(\.tmp)?$')
+
+def shard_name(shard: int) -> Text:
+    return 'shard-{:05d}.bin'.format(shard)
+
+def remove_stale_shards(dest_dir: Text, num_shards: int) -> int:
+    '''remove shards (and unfinished ones) other than the first `num_shards` left by a previous export
+    :return: the no. of removed files
+    '''
+    current = set(shard_name(i) for i in range(num_shards))
+    removed = 0
+    with os.scandir(dest_dir) as it:
+        for e in it:
+            if SHARD_PATTERN.match(e.name) and e.name not in current and e.is_file():
+                os.remove(e.path)
+                removed += 1
+    return removed
+
+def plan_shards(sizes: List[int], shard_size: int) -> List[List[int]]:
+    '''split images into shards of about `shard_size` bytes, keeping the order
+    :param sizes: file size of each image
+    :return: indices of the images of each shard
+    '''
+    shards = [[]]
+    total = 0
+    for i, size in enumerate(sizes):
+        if shards[-1] and total + size > shard_size:
+            shards.append([])
+            total = 0
+        shards[-1].append(i)
+        total += size
+    return shards if shards[0] else []
+
+def write_shard(path: Text, files: List[Text]) -> np.ndarray:
+    '''concatenate files into a shard
+    :return: (offset, length) of each file
+    '''
+    records = np.zeros((len(files), 2), dtype=np.uint64)
+    tmp_path = path + '.tmp'
+    offset = 0
+    with open(tmp_path, 'wb') as out:
+        for i, f in enumerate(files):
+            with open(f, 'rb') as fp:
+                data = fp.read()
+            out.write(data)
+            records[i] = offset, len(data)
+            offset += len(data)
+    os.replace(tmp_path, path)
+    return records
+
+def main(
+        dataset_dir: Text,
+        dest_dir: Text,
+        shard_size: int=1024 ** 3,
+        workers: int=8,
+        shuffle: bool=False,
+        seed: int=0
+        ):
+    '''pack a dataset into shards
+    :param dataset_dir: dataset directory
+    :param dest_dir: output directory
+    :param shard_size: approximate bytes of a shard
+    :param workers: the no. of shards written at the same time
+    :param shuffle: shuffle images across shards, otherwise in the order of classes and file names
+    :param seed: random seed of `shuffle`
+    '''
+    if not os.path.isdir(dataset_dir):
+        raise RuntimeError('invalid dataset dirctory path, "{}", is not dir or does not exist'.format(dataset_dir))
+    os.makedirs(dest_dir, exist_ok=True)
+
+    class_samples = scan_dataset(dataset_dir)
+    labels = list(class_samples)
+    keys = []
+    image_labels = []
+    for label, (class_name, files) in enumerate(class_samples.items()):
+        keys += [os.path.join(class_name, f) for f in files]
+        image_labels += [label] * len(files)
+    order = list(range(len(keys)))
+    if shuffle:
+        random.Random(seed).shuffle(order)
+    keys = [keys[i] for i in order]
+    image_labels = [image_labels[i] for i in order]
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        sizes = list(executor.map(lambda k: os.path.getsize(os.path.join(dataset_dir, k)), keys))
+        shards = plan_shards(sizes, shard_size)
+        records = list(executor.map(
+            lambda shard: write_shard(
+                os.path.join(dest_dir, shard_name(shard[0])),
+                [os.path.join(dataset_dir, keys[i]) for i in shard[1]]),
+            enumerate(shards)))
+
+    index = np.zeros(len(keys), dtype=INDEX_DTYPE)
+    start = 0
+    for shard, (image_indices, shard_records) in enumerate(zip(shards, records)):
+        end = start + len(image_indices)
+        index['shard'][start:end] = shard
+        index['offset'][start:end] = shard_records[:, 0]
+        index['length'][start:end] = shard_records[:, 1]
+        start = end
+    index['label'] = image_labels
+
+    np.save(os.path.join(dest_dir, 'index.npy'), index)
+    with open(os.path.join(dest_dir, 'labels.txt'), 'w') as f:
+        f.writelines(label + '\n' for label in labels)
+    with open(os.path.join(dest_dir, 'keys.txt'), 'w') as f:
+        f.writelines(key + '\n' for key in keys)
+    with open(os.path.join(dest_dir, 'meta.json'), 'w') as f:
+        json.dump({'num_images': len(keys), 'num_shards': len(shards), 'num_classes': len(labels),
+                   'total_bytes': int(sum(sizes))}, f, indent=2)
+    # after the new index is saved, so a reader never sees an index without its shards
+    remove_stale_shards(dest_dir, len(shards))
+    print('{:,} images in {:,} shards'.format(len(keys), len(shards)))
+
+class ShardReader:
+    '''random access and streaming over exported shards
+
+    >>> reader = ShardReader('shards')
+    >>> data, label = reader[0] # memoryview of the image file, e.g. Image.open(io.BytesIO(data))
+    >>> for data, label in reader.stream(shuffle=True): ...
+    '''
+    def __init__(self, export_dir: Text):
+        self.export_dir = export_dir
+        self.index = np.load(os.path.join(export_dir, 'index.npy'), mmap_mode='r')
+        with open(os.path.join(export_dir, 'labels.txt')) as f:
+            self.labels = f.read().splitlines()
+        self.shards: Dict[int, mmap.mmap] = {}
+
+    def shard(self, shard: int) -> mmap.mmap:
+        if shard not in self.shards:
+            with open(os.path.join(self.export_dir, shard_name(shard)), 'rb') as f:
+                # length 0 cannot be mapped
+                self.shards[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+        return self.shards[shard]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i: int) -> Tuple[memoryview, int]:
+        '''
+        :return: (bytes of the image file, label)
+        '''
+        shard, offset, length, label = self.index[i]
+        offset = int(offset)
+        return memoryview(self.shard(int(shard)))[offset:offset + int(length)], int(label)
+
+    def stream(self, shuffle: bool=False, seed: Optional[int]=None) -> Iterator[Tuple[memoryview, int]]:
+        '''read shard by shard, sequential reads within a shard
+        :param shuffle: shuffle the order of shards and the images in each shard
+        '''
+        rng = np.random.default_rng(seed)
+        # images are in the order of shards
+        bounds = np.searchsorted(self.index['shard'], np.arange(self.index['shard'].max(initial=0) + 2))
+        shards = np.arange(len(bounds) - 1)
+        if shuffle:
+            rng.shuffle(shards)
+        for shard in shards:
+            indices = np.arange(bounds[shard], bounds[shard + 1])
+            if shuffle:
+                rng.shuffle(indices)
+            for i in indices:
+                yield self[i]
+
+    def sample(self, n: int, seed: Optional[int]=None) -> Iterator[Tuple[memoryview, int]]:
+        '''`n` images drawn uniformly with replacement
+        '''
+        for i in np.random.default_rng(seed).integers(0, len(self), size=n):
+            yield self[i]
+
+    def close(self):
+        '''unmap the shards, memoryviews of images should be released before'''
+        for m in self.shards.values():
+            if isinstance(m, mmap.mmap):
+                m.close()
+        self.shards = {}
+
+
+if __name__ == '__main__':
+    import argparse
+    psr = argparse.ArgumentParser()
+    psr.add_argument('data', help='dataset directory')
+    psr.add_argument('out', help='output directory')
+    psr.add_argument('--shard-size', help='approximate bytes of a shard', type=int, default=1024 ** 3)
+    psr.add_argument('-w', '--workers', help='the no. of shards written at the same time', type=int, default=8)
+    psr.add_argument('--shuffle', help='shuffle images across shards', action='store_true')
+    psr.add_argument('--seed', help='random seed of --shuffle', type=int, default=0)
+    a = psr.parse_args()
+    main(a.data, a.out, shard_size=a.shard_size, workers=a.workers, shuffle=a.shuffle, seed=a.seed)
@@ -0,0 +1,146 @@
+'''
+Extract image urls from image search result pages.
+
+Each `.rg_meta.notranslate` element of a result page contains a JSON
+object, whose "ou" field is the original image url.
+
+- ScanExtractor: targeted string scanner, no DOM tree (fast, default)
+- LxmlExtractor: lxml.html tree and XPath
+- SoupExtractor: BeautifulSoup tree and CSS selector (the original implementation)
+- FallbackExtractor: try extractors in order until one finds urls
+
+Parsers are imported when an extractor is first used.
+'''
+
+import html
+import json
+import re
+from typing import List, Sequence, Text
+
+class Extractor:
+    '''interface of extractors
+    '''
+    name = ''
+
+    def extract(self, page: Text) -> List[Text]:
+        '''
+        :param page: html of a result page
+        :return: image urls in the order of the page
+        '''
+        raise NotImplementedError
+
+def urls_from_metas(metas) -> List[Text]:
+    '''get "ou" of JSON texts of .rg_meta elements
+    '''
+    urls = []
+    for meta in metas:
+        js = json.loads(meta)
+        urls.append(js['ou'])
+    return urls
+
+class ScanExtractor(Extractor):
+    '''find .rg_meta elements with string search instead of building a DOM tree
+
+    Only the "ou" string of each JSON text is decoded. Assumes the JSON
+    text of .rg_meta has no child elements, which is how the result pages
+    are written. Use `FallbackExtractor` to fall back to a parser for other pages.
+    '''
+    name = 'scan'
+
+    # class attribute of a start tag
+    class_pattern = re.compile(r'\sclass\s*=\s*(["\'])([^"\']*)\1')
+    # JSON string literal
+    string_pattern = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+
+    def extract(self, page: Text) -> List[Text]:
+        metas = []
+        pos = page.find('rg_meta')
+        while pos >= 0:
+            # start tag around the occurrence, and its text up to the next tag
+            tag_start = page.rfind('<', 0, pos)
+            tag_end = page.find('>', pos)
+            text_end = page.find('<', tag_end)
+            if tag_start < 0 or tag_end < 0 or text_end < 0:
+                break
+            m = self.class_pattern.search(page, tag_start, tag_end)
+            if m is not None and page.startswith('</', text_end):
+                classes = m.group(2).split()
+                if 'rg_meta' in classes and 'notranslate' in classes:
+                    metas.append(page[tag_end + 1:text_end])
+            pos = page.find('rg_meta', text_end)
+        return [self.url_from_meta(meta) for meta in metas]
+
+    def url_from_meta(self, meta: Text) -> Text:
+        if '&' in meta:
+            meta = html.unescape(meta)
+        # only the "ou" string is decoded instead of the whole object
+        start = meta.find('"ou":"')
+        if start < 0 or meta[start - 1] == '\\':
+            # other format, or no "ou" field to let json raise the error
+            return json.loads(meta)['ou']
+        m = self.string_pattern.match(meta, start + 5)
+        if m is None:
+            # unterminated string, let json raise ValueError
+            return json.loads(meta)['ou']
+        return json.loads(m.group(0))
+
+class LxmlExtractor(Extractor):
+    name = 'lxml'
+
+    xpath = ('//*[contains(concat(" ", normalize-space(@class), " "), " rg_meta ")'
+             ' and contains(concat(" ", normalize-space(@class), " "), " notranslate ")]')
+
+    def extract(self, page: Text) -> List[Text]:
+        import lxml.html
+        if not page.strip():
+            return []
+        tree = lxml.html.fromstring(page)
+        return urls_from_metas(e.text_content() for e in tree.xpath(self.xpath))
+
+class SoupExtractor(Extractor):
+    name = 'soup'
+
+    def extract(self, page: Text) -> List[Text]:
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup(page, 'lxml')
+        elements = soup.select('.rg_meta.notranslate')
+        return urls_from_metas(e.get_text() for e in elements)
+
+class FallbackExtractor(Extractor):
+    '''try extractors in order
+
+    The next extractor is used if an extractor raises an error, or finds no
+    url on a page that mentions "rg_meta".
+    '''
+    name = 'auto'
+
+    def __init__(self, extractors: Sequence[Extractor]):
+        self.extractors = list(extractors)
+
+    def extract(self, page: Text) -> List[Text]:
+        urls = []
+        for extractor in self.extractors:
+            try:
+                urls = extractor.extract(page)
+            except (ValueError, KeyError, TypeError):
+                continue
+            if urls or 'rg_meta' not in page:
+                return urls
+        return urls
+
+EXTRACTORS = {
+    'scan': ScanExtractor,
+    'lxml': LxmlExtractor,
+    'soup': SoupExtractor,
+    }
+
+def get_extractor(name: Text='auto') -> Extractor:
+    '''
+    :param name: "auto" (scan with soup fallback), "scan", "lxml" or "soup"
+    '''
+    if name == 'auto':
+        return FallbackExtractor([ScanExtractor(), SoupExtractor()])
+    try:
+        return EXTRACTORS[name]()
+    except KeyError:
+        raise RuntimeError('invalid extractor, "{}". {} are supported.'.format(name, ['auto'] + list(EXTRACTORS)))
@@ -0,0 +1,117 @@
+'''
+Cached SHA-256 of the images of a dataset, used by concat_datasets.py.
+
+Hashes are computed in a thread pool (hashlib releases the GIL while
+hashing) and appended to "[dataset dir]/.hash_index.csv" as soon as
+each one is done, so an interrupted run resumes where it stopped.
+An entry is reused while the size and mtime of the file are unchanged.
+'''
+
+import csv
+import hashlib
+import os
+import threading
+from typing import Dict, Iterable, Optional, Text, Tuple
+
+from scheduler import run_pipeline
+
+INDEX_FILE = '.hash_index.csv'
+FIELDS = ['path', 'size', 'mtime_ns', 'sha256']
+
+def file_sha256(path: Text, chunk_size: int=1024 * 1024) -> Text:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+class HashIndex:
+    def __init__(self, root: Text, index_path: Optional[Text]=None, workers: int=8):
+        '''
+        :param root: dataset directory, paths are relative to it
+        :param index_path: index file, "[root]/.hash_index.csv" by default. no index if empty string.
+        :param workers: the no. of files hashed at the same time
+        '''
+        self.root = root
+        self.index_path = os.path.join(root, INDEX_FILE) if index_path is None else index_path
+        self.workers = workers
+        self.lock = threading.Lock()
+        # the no. of files hashed by the last `hashes`
+        self.num_hashed = 0
+
+    def load(self) -> Dict[Text, Tuple[int, int, Text]]:
+        '''relative path -> (size, mtime_ns, sha256), the last entry of each path wins
+        '''
+        entries = {}
+        if not self.index_path or not os.path.isfile(self.index_path):
+            return entries
+        with open(self.index_path, newline='') as f:
+            for row in csv.DictReader(f):
+                try:
+                    entries[row['path']] = (int(row['size']), int(row['mtime_ns']), row['sha256'])
+                except (TypeError, ValueError):
+                    # broken line written at a crash
+                    continue
+        return entries
+
+    def write(self, entries: Dict[Text, Tuple[int, int, Text]]):
+        '''rewrite the index with `entries` only
+        '''
+        if not self.index_path:
+            return
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', newline='') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(FIELDS)
+            writer.writerows([path] + list(entry) for path, entry in sorted(entries.items()))
+        os.replace(tmp_path, self.index_path)
+
+    def hashes(self, rel_paths: Iterable[Text], known: Optional[Dict[Text, Text]]=None) -> Dict[Text, Text]:
+        '''SHA-256 of files, from the index if they are unchanged
+        :param rel_paths: paths relative to `root`
+        :param known: relative path -> SHA-256 already known (e.g. recorded while downloading),
+            used instead of hashing files not in the index
+        :return: relative path -> SHA-256
+        '''
+        cached = self.load()
+        known = known or {}
+        new_entries = {}
+        index_file = None
+        writer = None
+        if self.index_path:
+            try:
+                is_new = not os.path.isfile(self.index_path)
+                index_file = open(self.index_path, 'a', newline='')
+                writer = csv.writer(index_file, lineterminator='\n')
+                if is_new:
+                    writer.writerow(FIELDS)
+            except OSError:
+                # e.g. read-only dataset, hash without index
+                index_file = None
+
+        def run(rel_path):
+            st = os.stat(os.path.join(self.root, rel_path))
+            entry = cached.get(rel_path)
+            if entry is not None and entry[:2] == (st.st_size, st.st_mtime_ns):
+                return rel_path, entry
+            sha256 = known.get(rel_path) or file_sha256(os.path.join(self.root, rel_path))
+            entry = (st.st_size, st.st_mtime_ns, sha256)
+            with self.lock:
+                new_entries[rel_path] = entry
+                if writer is not None:
+                    writer.writerow([rel_path] + list(entry))
+                    index_file.flush()
+            return rel_path, entry
+
+        try:
+            results = run_pipeline(run, rel_paths, max_workers=self.workers, queue_size=4 * self.workers)
+        finally:
+            if index_file is not None:
+                index_file.close()
+        self.num_hashed = len(new_entries)
+
+        entries = dict(results)
+        if index_file is not None and (new_entries or len(entries) != len(cached)):
+            # drop entries of removed files and the duplicated lines
+            self.write(entries)
+        return {rel_path: entry[2] for rel_path, entry in entries.items()}
@@ -0,0 +1,241 @@
+'''
+Pooled, keep-alive HTTP client shared by the searches and the image downloads.
+
+Image urls of a query mostly point to a few CDNs, so keeping connections
+alive per host saves TCP and TLS handshakes for every image.
+'''
+
+from collections import Counter, namedtuple
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Iterator, Optional, Text
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ChunkedEncodingError, ContentDecodingError
+from urllib3.exceptions import DecodeError, ProtocolError, ReadTimeoutError, SSLError
+
+from metrics import Metrics
+
+class PooledHttpClient:
+    '''thread-safe HTTP client with per-host connection pools
+
+    One `requests.Session` is shared by all the threads. urllib3 keeps
+    `pool_size` connections alive for each of `num_pools` hosts.
+    '''
+    def __init__(self, pool_size: int=10, num_pools: int=100, headers: Optional[Dict[Text, Text]]=None):
+        '''
+        :param pool_size: max connections kept alive for each host, should be >= the no. of workers
+        :param num_pools: max hosts whose connections are kept alive
+        :param headers: default request headers
+        '''
+        self.pool_size = pool_size
+        self.num_pools = num_pools
+        self.session = requests.session()
+        adapter = HTTPAdapter(pool_connections=num_pools, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if headers:
+            self.session.headers.update(headers)
+        self.adapter = adapter
+        self.lock = threading.Lock()
+        self.requests_per_host = Counter()
+
+    def get(self, url: Text, **kwargs) -> requests.Response:
+        '''send GET request through the pool
+        :param url: request url
+        :param kwargs: passed to `requests.Session.get`
+        '''
+        with self.lock:
+            self.requests_per_host[urlparse(url).netloc] += 1
+        return self.session.get(url, **kwargs)
+
+    def stats(self) -> Dict[Text, int]:
+        '''connection reuse stats
+
+        `connections` counts the connections opened by the pools that are
+        still cached, so it is a lower bound once pools have been evicted.
+        '''
+        pools = self.adapter.poolmanager.pools
+        connections = sum(pools[key].num_connections for key in pools.keys())
+        with self.lock:
+            num_requests = sum(self.requests_per_host.values())
+            num_hosts = len(self.requests_per_host)
+        return {
+            'requests': num_requests,
+            'hosts': num_hosts,
+            'connections': connections,
+            'reused': max(0, num_requests - connections),
+            }
+
+    def close(self):
+        self.session.close()
+
+class DownloadRejected(Exception):
+    '''the response is not worth retrying (too large, not an image, too slow)
+    '''
+    pass
+
+# Content-Types accepted as images. Some hosts send images as octet-stream.
+ACCEPTED_CONTENT_TYPES = ('image/', 'application/octet-stream', 'binary/octet-stream')
+
+def is_accepted_content_type(content_type: Optional[Text]) -> bool:
+    '''True if the Content-Type can be an image (missing Content-Type is accepted)
+    '''
+    if not content_type:
+        return True
+    return content_type.strip().lower().startswith(ACCEPTED_CONTENT_TYPES)
+
+# result of `stream_to_file`: bytes written, SHA-256 of them, validators of the response,
+# and whether the server answered 304 Not Modified to a conditional request (nothing written)
+Downloaded = namedtuple(
+    'Downloaded', ['size', 'sha256', 'etag', 'last_modified', 'content_length', 'not_modified'],
+    defaults=(None, None, None, False))
+
+def iter_arrived(res: requests.Response, chunk_size: int) -> Iterator[bytes]:
+    '''body of a streamed response in chunks of at most `chunk_size` bytes, as soon as they arrive
+
+    `Response.iter_content` blocks until `chunk_size` bytes are received, so a
+    host sending a few bytes at a time holds the caller much longer than the
+    read timeout. Falls back to `iter_content` if urllib3 has no `read1` (< 2.0).
+    '''
+    read1 = getattr(res.raw, 'read1', None)
+    if read1 is None:
+        yield from res.iter_content(chunk_size=chunk_size)
+        return
+    # the same errors as iter_content
+    try:
+        while True:
+            chunk = read1(chunk_size, decode_content=True)
+            if not chunk:
+                return
+            yield chunk
+    except ProtocolError as e:
+        raise ChunkedEncodingError(e)
+    except DecodeError as e:
+        raise ContentDecodingError(e)
+    except ReadTimeoutError as e:
+        raise requests.ConnectionError(e)
+    except SSLError as e:
+        raise requests.exceptions.SSLError(e)
+
+def stream_to_file(
+        client: PooledHttpClient,
+        url: Text,
+        dest_path: Text,
+        headers: Optional[Dict[Text, Text]]=None,
+        timeout: float=15,
+        max_bytes: Optional[int]=None,
+        deadline: Optional[float]=None,
+        chunk_size: int=64 * 1024,
+        metrics: Optional[Metrics]=None,
+        etag: Optional[Text]=None,
+        last_modified: Optional[Text]=None) -> Downloaded:
+    '''download `url` to `dest_path` chunk by chunk
+
+    The body is written to a temporary file next to `dest_path`, which is
+    renamed to `dest_path` only when the whole body has been received,
+    so `dest_path` never contains a partial image.
+
+    :param client: HTTP client
+    :param url: image url
+    :param dest_path: file path to save the body
+    :param headers: request headers
+    :param timeout: connect and read timeout
+    :param max_bytes: max body size, no limit if None
+    :param deadline: `time.monotonic()` value by which the body must be received, no limit if None.
+        The read timeout is shortened to the time left, and chunks are handled as they arrive,
+        so a slow host is given up soon after the deadline.
+    :param chunk_size: bytes read at once
+    :param metrics: records the time of the writes as stage "write", not recorded if None
+    :param etag: ETag of the saved file, sent as If-None-Match
+    :param last_modified: Last-Modified of the saved file, sent as If-Modified-Since
+    :return: the no. of bytes written, SHA-256 hex digest of them and the validators of the response.
+        If the server answers 304 Not Modified, `dest_path` is not touched and `not_modified` is True.
+    :raises DownloadRejected: if the response is too large, not an image, or too slow
+    :raises requests.HTTPError: if the status is 4xx or 5xx
+    '''
+    if etag or last_modified:
+        headers = dict(headers or {})
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+    if deadline is None:
+        return _stream_to_file(client, url, dest_path, headers, timeout, max_bytes, deadline, chunk_size,
+                               metrics, etag, last_modified)
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DownloadRejected('deadline exceeded before the request')
+    try:
+        return _stream_to_file(client, url, dest_path, headers, (timeout, min(timeout, remaining)), max_bytes,
+                               deadline, chunk_size, metrics, etag, last_modified)
+    except (requests.ConnectionError, requests.Timeout) as e:
+        # a timeout shortened by the deadline is not a network failure to retry
+        if time.monotonic() >= deadline:
+            raise DownloadRejected('deadline exceeded, {}'.format(e)) from e
+        raise
+
+def _stream_to_file(client, url, dest_path, headers, timeout, max_bytes, deadline, chunk_size,
+                    metrics, etag, last_modified) -> Downloaded:
+    with client.get(url, headers=headers, timeout=timeout, stream=True) as res:
+        if res.status_code == 304:
+            return Downloaded(
+                0, None, res.headers.get('ETag', etag), res.headers.get('Last-Modified', last_modified),
+                None, not_modified=True)
+        res.raise_for_status()
+
+        # check headers before reading the body
+        content_type = res.headers.get('Content-Type')
+        if not is_accepted_content_type(content_type):
+            raise DownloadRejected('not an image, Content-Type: {}'.format(content_type))
+        content_length = res.headers.get('Content-Length')
+        if max_bytes is not None and content_length and content_length.isdigit() and int(content_length) > max_bytes:
+            raise DownloadRejected('too large, Content-Length: {}'.format(content_length))
+
+        dest_dir, dest_name = os.path.split(dest_path)
+        fd, tmp_path = tempfile.mkstemp(prefix='.' + dest_name + '.', suffix='.part', dir=dest_dir or '.')
+        try:
+            size = 0
+            sha256 = hashlib.sha256()
+            # time in the writes only, not waiting for the network
+            write_seconds = 0.0
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter_arrived(res, chunk_size):
+                    size += len(chunk)
+                    if max_bytes is not None and size > max_bytes:
+                        raise DownloadRejected('too large, more than {} bytes'.format(max_bytes))
+                    if deadline is not None and time.monotonic() > deadline:
+                        raise DownloadRejected('deadline exceeded after {} bytes'.format(size))
+                    start = time.perf_counter()
+                    f.write(chunk)
+                    write_seconds += time.perf_counter() - start
+                    sha256.update(chunk)
+            start = time.perf_counter()
+            os.replace(tmp_path, dest_path)
+            write_seconds += time.perf_counter() - start
+            if metrics is not None:
+                metrics.observe('write', write_seconds, bytes=size)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return Downloaded(
+            size, sha256.hexdigest(), res.headers.get('ETag'), res.headers.get('Last-Modified'),
+            int(content_length) if content_length and content_length.isdigit() else size)
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+def default_client() -> PooledHttpClient:
+    '''client shared in the process when no client is given explicitly
+    '''
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = PooledHttpClient()
+        return _default_client
@@ -1,18 +1,35 @@
-import csv
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import glob
-import json
 import os
 import re
 import sys
 import time
-import urllib
-
-from bs4 import BeautifulSoup
-import requests
-from requests.exceptions import ConnectionError, ReadTimeout
-from typing import List
-from urllib.request import HTTPError, URLError
+import urllib.parse
+
+from typing import Dict, List
+
+from dedup import ContentIndex
+from extractors import Extractor, get_extractor
+from file_links import link_file
+from http_client import Downloaded, PooledHttpClient, default_client, stream_to_file
+from manifest import Manifest, image_file_name, merge_rows, row_file_name
+from metrics import Metrics, Profiler, stage
+from normalize_images import Settings as NormalizeSettings, normalize_class, summary as normalize_summary
+from retry import CircuitOpen, RetryPolicy, default_retry_policy, is_congestion
+from scheduler import (AdaptiveConcurrency, Budget, BudgetExhausted, Cancelled, HostRateLimiter, keep_alive, run_jobs,
+                       run_pipeline, within_budgets)
+from search_cache import DEFAULT_CACHE_DIR, SearchCache, parse_search_url
+from url_db import FAILED, INVALID, OK, UrlDB
+from validate_images import validate_class
+from work_queue import WorkQueue
+
+# default endpoint of image search, can be changed by `Google(search_url=...)`
+# e.g. to a local fake server of benchmarks/fake_server.py
+GOOGLE_SEARCH_URL = 'https://www.google.co.jp/search'
+
+# interval of the heartbeats of a query while its images are validated and normalized
+HEARTBEAT_SECONDS = 10
 
 def with_timestamp(func):
     '''add prefix of timestamp to input text
@@ -37,6 +54,29 @@ def print_erro_with_trace(e):
     tb = sys.exc_info()[2]
     my_print(e.with_traceback(tb))
 
+def print_retry_error(e, attempt, delay):
+    '''print error of a request, passed to `RetryPolicy.call` as `on_error`
+    :param e: exception object
+    :param attempt: 1-origin count of tries
+    :param delay: seconds before the next try, None if giving up
+    '''
+    print(type(e).__name__)
+    print_erro_with_trace(e)
+    if delay is not None:
+        my_print('retry in {:.1f} sec...'.format(delay))
+
+def retry_error_handler(metrics: Metrics=None):
+    '''`print_retry_error` also counting retries and give-ups of requests in `metrics`
+    '''
+    if metrics is None:
+        return print_retry_error
+
+    def on_error(e, attempt, delay):
+        metrics.count('request_errors')
+        metrics.count('retries' if delay is not None else 'give_ups')
+        print_retry_error(e, attempt, delay)
+    return on_error
+
 def queries_from_other_sources(func):
     '''decorator to edit sys.args and run func several times
 
@@ -55,19 +95,64 @@ def queries_from_other_sources(func):
 
     Otherwise:
     just use the arg as query to search with google
+
+    The queries are run at most `query_workers` at once (keyword argument, default 1).
+    With `work_queue` (keyword argument, `work_queue.WorkQueue`), the queries of a file
+    or directories are added to the queue and leased from it, so that several processes
+    given the same target split the queries.
     '''
-    def wrapper(*args, **kwargs):
+    def wrapper(*args, query_workers=1, work_queue: WorkQueue=None, **kwargs):
         if len(args[0]) != 4:
             raise RuntimeError('Invalid argment\n> python3 ./image_collector_cui.py [target name] [download number] [save dir]')
+
+        def run(query_dirname, **overrides):
+            # each query gets its own copy of args because queries may run concurrently
+            query, dirname = query_dirname
+            query_args = list(args[0])
+            query_args[1] = query
+            query_args.append(dirname)
+            return func(query_args, **dict(kwargs, **overrides))
+
+        failed = []
+
+        def run_unqueued(query_dirname):
+            try:
+                run(query_dirname)
+            except BudgetExhausted:
+                # printed by `collect`, continued by --resume
+                pass
+            except Exception as e:
+                # the other queries go on, as failed queries of the work queue
+                print_erro_with_trace(e)
+                my_print('Failed "{}": {}: {}'.format(query_dirname[0], type(e).__name__, e))
+                failed.append(query_dirname[0])
+
+        def run_leased(job, lease):
+            my_print('Leased "{}" (attempt {})'.format(job.query, job.attempts))
+            # stopped when the lease is lost, and the lease is renewed only while urls are taken
+            overrides = dict(cancel=lease.cancelled, heartbeat=lease.progress)
+            if job.attempts > 1 or job.error:
+                # the worker of the previous attempt stopped or ran out of budget, continue from its manifest
+                overrides['resume'] = True
+            return run((job.query, job.dirname), **overrides)
+
+        def run_all(jobs):
+            if work_queue is None:
+                run_jobs(run_unqueued, jobs, max_workers=query_workers)
+                if failed:
+                    my_print('{} queries failed:'.format(len(failed)), failed)
+                return
+            added = work_queue.add(jobs)
+            my_print('Queue: {} queries added, {}'.format(added, work_queue.stats()))
+            work_queue.run(run_leased, workers=query_workers,
+                           on_lost=lambda dirnames: my_print('Lease lost, leased by another worker, stop:', dirnames))
+            my_print('Queue:', work_queue.stats())
+
         if os.path.isfile(args[0][1]):
             with open(args[0][1], 'r') as f:
                 queries = [q[:-1] for q in f.readlines()] # remove '\n' at the end of each string
             dirnames = [q.replace(' ', '_') for q in queries]
-            args[0].append('')
-            for query, dirname in zip(queries, dirnames):
-                args[0][1] = query
-                args[0][4] = dirname
-                func(args[0], **kwargs)
+            run_all(list(zip(queries, dirnames)))
         elif os.path.isdir(os.path.split(args[0][1])[0]):
 
             # retry download if the no. of images is less than this number.
@@ -78,36 +163,73 @@ def queries_from_other_sources(func):
             dirnames = [os.path.split(p)[1] for p in dirpaths]
             #my_print('dirnames:',dirnames)
             queries = [re.sub(r'^n\d{8}-', '', s.replace('_', ' ')) for s in dirnames]
-            args[0].append('')
+            if kwargs.get('resume'):
+                # the manifests know the progress of each class
+                min_num_enough_images = int(args[0][2])
+            if kwargs.get('refresh'):
+                # saved images of every class are refreshed
+                min_num_enough_images = float('inf')
+
+            jobs = []
             for query, dirname, dirpath in zip(queries, dirnames, dirpaths):
-                num_images = len([f for f in glob.glob(os.path.join(dirpath, '*')) if os.path.isfile(f)])
+                if kwargs.get('resume'):
+                    _, urls_file = class_paths(args[0][3], dirname=dirname)
+                    num_images = num_downloaded(Manifest(urls_file).read())
+                else:
+                    num_images = len([f for f in glob.glob(os.path.join(dirpath, '*')) if os.path.isfile(f)])
                 my_print('The no. of images downloaded with "{}" of "{}": {}'.format(query, dirname, num_images))
                 if num_images >= min_num_enough_images:
                     my_print('skip download')
                     continue
-                args[0][1] = query
-                args[0][4] = dirname
-                my_print(args[0])
-                func(args[0], **kwargs)
+                jobs.append((query, dirname))
+            run_all(jobs)
         else:
-            func(args[0], **kwargs)
+            try:
+                func(args[0], **kwargs)
+            except BudgetExhausted:
+                pass
         return None
     return wrapper
 
 
 class Google(object):
 
-    def __init__(self):
-        self.GOOGLE_SEARCH_URL = 'https://www.google.co.jp/search'
-        self.session = requests.session()
-        self.session.headers.update(
-            {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:10.0) Gecko/20100101 Firefox/10.0'})
+    def __init__(self, rate_limiter: HostRateLimiter=None, client: PooledHttpClient=None,
+            retry_policy: RetryPolicy=None, extractor: Extractor=None, search_cache: SearchCache=None,
+            search_url: str=None, metrics: Metrics=None):
+        '''
+        :param rate_limiter: limiter shared with other searches and downloads, no limit if None
+        :param client: HTTP client shared with the downloads, the process default if None
+        :param retry_policy: retry policy shared with the downloads, the process default if None
+        :param extractor: extractor of image urls from result pages, `get_extractor('auto')` if None
+        :param search_cache: cache of urls of result pages, no cache if None
+        :param search_url: endpoint of image search, `GOOGLE_SEARCH_URL` if None
+        :param metrics: records the time of requests and parsing of result pages, not recorded if None
+        '''
+        self.GOOGLE_SEARCH_URL = search_url if search_url is not None else GOOGLE_SEARCH_URL
+        self.rate_limiter = rate_limiter
+        self.client = client if client is not None else default_client()
+        self.retry_policy = retry_policy if retry_policy is not None else default_retry_policy()
+        self.extractor = extractor if extractor is not None else get_extractor('auto')
+        self.search_cache = search_cache
+        self.metrics = metrics
+        self.session = self.client.session
+        # the client is shared, so the headers are sent per request
+        # instead of updating the session.
+        self.headers = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:10.0) Gecko/20100101 Firefox/10.0'}
 
     def search(self, keyword, maximum):
         my_print('Begining searching', keyword)
         query = self.query_gen(keyword)
         return self.image_search(query, maximum)
 
+    def iter_search(self, keyword, maximum):
+        '''same as `search` but yield image urls as soon as each result page is parsed
+        '''
+        my_print('Begining searching', keyword)
+        query = self.query_gen(keyword)
+        return self.iter_image_search(query, maximum)
+
     def query_gen(self, keyword):
         # Search query generator
         page = 0
@@ -126,150 +248,629 @@ class Google(object):
         :param timeout: request timeout
         :param max_try: max times of trying to request. 1 means no retry.
         '''
+        def request():
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(query)
+            res = self.client.get(query, headers=self.headers, timeout=timeout)
+            res.raise_for_status()
+            return res.text
+
         html = None
-        # retry if the exception is ConnectionError or ReadTimeout
-        for i in range(max_try):
+        with stage(self.metrics, 'search_request', url=query) as event:
             try:
-                html = self.session.get(query, timeout=timeout).text
-                break
-            except (ConnectionError, ReadTimeout) as e:
-                print('ConnectionError, ReadTimeout')
-                print_erro_with_trace(e)
-            except Exception as e:
-                print('Exception')
+                html = self.retry_policy.call(query, request, max_try=max_try, on_error=retry_error_handler(self.metrics))
+            except CircuitOpen as e:
                 print_erro_with_trace(e)
-                break
-
-            my_print('retry in 30 sec...')
-            time.sleep(30) # may need some time to escape connection refusion next time
-
+            except Exception:
+                # already printed by print_retry_error
+                pass
+            event['ok'] = html is not None
         return html
 
-    def image_search(self, query_gen, maximum):
+    def image_search(self, query_gen, maximum, max_failed_pages=3):
         # Search image
-        result = []
+        return list(self.iter_image_search(query_gen, maximum, max_failed_pages=max_failed_pages))
+
+    def search_page(self, query):
+        '''get image urls of a result page from the cache or by searching
+        :param query: search page url
+        :return: image urls, None if the page could not be requested
+        '''
+        if self.search_cache is not None:
+            keyword, page = parse_search_url(query)
+            imageURLs = self.search_cache.get(keyword, page)
+            if imageURLs is not None:
+                if self.metrics is not None:
+                    self.metrics.count('search_cache_hits')
+                return imageURLs
+
+        html = self.request_with_retry(query, timeout=20, max_try=2)
+        if html is None:
+            return None
+
+        # parse to find image url
+        with stage(self.metrics, 'parse', bytes=len(html)) as event:
+            imageURLs = self.extractor.extract(html)
+            event['urls'] = len(imageURLs)
+        # a page without urls may be a consent or CAPTCHA page, not the end of the results
+        if self.search_cache is not None and imageURLs:
+            self.search_cache.put(keyword, page, imageURLs)
+        return imageURLs
+
+    def iter_image_search(self, query_gen, maximum, max_failed_pages=3):
+        '''yield image urls page by page
+        :param query_gen: generator of search page urls
+        :param maximum: max no. of image urls
+        :param max_failed_pages: give up after this no. of consecutive pages could not be requested
+        '''
         total = 0
-        while True:
+        failed_pages = 0
+        while total < maximum:
             # Search
             query = next(query_gen)
-            html = self.request_with_retry(query, timeout=20, max_try=2)
-            if html is None:
+            imageURLs = self.search_page(query)
+            if imageURLs is None:
+                failed_pages += 1
+                if failed_pages >= max_failed_pages:
+                    my_print('-> Give up searching after', failed_pages, 'failed pages')
+                    break
                 continue
-
-            # parse to find image url
-            soup = BeautifulSoup(html, 'lxml')
-            elements = soup.select('.rg_meta.notranslate')
-            jsons = [json.loads(e.get_text()) for e in elements]
-            imageURLs = [js['ou'] for js in jsons]
+            failed_pages = 0
 
             # Add search result
             if not len(imageURLs):
                 my_print('-> No more images')
                 break
-            elif len(imageURLs) > maximum - total:
-                result += imageURLs[:maximum - total]
-                break
-            else:
-                result += imageURLs
-                total += len(imageURLs)
-
-        my_print('-> Found', str(len(result)), 'images')
-        return result
-
-def download_img_with_retry(query, timeout=15, max_try=2):
-    '''try to download image from web URL
-    :param query: request query
+            imageURLs = imageURLs[:maximum - total]
+            total += len(imageURLs)
+            yield from imageURLs
+
+        my_print('-> Found', str(total), 'images')
+
+def download_img_with_retry(url, dest_path, headers=None, timeout=15, max_try=2,
+        rate_limiter: HostRateLimiter=None, client: PooledHttpClient=None,
+        max_bytes: int=None, max_seconds: float=None, retry_policy: RetryPolicy=None, metrics: Metrics=None,
+        etag: str=None, last_modified: str=None, on_attempt=None):
+    '''try to download image from web URL and save it
+    :param url: image url
+    :param dest_path: file path to save the image
+    :param headers: request headers
     :param timeout: request timeout
     :param max_try: max times of trying to request. 1 means no retry.
+    :param rate_limiter: per-host rate limiter, no limit if None
+    :param client: pooled HTTP client, the process default if None
+    :param max_bytes: give up images larger than this, no limit if None
+    :param max_seconds: give up images not received in this time including retries, no limit if None
+    :param retry_policy: retry policy, the process default if None
+    :param metrics: records the time of the download and the writes, not recorded if None
+    :param etag: ETag of the saved image for a conditional request
+    :param last_modified: Last-Modified of the saved image for a conditional request
+    :param on_attempt: called with (seconds, exception or None) of each request sent, the seconds
+        do not include waits for the rate limiter and retry delays
+    :return: `http_client.Downloaded` (size, SHA-256 and validators, or `not_modified`), None if failed
     '''
-    data = None
-    # retry if the exception is ConnectionError or URLError
-    for i in range(max_try):
+    if client is None:
+        client = default_client()
+    if retry_policy is None:
+        retry_policy = default_retry_policy()
+    deadline = time.monotonic() + max_seconds if max_seconds is not None else None
+
+    def request():
+        if rate_limiter is not None:
+            rate_limiter.acquire(url)
+        start = time.perf_counter()
         try:
-            data = urllib.request.urlopen(query, timeout=15).read()
-            break
-        except HTTPError as e:
-            print('HTTPError')
-            # must be caught before URLError because HTTPError is
-            # sub class of URLError.
-            print_erro_with_trace(e)
-            break
-        except (ConnectionError, URLError) as e:
-            print('ConnectionError, URLError')
-            print_erro_with_trace(e)
+            result = stream_to_file(
+                client, url, dest_path, headers=headers, timeout=timeout,
+                max_bytes=max_bytes, deadline=deadline, metrics=metrics, etag=etag, last_modified=last_modified)
         except Exception as e:
-            print('Exception')
+            if on_attempt is not None:
+                on_attempt(time.perf_counter() - start, e)
+            raise
+        if on_attempt is not None:
+            on_attempt(time.perf_counter() - start, None)
+        return result
+
+    downloaded = None
+    with stage(metrics, 'download', url=url) as event:
+        try:
+            downloaded = retry_policy.call(url, request, max_try=max_try, on_error=retry_error_handler(metrics))
+        except CircuitOpen as e:
             print_erro_with_trace(e)
-            break
+        except Exception:
+            # already printed by print_retry_error
+            pass
+        event['ok'] = downloaded is not None
+        if downloaded is not None:
+            event['bytes'] = downloaded.size
+    if metrics is not None:
+        if downloaded is not None and downloaded.not_modified:
+            metrics.count('images_not_modified')
+        elif downloaded is not None:
+            metrics.count('images_downloaded')
+            metrics.count('bytes_downloaded', downloaded.size)
+        else:
+            metrics.count('images_failed')
+    return downloaded
+
+def image_path(dest_dir_path, index):
+    return os.path.join(dest_dir_path, image_file_name(index))
+
+def download_and_save(index, url, dest_dir_path, req_headers, content_index: ContentIndex=None, url_db: UrlDB=None,
+        metrics: Metrics=None, concurrency: AdaptiveConcurrency=None, budgets: List[Budget]=None,
+        previous: Dict=None, cancel=None, **kwargs):
+    '''download one image and save it as "[index].jpg"
+    :param index: 1-origin index of the image in the search result
+    :param url: image url
+    :param dest_dir_path: directory to save the image
+    :param req_headers: request headers
+    :param content_index: index to detect duplicates of images already downloaded, no check if None
+    :param url_db: database of urls of all the runs to skip dead urls and reuse saved images, not used if None
+    :param metrics: records the time of the download and counts of skipped, reused and duplicate images,
+        not recorded if None
+    :param concurrency: adaptive limit of downloads in flight shared by all the queries, no limit if None
+    :param budgets: time and byte budgets of the query and the run, no download once one is exhausted
+    :param previous: row of the saved image to refresh. The url is requested with its ETag and
+        Last-Modified, and the file is kept as it is if the server answers 304 Not Modified
+        or the request fails.
+    :param cancel: `threading.Event`, no download once it is set
+    :param kwargs: passed to `download_img_with_retry`
+    :return: row of the url manifest
+    '''
+    my_print('-> Downloading image' if previous is None else '-> Refreshing image', str(index).zfill(4))
 
-        my_print('retry in 30 sec...')
-        time.sleep(30) # may need some time to escape connection refusion next time
+    if previous is None:
+        dest_path = image_path(dest_dir_path, index)
+    else:
+        dest_path = os.path.join(dest_dir_path, row_file_name(previous))
+        kwargs.update(etag=previous.get('etag') or None, last_modified=previous.get('last_modified') or None)
+    class_name = os.path.basename(os.path.normpath(dest_dir_path))
+    # a refresh requests the url even if the url db knows it
+    record = url_db.lookup(url) if url_db is not None and previous is None else None
+    saved = url_db.saved_file(record) if url_db is not None else None
+    if url_db is not None and url_db.is_dead(record):
+        my_print('--> Skip url failed before', str(index).zfill(4))
+        url_db.add_class(url, class_name)
+        if metrics is not None:
+            metrics.count('urls_skipped_dead')
+        return {'No.': index, 'url': url, 'is_downloaded': 0}
+    elif saved is not None:
+        # downloaded by another query or run
+        if os.path.abspath(saved) != os.path.abspath(dest_path):
+            link_file(saved, dest_path)
+        my_print('--> Reuse', record['path'], str(index).zfill(4))
+        url_db.add_class(url, class_name)
+        if metrics is not None:
+            metrics.count('images_reused')
+        downloaded = Downloaded(record['size'], record['sha256'])
+    elif cancel is not None and cancel.is_set():
+        my_print('--> Skip, cancelled', str(index).zfill(4))
+        return previous if previous is not None else {'No.': index, 'url': url, 'is_downloaded': 0}
+    elif budgets and any(b.exhausted() for b in budgets):
+        # queued before the budget ran out, downloaded by the next run with --resume
+        my_print('--> Skip, budget exhausted', str(index).zfill(4))
+        return previous if previous is not None else {'No.': index, 'url': url, 'is_downloaded': 0}
+    else:
+        if budgets:
+            # no image outlives the deadlines of the query and the run
+            limits = [kwargs.get('max_seconds')] + [b.remaining_seconds() for b in budgets]
+            limits = [s for s in limits if s is not None]
+            kwargs['max_seconds'] = min(limits) if limits else None
+        downloaded = None
+        if concurrency is not None:
+            concurrency.acquire()
+            # only overload of the host reduces the limit, not dead urls or files that are not images
+            kwargs['on_attempt'] = lambda seconds, error: concurrency.record(
+                seconds, congested=error is not None and is_congestion(error))
+        try:
+            downloaded = download_img_with_retry(
+                url, dest_path, headers=req_headers, timeout=15, max_try=2, metrics=metrics, **kwargs)
+        finally:
+            if concurrency is not None:
+                concurrency.release()
+        if downloaded is not None:
+            for budget in budgets or []:
+                budget.add(downloaded.size)
+        if url_db is not None:
+            if downloaded is None:
+                url_db.record(url, class_name, status=FAILED)
+            else:
+                # sha256 and size of a 304 are None, the recorded ones are kept
+                url_db.record(url, class_name, sha256=downloaded.sha256,
+                              size=None if downloaded.not_modified else downloaded.size, path=dest_path)
+    if downloaded is None:
+        if previous is not None:
+            my_print('--> Could not refresh image, keep the saved one', str(index).zfill(4))
+            return previous
+        my_print('--> Could not download image with error', str(index).zfill(4))
+        return {'No.': index, 'url': url, 'is_downloaded': 0}
+    if downloaded.not_modified:
+        my_print('--> Not modified', str(index).zfill(4))
+        return dict(previous, etag=downloaded.etag or '', last_modified=downloaded.last_modified or '')
+
+    row = {'No.': index, 'url': url, 'is_downloaded': 1, 'sha256': downloaded.sha256,
+           'etag': downloaded.etag, 'last_modified': downloaded.last_modified,
+           'content_length': downloaded.content_length}
+    if previous is not None:
+        # written over the saved file, validated again if validation is on
+        row['file'] = row_file_name(previous)
+    if content_index is not None:
+        original = content_index.add(downloaded.sha256, dest_path)
+        if original is not None:
+            my_print('--> Duplicate of', original, str(index).zfill(4))
+            content_index.resolve(dest_path, original)
+            row['duplicate_of'] = original
+            if metrics is not None:
+                metrics.count('duplicates')
+    return row
+
+def download_jobs(jobs, dest_dir_path, req_headers, workers=1, queue_size=None, manifest: Manifest=None,
+        on_row=None, **kwargs):
+    '''download images with a bounded pool of worker threads
+    :param jobs: (index, url) of images, can be a generator still searching,
+        or (index, url, row of the saved image) to refresh it
+    :param dest_dir_path: directory to save the images
+    :param req_headers: request headers
+    :param workers: the no. of images downloaded at the same time
+    :param queue_size: max urls waiting for workers, 2 * `workers` by default
+    :param manifest: started manifest to append each row as soon as the download finishes
+    :param on_row: called with each row as soon as the download finishes
+    :param kwargs: passed to `download_img_with_retry`
+    :return: rows of the url manifest in the order of `jobs`
+    '''
+    def run(job):
+        index, url, *previous = job
+        row = download_and_save(index, url, dest_dir_path, req_headers, previous=previous[0] if previous else None, **kwargs)
+        if manifest is not None:
+            manifest.append(row)
+        if on_row is not None:
+            on_row(row)
+        return row
+
+    # each image is saved with its own index, so the file names and the
+    # log rows keep the original order even if the downloads finish in any order.
+    return run_pipeline(run, jobs, max_workers=workers, queue_size=queue_size)
+
+def download_all(urls, dest_dir_path, req_headers, **kwargs):
+    '''download images numbered from 1
+    :param urls: image urls, can be a generator still searching (see `Google.iter_search`)
+    :param kwargs: passed to `download_jobs`
+    :return: rows of the url manifest in the original order of `urls`
+    '''
+    return download_jobs(enumerate(urls, 1), dest_dir_path, req_headers, **kwargs)
+
+def resume_jobs(previous_rows, urls, maximum, dest_dir_path):
+    '''images to download to top up a class to `maximum` images
+    :param previous_rows: rows of the url manifest of the previous runs
+    :param urls: image urls of the search
+    :param maximum: the no. of images requested
+    :param dest_dir_path: directory of the images
+    :return: generator of (index, url). Failed urls of the previous runs keep
+        their index, and new urls are numbered after the last index.
+    '''
+    saved = set(
+        row['url'] for row in previous_rows
+        if row['is_downloaded'] and row.get('is_valid') != 0
+        and os.path.isfile(os.path.join(dest_dir_path, row_file_name(row))))
+    # duplicates and invalid images are not downloaded again even if they were not saved
+    downloaded = saved.union(
+        row['url'] for row in previous_rows
+        if row['is_downloaded'] and (row.get('duplicate_of') or row.get('is_valid') == 0))
+    need = maximum - len(saved)
+    if need <= 0:
+        return
+    known = set(row['url'] for row in previous_rows)
+    next_index = max([row['No.'] for row in previous_rows], default=0) + 1
+
+    # retry failed ones first
+    for row in previous_rows:
+        if row['url'] not in downloaded:
+            yield row['No.'], row['url']
+            need -= 1
+            if need <= 0:
+                return
+    for url in urls:
+        if url in known:
+            continue
+        known.add(url)
+        yield next_index, url
+        next_index += 1
+        need -= 1
+        if need <= 0:
+            return
+
+def refresh_jobs(previous_rows, dest_dir_path):
+    '''images saved by the previous runs, to request again with their validators
+    :param previous_rows: rows of the url manifest of the previous runs
+    :param dest_dir_path: directory of the images
+    :return: generator of (index, url, row)
+    '''
+    for row in previous_rows:
+        if (row['is_downloaded'] and row.get('is_valid') != 0 and not row.get('duplicate_of')
+                and os.path.isfile(os.path.join(dest_dir_path, row_file_name(row)))):
+            yield row['No.'], row['url'], row
+
+def num_downloaded(rows):
+    return sum(1 for row in rows if row['is_downloaded'] and row.get('is_valid') != 0)
+
+def collect(name: str, maximum: int, data_dir: str, dirname: str=None, workers: int=1,
+        rate_limiter: HostRateLimiter=None, client: PooledHttpClient=None,
+        max_bytes: int=None, max_seconds: float=None, retry_policy: RetryPolicy=None, extractor: Extractor=None,
+        search_cache: SearchCache=None, resume: bool=False, content_index: ContentIndex=None,
+        validate: bool=False, validate_workers: int=None, url_db: UrlDB=None, search_url: str=None,
+        metrics: Metrics=None, on_row=None, concurrency: AdaptiveConcurrency=None, run_budget: Budget=None,
+        query_seconds: float=None, query_bytes: int=None, refresh: bool=False,
+        normalize: NormalizeSettings=None, process_pool: ProcessPoolExecutor=None,
+        cancel=None, heartbeat=None) -> List[Dict]:
+    '''search and download images of a query
+    :param name: search query
+    :param maximum: the no. of images to download
+    :param data_dir: save dir
+    :param dirname: class directory name, `name` with "_" for spaces if None
+    :param workers: the no. of images downloaded at the same time
+    :param rate_limiter: per-host rate limiter shared by all the queries, no limit if None
+    :param client: pooled HTTP client shared by all the queries, the process default if None
+    :param max_bytes: give up images larger than this, no limit if None
+    :param max_seconds: give up images not received in this time, no limit if None
+    :param retry_policy: retry policy shared by all the queries, the process default if None
+    :param extractor: extractor of image urls from result pages, `get_extractor('auto')` if None
+    :param search_cache: cache of urls of result pages shared by all the queries, no cache if None
+    :param resume: continue from the url manifest of the previous run, skipping
+        downloaded images and retrying failed ones
+    :param content_index: index of image contents shared by all the queries to detect duplicates,
+        no check if None
+    :param validate: check downloaded images, rename them to their true format and
+        quarantine invalid ones (see validate_images.py)
+    :param validate_workers: the no. of processes to validate images, the no. of CPUs if None
+    :param url_db: database of urls shared by all the queries and runs, checked before downloading, not used if None
+    :param search_url: endpoint of image search, `GOOGLE_SEARCH_URL` if None
+    :param metrics: timings and counters shared by all the queries, exported and printed
+        at the end of each query, not recorded if None
+    :param on_row: called with each row of the url manifest as soon as the image is downloaded
+        or failed, in the download threads
+    :param concurrency: adaptive limit of downloads in flight shared by all the queries, `workers` threads if None
+    :param run_budget: time and byte budget shared by all the queries, no limit if None
+    :param query_seconds: stop searching and downloading after this time, no limit if None
+    :param query_bytes: stop searching and downloading after this no. of bytes are downloaded, no limit if None
+    :param refresh: request the images saved by the previous runs again with conditional requests
+        (If-None-Match, If-Modified-Since) instead of searching. Unchanged images (304) are not written.
+    :param normalize: resize and re-encode the images changed since the last run to "[save dir]/normalized/[class]"
+        in a process pool of `validate_workers` (see normalize_images.py), not normalized if None
+    :param process_pool: process pool shared by all the queries to validate and normalize images
+        (see `validate_images.process_pool`), a pool of `validate_workers` is started for each query if None
+    :param cancel: `threading.Event` to stop the query, e.g. set when its lease of the work queue was lost.
+        No more images are searched or downloaded once it is set.
+    :param heartbeat: called as the query makes progress (each url taken from the search results,
+        and every `HEARTBEAT_SECONDS` while the images are validated and normalized)
+    :return: rows of the url manifest of the class, one row per image in the order of the index
+    :raises BudgetExhausted: if a budget ran out before the query finished. The downloads in flight
+        finish and the manifest is written first, so `resume` continues from there.
+    :raises Cancelled: if `cancel` was set. The downloads in flight finish, and the manifest is
+        not rewritten because the query may have been taken over by another worker.
+    '''
+    if run_budget is not None and run_budget.exhausted() is not None:
+        my_print('Skip "{}", budget of the run exhausted: {}'.format(name, run_budget.exhausted()))
+        raise BudgetExhausted(run_budget.exhausted(), run=True)
+    budgets = [] if run_budget is None else [run_budget]
+    if query_seconds is not None or query_bytes is not None:
+        budgets.append(Budget(query_seconds, query_bytes))
+    if client is None:
+        client = default_client()
+    if retry_policy is None:
+        retry_policy = default_retry_policy()
+    google = Google(
+        rate_limiter=rate_limiter, client=client, retry_policy=retry_policy,
+        extractor=extractor, search_cache=search_cache, search_url=search_url, metrics=metrics)
+    req_headers = {"User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:47.0) Gecko/20100101 Firefox/47.0"}
 
-    return data
+    # Save location
+    dest_dir_path, urls_file = class_paths(data_dir, name, dirname)
+    os.makedirs(dest_dir_path, exist_ok=True)
+    os.makedirs(os.path.dirname(urls_file), exist_ok=True)
+
+    manifest = Manifest(urls_file)
+    previous_rows = manifest.read() if resume or refresh else []
+    if resume and not refresh:
+        my_print('Resume:', num_downloaded(previous_rows), 'images downloaded,',
+                 len(previous_rows) - num_downloaded(previous_rows), 'failed')
+
+    # Search and download images, downloads start as soon as
+    # the first result page is parsed.
+    query_start = time.perf_counter()
+    manifest.start(previous_rows)
+    try:
+        if refresh:
+            jobs = refresh_jobs(previous_rows, dest_dir_path)
+        elif resume:
+            # search more than `maximum` because downloaded ones are skipped
+            result = google.iter_search(name, maximum=maximum + len(previous_rows))
+            jobs = resume_jobs(previous_rows, result, maximum, dest_dir_path)
+        else:
+            jobs = enumerate(google.iter_search(name, maximum=maximum), 1)
+        stopped = []
+        if budgets or cancel is not None or heartbeat is not None:
+            def on_exhausted(reason):
+                my_print('-> Stop, budget exhausted:', reason)
+                stopped.append(reason)
+
+            jobs = within_budgets(jobs, budgets, on_exhausted=on_exhausted, cancel=cancel, on_next=heartbeat)
+        result_logs = download_jobs(
+            jobs, dest_dir_path, req_headers, workers=workers, manifest=manifest, on_row=on_row,
+            content_index=content_index, url_db=url_db, rate_limiter=rate_limiter, client=client,
+            max_bytes=max_bytes, max_seconds=max_seconds, retry_policy=retry_policy, metrics=metrics,
+            concurrency=concurrency, budgets=budgets, cancel=cancel)
+        # also when the searches finished but queued downloads were skipped
+        exhausted = stopped[0] if stopped else next(filter(None, (b.exhausted() for b in budgets)), None)
+    finally:
+        manifest.close()
+    if cancel is not None and cancel.is_set():
+        my_print('-> Cancel "{}", {} images downloaded'.format(name, sum(row['is_downloaded'] for row in result_logs)))
+        if url_db is not None:
+            url_db.flush()
+        raise Cancelled(name)
+    download_error = [row['No.'] for row in result_logs if not row['is_downloaded']]
+    duplicates = [row['No.'] for row in result_logs if row.get('duplicate_of')]
+
+    rows = merge_rows(previous_rows, result_logs)
+    # validation and normalization take no urls, tell the work queue that the query is not hung
+    with keep_alive(heartbeat, HEARTBEAT_SECONDS):
+        if validate:
+            quarantine_dir = os.path.join(data_dir, 'quarantine', os.path.basename(dest_dir_path))
+            with stage(metrics, 'validate', query=name, images=len(rows)):
+                validate_class(dest_dir_path, rows, quarantine_dir, workers=validate_workers, content_index=content_index,
+                               pool=process_pool)
+        invalid = [row['No.'] for row in result_logs if row.get('is_valid') == 0]
+        normalized = None
+        if normalize is not None:
+            with stage(metrics, 'normalize', query=name):
+                normalized = normalize_class(
+                    dest_dir_path, os.path.join(data_dir, 'normalized', os.path.basename(dest_dir_path)),
+                    normalize, workers=validate_workers, pool=process_pool)
+            if metrics is not None:
+                metrics.count('images_normalized', normalized.normalized)
+                metrics.count('normalize_bytes_saved', normalized.bytes_saved)
+    if url_db is not None:
+        if validate:
+            for row in result_logs:
+                if row.get('is_valid') == 0:
+                    url_db.record(row['url'], status=INVALID, attempted=False)
+                elif row.get('file') and row['file'] != image_file_name(row['No.']):
+                    url_db.record(row['url'], status=OK, path=os.path.join(dest_dir_path, row['file']), attempted=False)
+        url_db.flush()
+
+    # save logs, one row per image in the order of the index
+    manifest.finish(rows)
+
+    my_print('Complete download')
+    my_print('├─ Download', len(result_logs) - len(download_error), 'images')
+    my_print('├─ Duplicate', len(duplicates), 'images', duplicates)
+    if refresh:
+        previous_sha256 = {row['No.']: row.get('sha256') for row in previous_rows}
+        unchanged = [row['No.'] for row in result_logs if row.get('sha256') == previous_sha256.get(row['No.'])]
+        my_print('├─ Unchanged', len(unchanged), 'images')
+    if validate:
+        my_print('├─ Quarantine', len(invalid), 'invalid images', invalid)
+    if normalized is not None:
+        my_print('├─ Normalize', normalize_summary(normalized), normalized.failed)
+    my_print('└─ Could not download', len(
+        download_error), 'images', download_error)
+    my_print('Connections:', client.stats())
+    if concurrency is not None:
+        my_print('Concurrency:', concurrency.stats())
+    if metrics is not None:
+        metrics.observe('query', time.perf_counter() - query_start, query=name,
+                        downloaded=len(result_logs) - len(download_error), failed=len(download_error))
+        metrics.export()
+        my_print('Metrics (all the queries so far):\n' + metrics.summary())
+    if exhausted is not None:
+        raise BudgetExhausted(exhausted, rows, run=run_budget is not None and run_budget.exhausted() is not None)
+    return rows
 
 @queries_from_other_sources
-def main(args: List):
+def main(args: List, **kwargs):
     '''download images by google search
-    :param args: should be sys.argv
+    :param args: should be sys.argv, the class directory name can be appended as the 5th element
+    :param kwargs: passed to `collect`
 
     TODO: should use argparse to parse command line arguments.
     '''
-    google = Google()
-    req_headers = {"User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:47.0) Gecko/20100101 Firefox/47.0"}
     if len(args) < 4:
         my_print('Invalid argment')
         my_print(
             '> python3 ./image_collector_cui.py [target name] [download number] [save dir]')
         sys.exit()
-    else:
-        # Save location
-        name = args[1]
-        data_dir = args[3]
-        if len(args) > 4:
-            dest_dir_path = os.path.join(data_dir, 'images', args[4])
-            urls_dest_dir_path = os.path.join(data_dir, 'urls')
-            urls_file = os.path.join(urls_dest_dir_path, args[4] + '.csv')
-        else:
-            dest_dir_path = os.path.join(data_dir, 'images', name.replace(' ', '_'))
-            urls_dest_dir_path = os.path.join(data_dir, 'urls')
-            urls_file = os.path.join(urls_dest_dir_path, name.replace(' ', '_') + '.csv')
-        os.makedirs(dest_dir_path, exist_ok=True)
-        os.makedirs(urls_dest_dir_path, exist_ok=True)
-
-        # Search image
-        result = google.search(
-            name, maximum=int(args[2]))
-        result_logs = []
-
-        # Download
-        download_error = []
-        for i in range(len(result)):
-            my_print('-> Downloading image', str(i + 1).zfill(4))
-
-            query = urllib.request.Request(url=result[i], headers=req_headers)
-            image_data = download_img_with_retry(query, timeout=15, max_try=2)
-            if image_data is None:
-                my_print('--> Could not download image with error', str(i + 1).zfill(4))
-                download_error.append(i + 1)
-                downloaded = 0
-            else:
-                with open(os.path.join(dest_dir_path, str(i + 1).zfill(4) + '.jpg'), "wb") as f:
-                    f.write(image_data)
-                downloaded = 1
-
-            result_logs.append((i+1, result[i], downloaded))
-
-        # save logs
-        with open(urls_file, 'w') as f:
-            writer = csv.writer(f, lineterminator='\n')
-            writer.writerow(['No.', 'url', 'is_downloaded'])
-            writer.writerows(result_logs)
-
-        my_print('Complete download')
-        my_print('├─ Download', len(result) - len(download_error), 'images')
-        my_print('└─ Could not download', len(
-            download_error), 'images', download_error)
+    collect(args[1], int(args[2]), args[3], args[4] if len(args) > 4 else None, **kwargs)
+
+def class_paths(data_dir, name=None, dirname=None):
+    '''paths of a class
+    :param data_dir: save dir
+    :param name: query, used if `dirname` is None
+    :param dirname: class directory name
+    :return: (image directory, url manifest file)
+    '''
+    if dirname is None:
+        dirname = name.replace(' ', '_')
+    return os.path.join(data_dir, 'images', dirname), os.path.join(data_dir, 'urls', dirname + '.csv')
 
 
 if __name__ == '__main__':
-    main(sys.argv)
+    import argparse
+    psr = argparse.ArgumentParser()
+    psr.add_argument('target', help='search query, text file of queries, or glob of directories')
+    psr.add_argument('number', help='the no. of images to download for each query')
+    psr.add_argument('save_dir', help='directory to save images and urls')
+    psr.add_argument('-w', '--workers', help='the no. of images downloaded at the same time', type=int, default=1)
+    psr.add_argument('-q', '--query-workers', help='the no. of queries run at the same time', type=int, default=1)
+    psr.add_argument('--host-rate', help='max requests per second to each host, no limit by default', type=float, default=None)
+    psr.add_argument('--host-burst', help='max burst of requests to each host, at least 1', type=float, default=None)
+    psr.add_argument('--search-rate', help='max requests per second to the search host (with --host-rate)', type=float, default=1.0)
+    psr.add_argument('--pool-size', help='max connections kept alive for each host', type=int, default=None)
+    psr.add_argument('--max-bytes', help='give up images larger than this', type=int, default=20 * 1024 * 1024)
+    psr.add_argument('--max-seconds', help='give up images not received in this time', type=float, default=120)
+    psr.add_argument('--retry-base-delay', help='delay before the first retry, doubled for each retry', type=float, default=1.0)
+    psr.add_argument('--retry-max-delay', help='max delay before a retry', type=float, default=30.0)
+    psr.add_argument('--breaker-threshold', help='consecutive errors to stop requesting a host for a while', type=int, default=5)
+    psr.add_argument('--breaker-reset', help='seconds to stop requesting a host that keeps erroring', type=float, default=60.0)
+    psr.add_argument('--extractor', help='parser of result pages', choices=['auto', 'scan', 'lxml', 'soup'], default='auto')
+    psr.add_argument('--resume', help='skip images downloaded by the previous run, and retry failed ones', action='store_true')
+    psr.add_argument('--refresh', help='request images saved by the previous runs again with their ETag and Last-Modified, '
+                     'unchanged ones are not downloaded', action='store_true')
+    psr.add_argument('--dedup', help='what to do with images of the same content as downloaded ones',
+                     choices=['off', 'report', 'skip', 'hardlink'], default='report')
+    psr.add_argument('--no-validate', help='keep downloaded files as they are without checking them', action='store_true')
+    psr.add_argument('--validate-workers', help='the no. of processes to validate images, the no. of CPUs by default', type=int, default=None)
+    psr.add_argument('--normalize', help='resize and re-encode images to [save dir]/normalized after downloading', action='store_true')
+    psr.add_argument('--max-edge', help='longest edge of normalized images, 0 not to resize (--normalize)', type=int, default=1024)
+    psr.add_argument('--normalize-format', help='format of normalized images (--normalize)',
+                     choices=['JPEG', 'PNG', 'WEBP'], default='JPEG')
+    psr.add_argument('--normalize-quality', help='quality of normalized JPEG and WebP images (--normalize)', type=int, default=90)
+    psr.add_argument('--no-url-db', help='do not use the database of urls of all the runs, [save dir]/urls.sqlite3', action='store_true')
+    psr.add_argument('--dead-after', help='skip urls failed this no. of times in a row (url db)', type=int, default=3)
+    psr.add_argument('--search-url', help='endpoint of image search', default=GOOGLE_SEARCH_URL)
+    psr.add_argument('--no-search-cache', help='always search instead of reading urls from the cache', action='store_true')
+    psr.add_argument('--search-cache-dir', help='directory of the cache of search results', default=DEFAULT_CACHE_DIR)
+    psr.add_argument('--search-cache-ttl', help='seconds search results are cached', type=float, default=7 * 24 * 3600)
+    psr.add_argument('--search-cache-size', help='max no. of result pages cached', type=int, default=100000)
+    psr.add_argument('--no-metrics', help='do not write [save dir]/metrics/events.jsonl and metrics.prom', action='store_true')
+    psr.add_argument('--adaptive', help='adjust downloads in flight between --min-workers and workers x query workers '
+                     'from latency and errors (AIMD)', action='store_true')
+    psr.add_argument('--min-workers', help='min downloads in flight (--adaptive)', type=int, default=1)
+    psr.add_argument('--run-seconds', help='stop the run after this time, writing the manifests', type=float, default=None)
+    psr.add_argument('--run-bytes', help='stop the run after this no. of bytes are downloaded', type=int, default=None)
+    psr.add_argument('--query-seconds', help='stop each query after this time', type=float, default=None)
+    psr.add_argument('--query-bytes', help='stop each query after this no. of bytes are downloaded', type=int, default=None)
+    psr.add_argument('--queue', help='queue file shared by processes collecting the same queries, e.g. [save dir]/queue.sqlite3', default=None)
+    psr.add_argument('--lease-seconds', help='a query of a stopped or hung process is run by another one after this time (--queue)',
+                     type=float, default=600)
+    psr.add_argument('--max-attempts', help='give up a query failed this no. of times (--queue)', type=int, default=3)
+    psr.add_argument('--profile', help='write cProfile stats and a tracemalloc snapshot to [save dir]/profile', action='store_true')
+    a = psr.parse_args()
+    profiler = Profiler(os.path.join(a.save_dir, 'profile')).start() if a.profile else None
+    from collector import Collector, CollectorConfig
+    collector = Collector(CollectorConfig(
+        a.save_dir, workers=a.workers, query_workers=a.query_workers,
+        host_rate=a.host_rate, host_burst=a.host_burst, search_rate=a.search_rate, pool_size=a.pool_size,
+        max_bytes=a.max_bytes, max_seconds=a.max_seconds,
+        retry_base_delay=a.retry_base_delay, retry_max_delay=a.retry_max_delay,
+        breaker_threshold=a.breaker_threshold, breaker_reset=a.breaker_reset,
+        extractor=a.extractor, dedup=a.dedup, validate=not a.no_validate, validate_workers=a.validate_workers,
+        url_db=not a.no_url_db, dead_after=a.dead_after, search_url=a.search_url,
+        search_cache=not a.no_search_cache, search_cache_dir=a.search_cache_dir,
+        search_cache_ttl=a.search_cache_ttl, search_cache_size=a.search_cache_size, metrics=not a.no_metrics,
+        adaptive=a.adaptive, min_workers=a.min_workers, run_seconds=a.run_seconds, run_bytes=a.run_bytes,
+        query_seconds=a.query_seconds, query_bytes=a.query_bytes, normalize=a.normalize, max_edge=a.max_edge,
+        normalize_format=a.normalize_format, normalize_quality=a.normalize_quality))
+    work_queue = None
+    if a.queue is not None:
+        work_queue = WorkQueue(a.queue, lease_seconds=a.lease_seconds, max_attempts=a.max_attempts)
+    try:
+        main([sys.argv[0], a.target, a.number, a.save_dir],
+             query_workers=a.query_workers, resume=a.resume, refresh=a.refresh, work_queue=work_queue,
+             **collector.main_kwargs())
+    finally:
+        # profiles of interrupted runs are written too
+        if profiler is not None:
+            profiler.stop()
+    collector.close()
+    if work_queue is not None:
+        work_queue.close()
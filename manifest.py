@@ -0,0 +1,109 @@
+'''
+Url manifest of a class, "[save dir]/urls/[class].csv".
+
+Rows are appended and flushed as each download finishes, so the
+bookkeeping survives a crash and `--resume` can continue from it.
+When the query is complete, the file is rewritten with one row per
+image in the order of "No.".
+'''
+
+import csv
+import os
+import threading
+from typing import Dict, Iterable, List, Text
+
+FIELDS = ['No.', 'url', 'is_downloaded', 'sha256', 'duplicate_of', 'file', 'format', 'width', 'height', 'is_valid',
+          'etag', 'last_modified', 'content_length']
+# columns every row has, manifests of older versions have only these
+REQUIRED_FIELDS = ['No.', 'url', 'is_downloaded']
+# columns read as int
+INT_FIELDS = ['No.', 'is_downloaded', 'width', 'height', 'is_valid', 'content_length']
+
+def image_file_name(index: int, ext: Text='.jpg') -> Text:
+    '''file name of the [index]-th image of a class, e.g. "0001.jpg"
+    '''
+    return str(index).zfill(4) + ext
+
+def row_file_name(row: Dict) -> Text:
+    '''file name of the image of a manifest row, renamed by validate_images.py or "[No.].jpg"
+    '''
+    return row.get('file') or image_file_name(row['No.'])
+
+class Manifest:
+    def __init__(self, path: Text, fields: List[Text]=FIELDS):
+        '''
+        :param path: csv file path
+        :param fields: column names
+        '''
+        self.path = path
+        self.fields = fields
+        self.lock = threading.Lock()
+        self.file = None
+        self.writer = None
+
+    def read(self) -> List[Dict]:
+        '''read rows, the last row is used if there are rows of the same "No."
+        :return: rows sorted by "No.", [] if the file does not exist
+        '''
+        if not os.path.isfile(self.path):
+            return []
+        rows = {}
+        with open(self.path, 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                if any(row.get(field) in (None, '') for field in REQUIRED_FIELDS):
+                    # broken line written at a crash
+                    continue
+                try:
+                    for field in INT_FIELDS:
+                        if row.get(field) not in (None, ''):
+                            row[field] = int(row[field])
+                except ValueError:
+                    continue
+                rows[row['No.']] = row
+        return [rows[k] for k in sorted(rows)]
+
+    def start(self, rows: Iterable[Dict]=()):
+        '''rewrite the file with `rows` and open it to append rows
+        '''
+        self.write(rows)
+        self.file = open(self.path, 'a', newline='')
+        self.writer = csv.DictWriter(self.file, self.fields, extrasaction='ignore', lineterminator='\n')
+
+    def append(self, row: Dict):
+        '''append a row and flush it (thread-safe)
+        '''
+        with self.lock:
+            self.writer.writerow(row)
+            self.file.flush()
+
+    def finish(self, rows: Iterable[Dict]):
+        '''close and rewrite the file with `rows` sorted by "No."
+        '''
+        self.close()
+        self.write(sorted(rows, key=lambda row: row['No.']))
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+                self.writer = None
+
+    def write(self, rows: Iterable[Dict]):
+        '''write header and rows to a temporary file and rename it to the manifest
+        '''
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, self.fields, extrasaction='ignore', lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(tmp_path, self.path)
+
+def merge_rows(*row_lists: Iterable[Dict]) -> List[Dict]:
+    '''merge rows by "No.", rows of later lists overwrite earlier ones
+    '''
+    rows = {}
+    for row_list in row_lists:
+        for row in row_list:
+            rows[row['No.']] = row
+    return [rows[k] for k in sorted(rows)]
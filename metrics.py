@@ -0,0 +1,262 @@
+'''
+Timing and counters of each stage of the collection
+
+Stages timed by image_collector_cui.py:
+  search_request: request of a result page including retries (`Google.request_with_retry`)
+  parse: extraction of image urls from a result page
+  download: download of an image including retries (`download_img_with_retry`)
+  write: writes of the body to the file and the rename (`http_client.stream_to_file`)
+  validate: validation of the images of a class (validate_images.py)
+  query: a whole query
+
+Each timing is appended to a JSON-lines file as an event, e.g.
+  {"time": 1700000000.1, "stage": "download", "seconds": 0.31, "ok": true, "bytes": 51234}
+and aggregated per stage into a histogram. At the end of each query the
+aggregates are written in the Prometheus text format (for the textfile
+collector of node_exporter) and printed as a summary.
+
+`Profiler` writes cProfile stats of all the threads and a tracemalloc snapshot.
+'''
+
+from collections import OrderedDict
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Text
+
+# upper bounds (seconds) of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+class StageStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, seconds: float, ok: bool):
+        self.count += 1
+        if not ok:
+            self.errors += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+class Metrics:
+    '''thread-safe timings and counters shared by all the queries
+
+    >>> metrics = Metrics('events.jsonl', 'metrics.prom')
+    >>> with metrics.stage('download', url=url) as event:
+    ...     downloaded = download()
+    ...     event['ok'] = downloaded is not None
+    >>> metrics.count('bytes_downloaded', downloaded.size)
+    >>> metrics.export()
+    '''
+    def __init__(self, events_path: Optional[Text]=None, prometheus_path: Optional[Text]=None,
+                 prefix: Text='image_collector', buffer_size: int=1000):
+        '''
+        :param events_path: JSON-lines file events are appended to, no events if None
+        :param prometheus_path: file written by `export`, not written if None
+        :param prefix: prefix of the Prometheus metric names
+        :param buffer_size: the no. of events written at once
+        '''
+        self.events_path = events_path
+        self.prometheus_path = prometheus_path
+        self.prefix = prefix
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        # queries running at once export at the end of each, the last snapshot taken is written last
+        self.export_lock = threading.Lock()
+        self.stages: Dict[Text, StageStats] = OrderedDict()
+        self.counters: Dict[Text, float] = OrderedDict()
+        self.events: List[Text] = []
+        for path in (events_path, prometheus_path):
+            if path is not None and os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    @contextlib.contextmanager
+    def stage(self, name: Text, **labels):
+        '''time the block as stage `name`
+
+        The yielded dict is the event: set `event['ok'] = False` if the stage
+        failed without an exception, and add fields to log (e.g. bytes).
+        An exception raised in the block counts as an error.
+        '''
+        event = dict(labels)
+        start = time.perf_counter()
+        try:
+            yield event
+        except BaseException:
+            event['ok'] = False
+            raise
+        finally:
+            ok = event.pop('ok', True)
+            self.observe(name, time.perf_counter() - start, ok=ok, **event)
+
+    def observe(self, name: Text, seconds: float, ok: bool=True, **labels):
+        '''record a timing of stage `name` measured by the caller
+        '''
+        with self.lock:
+            self.stages.setdefault(name, StageStats()).observe(seconds, ok)
+            if self.events_path is not None:
+                event = {'time': round(time.time(), 3), 'stage': name, 'seconds': round(seconds, 6), 'ok': ok}
+                event.update(labels)
+                self.events.append(json.dumps(event, ensure_ascii=False))
+                if len(self.events) >= self.buffer_size:
+                    self._flush()
+
+    def count(self, name: Text, value: float=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.events:
+            return
+        with open(self.events_path, 'a', encoding='utf-8') as f:
+            f.write('\n'.join(self.events) + '\n')
+        self.events = []
+
+    def snapshot(self) -> Dict:
+        '''
+        :return: {'stages': {name: {count, errors, sum, max, buckets}}, 'counters': {name: value}}
+        '''
+        with self.lock:
+            return {
+                'stages': OrderedDict(
+                    (name, {'count': s.count, 'errors': s.errors, 'sum': s.sum, 'max': s.max, 'buckets': list(s.buckets)})
+                    for name, s in self.stages.items()),
+                'counters': OrderedDict(self.counters),
+                }
+
+    def prometheus(self) -> Text:
+        '''aggregates in the Prometheus text exposition format
+        '''
+        snapshot = self.snapshot()
+        name = self.prefix + '_stage_seconds'
+        lines = [
+            '# HELP {} time spent in each stage'.format(name),
+            '# TYPE {} histogram'.format(name),
+            ]
+        for stage, s in snapshot['stages'].items():
+            total = 0
+            for bound, n in zip(BUCKETS + ('+Inf',), s['buckets']):
+                total += n
+                lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(name, stage, bound, total))
+            lines.append('{}_sum{{stage="{}"}} {}'.format(name, stage, s['sum']))
+            lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, s['count']))
+        errors = self.prefix + '_stage_errors_total'
+        lines += ['# HELP {} failed runs of each stage'.format(errors), '# TYPE {} counter'.format(errors)]
+        lines += ['{}{{stage="{}"}} {}'.format(errors, stage, s['errors']) for stage, s in snapshot['stages'].items()]
+        for counter, value in snapshot['counters'].items():
+            lines.append('# TYPE {}_{}_total counter'.format(self.prefix, counter))
+            lines.append('{}_{}_total {}'.format(self.prefix, counter, value))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: Text):
+        # written to a temporary file and renamed, the textfile collector never reads a partial file.
+        # the file name is unique, so other writers (threads, processes sharing the save dir) do not collide.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.' + os.path.basename(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.prometheus())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def export(self):
+        '''write the buffered events and the Prometheus textfile, can be called by several threads at once
+        '''
+        with self.export_lock:
+            if self.events_path is not None:
+                self.flush()
+            if self.prometheus_path is not None:
+                self.write_prometheus(self.prometheus_path)
+
+    def summary(self) -> Text:
+        '''table of the stages and the counters
+        '''
+        snapshot = self.snapshot()
+        lines = ['{:<16}{:>8}{:>8}{:>11}{:>10}{:>10}'.format('stage', 'count', 'errors', 'total s', 'mean ms', 'max ms')]
+        for stage, s in snapshot['stages'].items():
+            lines.append('{:<16}{:>8}{:>8}{:>11.2f}{:>10.1f}{:>10.1f}'.format(
+                stage, s['count'], s['errors'], s['sum'], s['sum'] / s['count'] * 1000 if s['count'] else 0.0, s['max'] * 1000))
+        for counter, value in snapshot['counters'].items():
+            lines.append('{:<24}{:>,}'.format(counter, value))
+        return '\n'.join(lines)
+
+def stage(metrics: Optional[Metrics], name: Text, **labels):
+    '''`metrics.stage(name, **labels)`, or a block recording nothing if `metrics` is None
+    '''
+    return metrics.stage(name, **labels) if metrics is not None else contextlib.nullcontext({})
+
+class Profiler:
+    '''cProfile of all the threads and tracemalloc snapshot of a run
+
+    > python3 -m pstats [dest dir]/cprofile.pstats
+    '''
+    def __init__(self, dest_dir: Text, frames: int=10):
+        '''
+        :param dest_dir: directory of cprofile.pstats, tracemalloc.snapshot and tracemalloc_top.txt
+        :param frames: frames of the traceback stored for each allocation
+        '''
+        self.dest_dir = dest_dir
+        self.frames = frames
+        self.profiles: List = []
+        self.lock = threading.Lock()
+
+    def _start_thread(self, *args):
+        # called once in each new thread, replaced by the profiler of the thread
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+: one profiler already sees all the threads
+            return
+        with self.lock:
+            self.profiles.append(profile)
+
+    def start(self):
+        import tracemalloc
+        tracemalloc.start(self.frames)
+        threading.setprofile(self._start_thread)
+        self._start_thread()
+        return self
+
+    def stop(self):
+        import pstats
+        import tracemalloc
+        threading.setprofile(None)
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        with self.lock:
+            profiles = list(self.profiles)
+        for profile in profiles:
+            profile.disable()
+        os.makedirs(self.dest_dir, exist_ok=True)
+        stats = pstats.Stats(*profiles)
+        stats.dump_stats(os.path.join(self.dest_dir, 'cprofile.pstats'))
+        snapshot.dump(os.path.join(self.dest_dir, 'tracemalloc.snapshot'))
+        with open(os.path.join(self.dest_dir, 'tracemalloc_top.txt'), 'w') as f:
+            for stat in snapshot.statistics('lineno')[:50]:
+                f.write(str(stat) + '\n')
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
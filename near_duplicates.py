@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+'''
+Find near-duplicate images (resized or re-encoded copies) in a dataset
+
+- perceptual hash (dHash or pHash, 64 bits) of every image, computed in a process pool
+- hashes are stored as a bit-packed NumPy array (one uint64 per image)
+- pairs within a Hamming distance are found by multi-index hashing:
+  the hash is split into (threshold + 1) bands, and pairs within the
+  distance share at least one band exactly (pigeonhole principle).
+  Only pairs sharing a band are compared, with vectorized popcount.
+
+Requires numpy and Pillow.
+
+Which data can be dealt with?
+- same as stats.py, each class has one directory including all samples
+[dataset top dir to be passed as the argument]
+  |
+  |--[class 1 dir]
+  |    |--[img file]
+  |    |--...
+  |--[class 2 dir]
+  |--...
+
+Output
+  hashes.npy: uint64 hashes in the order of paths.txt
+  paths.txt: image paths relative to the dataset dir
+  pairs.csv: near-duplicate pairs and their distances
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import os
+from typing import List, Optional, Text, Tuple
+
+import numpy as np
+
+from dataset_index import scan_dataset
+
+def bits_to_int(bits: np.ndarray) -> int:
+    '''64 booleans to an int, the first is the most significant bit
+    '''
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), 'big')
+
+def dhash(path: Text, size: int=8) -> int:
+    '''difference hash: whether each pixel is brighter than its right neighbor
+    '''
+    from PIL import Image
+    with Image.open(path) as img:
+        img.draft('L', (size * 4, size * 4)) # faster JPEG decoding at low resolution
+        pixels = np.asarray(img.convert('L').resize((size + 1, size), Image.BILINEAR), dtype=np.int16)
+    return bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+def dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    return np.cos(np.pi * (2 * x + 1) * k / (2 * n))
+
+DCT_32 = dct_matrix(32)
+
+def phash(path: Text, size: int=8) -> int:
+    '''perceptual hash: whether each low frequency DCT coefficient is above their median
+    '''
+    from PIL import Image
+    with Image.open(path) as img:
+        img.draft('L', (128, 128))
+        pixels = np.asarray(img.convert('L').resize((32, 32), Image.BILINEAR), dtype=np.float64)
+    dct = DCT_32 @ pixels @ DCT_32.T
+    low = dct[:size, :size]
+    return bits_to_int(low > np.median(low))
+
+HASHES = {'dhash': dhash, 'phash': phash}
+
+def _hash_or_none(args: Tuple[Text, Text]) -> Optional[int]:
+    method, path = args
+    try:
+        return HASHES[method](path)
+    except Exception:
+        # broken or not an image
+        return None
+
+def compute_hashes(paths: List[Text], method: Text='dhash', workers: Optional[int]=None) -> Tuple[np.ndarray, np.ndarray]:
+    '''hash images in a process pool
+    :param paths: image paths
+    :param method: "dhash" or "phash"
+    :param workers: the no. of processes, the no. of CPUs if None
+    :return: (uint64 hashes, bool mask of images that could be hashed)
+    '''
+    if method not in HASHES:
+        raise RuntimeError('invalid hash method, "{}". {} are supported.'.format(method, list(HASHES)))
+    hashes = np.zeros(len(paths), dtype=np.uint64)
+    valid = np.zeros(len(paths), dtype=bool)
+    jobs = [(method, p) for p in paths]
+    if workers == 1:
+        results = map(_hash_or_none, jobs)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(_hash_or_none, jobs, chunksize=256)
+    try:
+        for i, h in enumerate(results):
+            if h is not None:
+                hashes[i] = h
+                valid[i] = True
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return hashes, valid
+
+# popcount of each byte value, for numpy without bitwise_count
+_POPCOUNT_8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def popcount(x: np.ndarray) -> np.ndarray:
+    '''no. of set bits of each uint64
+    '''
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x).astype(np.int64)
+    return _POPCOUNT_8[x.view(np.uint8)].reshape(-1, 8).sum(axis=1).astype(np.int64)
+
+def hamming(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return popcount(np.bitwise_xor(a, b))
+
+def band_masks(num_bands: int, bits: int=64) -> List[Tuple[int, int]]:
+    '''(shift, mask) of each band to split hashes into `num_bands` bands
+    '''
+    num_bands = min(num_bands, bits)
+    bounds = np.linspace(0, bits, num_bands + 1).astype(int)
+    return [(int(lo), (1 << int(hi - lo)) - 1) for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+def find_pairs(hashes: np.ndarray, threshold: int=4) -> np.ndarray:
+    '''find pairs of hashes within `threshold` Hamming distance
+    :param hashes: uint64 hashes
+    :param threshold: max Hamming distance
+    :return: int64 array of shape (n pairs, 3), (i, j, distance) with i < j, sorted
+    '''
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    n = len(hashes)
+    candidates = []
+    for shift, mask in band_masks(threshold + 1):
+        keys = (hashes >> np.uint64(shift)) & np.uint64(mask)
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        # compare each element with the k-th next one while they are in the same bucket
+        active = np.arange(n - 1)
+        k = 1
+        while len(active):
+            active = active[active + k < n]
+            active = active[sorted_keys[active] == sorted_keys[active + k]]
+            if not len(active):
+                break
+            i = order[active]
+            j = order[active + k]
+            near = hamming(hashes[i], hashes[j]) <= threshold
+            candidates.append(np.stack([np.minimum(i, j)[near], np.maximum(i, j)[near]], axis=1))
+            k += 1
+
+    if not candidates:
+        return np.zeros((0, 3), dtype=np.int64)
+    pairs = np.unique(np.concatenate(candidates).astype(np.int64), axis=0)
+    if not len(pairs):
+        return np.zeros((0, 3), dtype=np.int64)
+    distances = hamming(hashes[pairs[:, 0]], hashes[pairs[:, 1]])
+    return np.concatenate([pairs, distances[:, None]], axis=1)
+
+def main(
+        dataset_dir: Text,
+        dest_dir: Text='near_duplicates',
+        method: Text='dhash',
+        threshold: int=4,
+        workers: Optional[int]=None
+        ):
+    '''find near-duplicate images
+    :param dataset_dir: dataset directory
+    :param dest_dir: output directory
+    :param method: "dhash" or "phash"
+    :param threshold: max Hamming distance of near duplicates
+    :param workers: the no. of processes to hash images
+    '''
+    # validate args
+    if not os.path.isdir(dataset_dir):
+        raise RuntimeError('invalid dataset dirctory path, "{}", is not dir or does not exist'.format(dataset_dir))
+    os.makedirs(dest_dir, exist_ok=True)
+
+    paths = [os.path.join(dataset_dir, class_name, f)
+             for class_name, files in scan_dataset(dataset_dir).items() for f in files]
+    print('hashing {:,} images...'.format(len(paths)))
+    hashes, valid = compute_hashes(paths, method=method, workers=workers)
+    print('could not hash {:,} images'.format(int((~valid).sum())))
+
+    rel_paths = [os.path.relpath(p, dataset_dir) for p, v in zip(paths, valid) if v]
+    hashes = hashes[valid]
+    np.save(os.path.join(dest_dir, 'hashes.npy'), hashes)
+    with open(os.path.join(dest_dir, 'paths.txt'), 'w') as f:
+        f.writelines(p + '\n' for p in rel_paths)
+
+    pairs = find_pairs(hashes, threshold=threshold)
+    with open(os.path.join(dest_dir, 'pairs.csv'), 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['path_a', 'path_b', 'distance'])
+        writer.writerows((rel_paths[i], rel_paths[j], d) for i, j, d in pairs)
+    print('found {:,} near-duplicate pairs'.format(len(pairs)))
+    return pairs
+
+
+if __name__ == '__main__':
+    import argparse
+    psr = argparse.ArgumentParser()
+    psr.add_argument('data', help='dataset directory')
+    psr.add_argument('-o', '--out', help='output directory', required=False, default='near_duplicates')
+    psr.add_argument('-m', '--method', help='perceptual hash', choices=list(HASHES), default='dhash')
+    psr.add_argument('-t', '--threshold', help='max Hamming distance of near duplicates', type=int, default=4)
+    psr.add_argument('-w', '--workers', help='the no. of processes, the no. of CPUs by default', type=int, default=None)
+    a = psr.parse_args()
+    main(a.data, dest_dir=a.out, method=a.method, threshold=a.threshold, workers=a.workers)
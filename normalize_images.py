@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+'''
+Resize and re-encode collected images to a uniform format
+
+Scraped images range from thumbnails to huge originals, and decoding large
+JPEGs every epoch slows training. This stage writes a copy of each image
+- shrunk to fit `max_edge` x `max_edge` (smaller images are not enlarged)
+- rotated by its EXIF orientation
+- re-encoded to one format and quality (JPEG by default, alpha composited on white)
+to "[save dir]/normalized/[class]/", so the originals, their manifests and
+hashes are kept as they are. A JPEG is decoded at a reduced scale when the
+result is smaller (`Image.draft`), which is much faster than a full decode.
+
+Files are normalized in a process pool. The size, mtime and settings of
+each source are saved in "[class dir]/.normalize_index.csv" of the output,
+so unchanged files are skipped by the next run, and outputs of removed
+sources are removed.
+
+It runs after the downloads (and validation) of each query in
+image_collector_cui.py (--normalize), or over an images directory:
+
+> python3 normalize_images.py [save dir]/images [save dir]/normalized --max-edge 512
+
+This needs Pillow.
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import itertools
+import os
+from typing import Dict, List, NamedTuple, Optional, Text
+
+from dataset_index import list_images
+from validate_images import EXTENSIONS, process_pool
+
+INDEX_FILE = '.normalize_index.csv'
+FIELDS = ['file', 'size', 'mtime_ns', 'settings', 'output', 'output_size']
+
+class Settings(NamedTuple):
+    # longest edge of outputs, not resized if None
+    max_edge: Optional[int] = 1024
+    format: Text = 'JPEG'
+    quality: int = 90
+
+    def key(self) -> Text:
+        '''string saved in the index, outputs of other settings are normalized again
+        '''
+        return '{}:{}:{}'.format(self.format, self.quality, self.max_edge or '')
+
+def output_name(file_name: Text, settings: Settings) -> Text:
+    return os.path.splitext(file_name)[0] + EXTENSIONS[settings.format]
+
+def normalize_file(src: Text, dest: Text, settings: Settings) -> Dict:
+    '''
+    :param src: image file path
+    :param dest: output file path, written through a temporary file
+    :return: {'size', 'output_size', 'error'}, 'output_size' is 0 if failed
+    '''
+    from PIL import Image, ImageOps
+    result = {'size': os.path.getsize(src), 'output_size': 0, 'error': ''}
+    tmp_path = dest + '.tmp'
+    try:
+        with Image.open(src) as img:
+            if settings.max_edge:
+                # JPEG: decode at 1/2, 1/4 or 1/8 scale if still larger than `max_edge`
+                img.draft('RGB', (settings.max_edge, settings.max_edge))
+            img = ImageOps.exif_transpose(img)
+            if settings.max_edge:
+                img.thumbnail((settings.max_edge, settings.max_edge), Image.LANCZOS)
+            if settings.format == 'JPEG' and img.mode != 'RGB':
+                rgba = img.convert('RGBA')
+                img = Image.new('RGB', rgba.size, (255, 255, 255))
+                img.paste(rgba, mask=rgba.getchannel('A'))
+            elif img.mode not in ('RGB', 'RGBA', 'L'):
+                img = img.convert('RGBA' if 'transparency' in img.info or img.mode in ('LA', 'PA') else 'RGB')
+            options = {'quality': settings.quality} if settings.format in ('JPEG', 'WEBP') else {}
+            img.save(tmp_path, format=settings.format, **options)
+        os.replace(tmp_path, dest)
+    except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+        return result
+    result['output_size'] = os.path.getsize(dest)
+    return result
+
+def _normalize_job(job):
+    return normalize_file(*job)
+
+def load_index(path: Text) -> Dict[Text, Dict]:
+    '''source file name -> row of the index, {} if there is no index
+    '''
+    if not os.path.isfile(path):
+        return {}
+    index = {}
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            try:
+                row['size'], row['mtime_ns'], row['output_size'] = (
+                    int(row['size']), int(row['mtime_ns']), int(row['output_size']))
+            except (TypeError, ValueError):
+                continue
+            index[row['file']] = row
+    return index
+
+def write_index(path: Text, index: Dict[Text, Dict]):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, FIELDS, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(row for _, row in sorted(index.items()))
+    os.replace(tmp_path, path)
+
+class NormalizeResult(NamedTuple):
+    normalized: int
+    skipped: int
+    failed: List[Text]
+    removed: int
+    # sizes of all the sources and outputs of the class, including skipped ones
+    bytes_before: int
+    bytes_after: int
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.bytes_before - self.bytes_after
+
+def normalize_class(src_dir: Text, dest_dir: Text, settings: Settings=Settings(),
+                    workers: Optional[int]=None, pool: Optional[ProcessPoolExecutor]=None) -> NormalizeResult:
+    '''normalize images of a class changed since the last run
+    :param src_dir: image directory of the class
+    :param dest_dir: output directory of the class
+    :param settings: size, format and quality of outputs
+    :param workers: the no. of processes, the no. of CPUs if None, no pool if 1
+    :param pool: process pool shared by the classes (see `validate_images.process_pool`), `workers` is ignored
+    '''
+    if settings.format not in EXTENSIONS:
+        raise ValueError('unknown format "{}", one of {}'.format(settings.format, ', '.join(EXTENSIONS)))
+    os.makedirs(dest_dir, exist_ok=True)
+    index_path = os.path.join(dest_dir, INDEX_FILE)
+    index = load_index(index_path)
+    key = settings.key()
+
+    files = list_images(src_dir) if os.path.isdir(src_dir) else []
+    targets = []
+    skipped = 0
+    new_index = {}
+    for file_name in files:
+        st = os.stat(os.path.join(src_dir, file_name))
+        entry = index.get(file_name)
+        if (entry is not None and (entry['size'], entry['mtime_ns'], entry['settings']) == (st.st_size, st.st_mtime_ns, key)
+                and os.path.isfile(os.path.join(dest_dir, entry['output']))):
+            new_index[file_name] = entry
+            skipped += 1
+            continue
+        new_index[file_name] = {'file': file_name, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                                'settings': key, 'output': output_name(file_name, settings), 'output_size': 0}
+        targets.append(file_name)
+
+    # outputs of removed sources and of the previous settings
+    outputs = set(row['output'] for row in new_index.values())
+    removed = 0
+    for row in index.values():
+        path = os.path.join(dest_dir, row['output'])
+        if row['output'] not in outputs and os.path.isfile(path):
+            os.remove(path)
+            removed += 1
+
+    jobs = [(os.path.join(src_dir, f), os.path.join(dest_dir, new_index[f]['output']), settings) for f in targets]
+    if len(jobs) <= 1 or (pool is None and workers == 1):
+        results = [normalize_file(*job) for job in jobs]
+    elif pool is not None:
+        results = list(pool.map(_normalize_job, jobs, chunksize=16))
+    else:
+        with process_pool(workers) as executor:
+            results = list(executor.map(_normalize_job, jobs, chunksize=16))
+    failed = []
+    for file_name, result in zip(targets, results):
+        if result['error']:
+            failed.append(file_name)
+            del new_index[file_name]
+        else:
+            new_index[file_name]['output_size'] = result['output_size']
+    if new_index or index:
+        write_index(index_path, new_index)
+
+    return NormalizeResult(
+        normalized=len(targets) - len(failed), skipped=skipped, failed=failed, removed=removed,
+        bytes_before=sum(row['size'] for row in new_index.values()),
+        bytes_after=sum(row['output_size'] for row in new_index.values()))
+
+def summary(result: NormalizeResult) -> Text:
+    return '{} normalized, {} unchanged, {} failed, {:.1f}MB -> {:.1f}MB ({:.1f}MB saved)'.format(
+        result.normalized, result.skipped, len(result.failed),
+        result.bytes_before / 1e6, result.bytes_after / 1e6, result.bytes_saved / 1e6)
+
+def main(images_dir: Text, dest_dir: Text, settings: Settings=Settings(), workers: Optional[int]=None) -> NormalizeResult:
+    '''normalize all the classes of an images directory
+    :param images_dir: directory including a directory for each class, e.g. "[save dir]/images"
+    :param dest_dir: output directory, a directory is made for each class
+    :param workers: the no. of processes
+    :return: totals of all the classes
+    '''
+    if not os.path.isdir(images_dir):
+        raise RuntimeError('"{}" is not a directory'.format(images_dir))
+    with os.scandir(images_dir) as it:
+        classes = sorted(e.name for e in it if e.is_dir())
+    results = []
+    pool = process_pool(workers) if workers != 1 else None
+    try:
+        for class_name in classes:
+            result = normalize_class(os.path.join(images_dir, class_name), os.path.join(dest_dir, class_name),
+                                     settings, workers=workers, pool=pool)
+            print('{}: {}'.format(class_name, summary(result)))
+            results.append(result)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    total = NormalizeResult(
+        sum(r.normalized for r in results), sum(r.skipped for r in results),
+        list(itertools.chain.from_iterable(r.failed for r in results)), sum(r.removed for r in results),
+        sum(r.bytes_before for r in results), sum(r.bytes_after for r in results))
+    print('Total: {}'.format(summary(total)))
+    return total
+
+
+if __name__ == '__main__':
+    import argparse
+    psr = argparse.ArgumentParser()
+    psr.add_argument('images', help='directory of class directories, e.g. [save dir]/images')
+    psr.add_argument('dest', help='output directory, e.g. [save dir]/normalized')
+    psr.add_argument('--max-edge', help='longest edge of outputs, 0 not to resize', type=int, default=1024)
+    psr.add_argument('--format', help='format of outputs', choices=list(EXTENSIONS), default='JPEG')
+    psr.add_argument('--quality', help='quality of JPEG and WebP outputs', type=int, default=90)
+    psr.add_argument('-w', '--workers', help='the no. of processes, the no. of CPUs by default', type=int, default=None)
+    a = psr.parse_args()
+    main(a.images, a.dest, Settings(a.max_edge or None, a.format, a.quality), workers=a.workers)
@@ -0,0 +1,200 @@
+'''
+Retry policy shared by the searches and the image downloads.
+
+- exponential backoff with jitter instead of a fixed sleep
+- honors Retry-After of 429 and 503 responses
+- per-host circuit breaker to fail fast on hosts that keep erroring
+'''
+
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional, Text
+from urllib.parse import urlparse
+
+from requests.exceptions import ChunkedEncodingError, ConnectionError, HTTPError, Timeout
+
+class CircuitOpen(Exception):
+    '''requests to the host are skipped because it keeps erroring
+    '''
+    pass
+
+class CircuitBreaker:
+    '''per-host circuit breaker
+
+    After `failure_threshold` consecutive failures the circuit of the host
+    opens and requests fail fast for `reset_seconds`. Then one trial request
+    is allowed (half open): success closes the circuit, failure opens it again.
+    '''
+    def __init__(self, failure_threshold: int=5, reset_seconds: float=60, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self.failures: Dict[Text, int] = {}
+        self.opened_at: Dict[Text, float] = {}
+        self.lock = threading.Lock()
+
+    def allow(self, host: Text) -> bool:
+        with self.lock:
+            opened_at = self.opened_at.get(host)
+            if opened_at is None:
+                return True
+            if self.clock() - opened_at >= self.reset_seconds:
+                # half open: let this request try, and block others until it finishes
+                self.opened_at[host] = self.clock()
+                return True
+            return False
+
+    def record_success(self, host: Text):
+        with self.lock:
+            self.failures.pop(host, None)
+            self.opened_at.pop(host, None)
+
+    def record_failure(self, host: Text):
+        with self.lock:
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if self.failures[host] >= self.failure_threshold:
+                self.opened_at[host] = self.clock()
+
+    def is_open(self, host: Text) -> bool:
+        with self.lock:
+            return host in self.opened_at
+
+def parse_retry_after(value: Optional[Text], now: Optional[datetime]=None) -> Optional[float]:
+    '''parse Retry-After header (seconds or HTTP-date)
+    :return: seconds to wait, None if missing or invalid
+    '''
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        # "-0000" means UTC without a known local offset
+        date = date.replace(tzinfo=timezone.utc)
+    if now is None:
+        now = datetime.now(timezone.utc)
+    return max(0.0, (date - now).total_seconds())
+
+def is_congestion(e: Exception) -> bool:
+    '''True if the error suggests the host is overloaded: timeouts, connection errors, 429 and 5xx.
+    404s and rejected responses (not an image, too large) are not.
+    '''
+    if isinstance(e, HTTPError):
+        return e.response is not None and (e.response.status_code == 429 or e.response.status_code >= 500)
+    return isinstance(e, (ConnectionError, Timeout, ChunkedEncodingError))
+
+class RetryPolicy:
+    '''retry with exponential backoff, jitter and a per-host circuit breaker
+
+    Retried: connection errors, timeouts and HTTP statuses in `retry_statuses`.
+    Other exceptions are raised at once.
+    '''
+    def __init__(
+            self,
+            max_try: int=2,
+            base_delay: float=1.0,
+            max_delay: float=30.0,
+            retry_statuses=(429, 500, 502, 503, 504),
+            breaker: Optional[CircuitBreaker]=None,
+            sleep=time.sleep,
+            rand=random.random):
+        '''
+        :param max_try: max times of trying. 1 means no retry.
+        :param base_delay: delay before the first retry, doubled for each retry
+        :param max_delay: max delay, also the max Retry-After to wait for
+        :param retry_statuses: HTTP statuses to retry
+        :param breaker: circuit breaker, a new one if None
+        :param sleep: function to sleep for given seconds
+        :param rand: function returning random float in [0, 1)
+        '''
+        self.max_try = max_try
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = retry_statuses
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.sleep = sleep
+        self.rand = rand
+
+    def delay(self, attempt: int, retry_after: Optional[float]=None) -> float:
+        '''seconds to wait before the retry after `attempt`-th try (1-origin)
+
+        "full jitter": random in [0, base_delay * 2 ** (attempt - 1)], capped by `max_delay`.
+        Retry-After is used as is if given.
+        '''
+        if retry_after is not None:
+            return retry_after
+        return self.rand() * min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+
+    def is_retriable(self, e: Exception) -> bool:
+        if isinstance(e, HTTPError):
+            return e.response is not None and e.response.status_code in self.retry_statuses
+        return isinstance(e, (ConnectionError, Timeout, ChunkedEncodingError))
+
+    def is_host_failure(self, e: Exception) -> bool:
+        '''True if the error suggests the host is down or overloaded
+        '''
+        return self.is_retriable(e)
+
+    def call(self, url: Text, func: Callable, max_try: Optional[int]=None, on_error: Optional[Callable]=None):
+        '''call `func()` to request `url` with retry
+        :param url: request url, its host is used for the circuit breaker
+        :param func: function sending the request
+        :param max_try: overrides `self.max_try`
+        :param on_error: called with (exception, attempt, delay or None if giving up) on each failure
+        :return: return value of `func`
+        :raises CircuitOpen: if the circuit of the host is open
+        :raises Exception: the last exception raised by `func`
+        '''
+        host = urlparse(url).netloc
+        max_try = max_try if max_try is not None else self.max_try
+        attempt = 0
+        while True:
+            if not self.breaker.allow(host):
+                raise CircuitOpen('too many errors on {}, skip {}'.format(host, url))
+            attempt += 1
+            try:
+                result = func()
+            except Exception as e:
+                if not self.is_host_failure(e):
+                    self.breaker.record_success(host)
+                    if on_error is not None:
+                        on_error(e, attempt, None)
+                    raise
+                self.breaker.record_failure(host)
+
+                delay = None
+                if attempt < max_try:
+                    retry_after = None
+                    if isinstance(e, HTTPError):
+                        retry_after = parse_retry_after(e.response.headers.get('Retry-After'))
+                    delay = self.delay(attempt, retry_after)
+                    if delay > self.max_delay:
+                        # the host asks to wait too long, give up this one
+                        delay = None
+                if on_error is not None:
+                    on_error(e, attempt, delay)
+                if delay is None:
+                    raise
+                self.sleep(delay)
+            else:
+                self.breaker.record_success(host)
+                return result
+
+_default_policy = None
+_default_policy_lock = threading.Lock()
+
+def default_retry_policy() -> RetryPolicy:
+    '''policy shared in the process when no policy is given explicitly
+    '''
+    global _default_policy
+    with _default_policy_lock:
+        if _default_policy is None:
+            _default_policy = RetryPolicy()
+        return _default_policy
@@ -0,0 +1,361 @@
+'''
+Run many queries at once without overloading any single host.
+
+- TokenBucket: token bucket rate limiter for one host
+- HostRateLimiter: one token bucket per host, shared by all the threads
+- AdaptiveConcurrency: AIMD limit of requests in flight from latency and errors
+- Budget: time and byte budget of a query or a run, `BudgetExhausted` when it stops a query
+- keep_alive: call a heartbeat while a long stage runs
+- run_jobs: run jobs with a global concurrency cap
+- run_pipeline: run jobs while they are still being produced
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Text
+from urllib.parse import urlparse
+
+class TokenBucket:
+    '''token bucket rate limiter
+
+    `rate` tokens are added per second up to `capacity`.
+    `acquire` blocks until the requested tokens are available.
+    '''
+    def __init__(self, rate: float, capacity: Optional[float]=None, clock=time.monotonic, sleep=time.sleep):
+        '''
+        :param rate: tokens added per second
+        :param capacity: max tokens (burst size), same as `rate` by default (at least 1)
+        :param clock: function returning current time in seconds
+        :param sleep: function to sleep for given seconds
+        '''
+        if rate <= 0:
+            raise ValueError('`rate` must be positive, but {}'.format(rate))
+        if capacity is not None and capacity < 1:
+            # a request takes one token, so it could never be taken
+            raise ValueError('`capacity` must be at least 1, but {}'.format(capacity))
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.last = clock()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def try_acquire(self, tokens: float=1) -> float:
+        '''take tokens if available
+        :return: 0 if the tokens were taken, otherwise seconds to wait
+        '''
+        with self.lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0.0
+            return (tokens - self.tokens) / self.rate
+
+    def acquire(self, tokens: float=1):
+        '''block until the tokens are taken
+        :raises ValueError: if `tokens` is more than `capacity`, they would never be available
+        '''
+        if tokens > self.capacity:
+            raise ValueError('cannot acquire {} tokens from a bucket of capacity {}'.format(tokens, self.capacity))
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return
+            self.sleep(wait)
+
+class HostRateLimiter:
+    '''per-host token buckets
+
+    All the downloads and searches share one limiter so that each host
+    receives at most `rate` requests per second however many queries run at once.
+    '''
+    def __init__(self, rate: float, capacity: Optional[float]=None, host_rates: Optional[Dict[Text, float]]=None):
+        '''
+        :param rate: requests per second for each host
+        :param capacity: burst size for each host
+        :param host_rates: requests per second for specific hosts, e.g. {'www.google.co.jp': 1}
+        '''
+        self.rate = rate
+        self.capacity = capacity
+        self.host_rates = host_rates or {}
+        self.buckets: Dict[Text, TokenBucket] = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, host: Text) -> TokenBucket:
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.host_rates.get(host, self.rate), self.capacity)
+            return self.buckets[host]
+
+    def acquire(self, url: Text):
+        '''block until a request to the host of `url` is allowed
+        '''
+        self.bucket(urlparse(url).netloc).acquire()
+
+class AdaptiveConcurrency:
+    '''AIMD (additive increase, multiplicative decrease) limit of requests in flight
+
+    The result of each network attempt is fed by `record`. The limit grows
+    by one after about `limit` attempts without congestion. Attempts are
+    judged in windows of `limit` attempts (at least `min_window`): the limit
+    is multiplied by `decrease` when more than `max_failure_rate` of the
+    attempts of a window were congested (timeouts, connection errors, 429
+    and 5xx, not 404s or rejected files, which are normal in scraping), or
+    when the smoothed latency exceeds `tolerance` times the baseline latency.
+    So one burst of errors reduces the limit at most once per window.
+    The baseline is the lowest smoothed latency seen, slowly raised
+    toward the current latency.
+    '''
+    def __init__(self, min_limit: int=1, max_limit: int=32, initial: Optional[int]=None,
+                 decrease: float=0.5, tolerance: float=2.0, smoothing: float=0.1,
+                 max_failure_rate: float=0.2, min_window: int=10):
+        '''
+        :param min_limit: the limit never goes below this
+        :param max_limit: the limit never goes above this
+        :param initial: initial limit, `min_limit` if None
+        :param decrease: factor of the limit on congestion
+        :param tolerance: latency above this times the baseline is congestion
+        :param smoothing: weight of a new latency in the smoothed latency
+        :param max_failure_rate: a window with more congested attempts than this rate is congestion
+        :param min_window: min no. of attempts of a window
+        '''
+        if not 1 <= min_limit <= max_limit:
+            raise ValueError('should be 1 <= min_limit <= max_limit, but {} and {}'.format(min_limit, max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(initial if initial is not None else min_limit)
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.max_failure_rate = max_failure_rate
+        self.min_window = min_window
+        self.in_flight = 0
+        self.latency: Optional[float] = None
+        self.baseline: Optional[float] = None
+        # attempts and congested attempts of the current window
+        self.window = 0
+        self.window_congested = 0
+        self.num_decreases = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        '''block until a request is allowed, should be followed by `release`
+        '''
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+    def record(self, latency: Optional[float]=None, congested: bool=False):
+        '''feed the result of one network attempt of a request
+        :param latency: seconds of the attempt, without waits for rate limits and retry delays, not used if None
+        :param congested: the attempt failed by a timeout, a connection error, 429 or 5xx
+        '''
+        with self.cond:
+            if latency is not None and not congested:
+                if self.latency is None:
+                    self.latency = self.baseline = latency
+                else:
+                    self.latency += self.smoothing * (latency - self.latency)
+                    self.baseline = min(self.latency, self.baseline + 0.01 * (self.latency - self.baseline))
+            self.window += 1
+            self.window_congested += congested
+            if not congested:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            if self.window >= max(self.limit, self.min_window):
+                slow = self.latency is not None and self.latency > self.tolerance * self.baseline
+                if self.window_congested > self.max_failure_rate * self.window or slow:
+                    self.limit = max(float(self.min_limit), self.limit * self.decrease)
+                    self.num_decreases += 1
+                self.window = self.window_congested = 0
+            self.cond.notify_all()
+
+    def stats(self) -> Dict:
+        with self.cond:
+            return {
+                'limit': int(self.limit), 'in_flight': self.in_flight, 'decreases': self.num_decreases,
+                'latency_ms': round(self.latency * 1000, 1) if self.latency is not None else None,
+                'baseline_ms': round(self.baseline * 1000, 1) if self.baseline is not None else None}
+
+class Budget:
+    '''time and byte budget of a query or a run
+
+    The time starts when the budget is created. Bytes are added by the
+    downloads. The budget is exhausted when either of them runs out.
+    '''
+    def __init__(self, seconds: Optional[float]=None, max_bytes: Optional[int]=None, clock=time.monotonic):
+        '''
+        :param seconds: time budget, no limit if None
+        :param max_bytes: byte budget, no limit if None
+        '''
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.start = clock()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def add(self, num_bytes: int):
+        with self.lock:
+            self.bytes += num_bytes
+
+    def remaining_seconds(self) -> Optional[float]:
+        '''
+        :return: seconds until the deadline, None if no time limit
+        '''
+        if self.seconds is None:
+            return None
+        return max(0.0, self.seconds - (self.clock() - self.start))
+
+    def exhausted(self) -> Optional[Text]:
+        '''
+        :return: reason if the budget ran out, otherwise None
+        '''
+        if self.seconds is not None and self.clock() - self.start >= self.seconds:
+            return 'deadline of {:g} seconds'.format(self.seconds)
+        with self.lock:
+            if self.max_bytes is not None and self.bytes >= self.max_bytes:
+                return '{:,} bytes of {:,} bytes'.format(self.bytes, self.max_bytes)
+        return None
+
+class BudgetExhausted(Exception):
+    '''a query was stopped or not started because a budget ran out
+
+    Its manifest is written, so the query is continued by resuming it.
+    '''
+    def __init__(self, reason: Text, rows: Optional[List[Dict]]=None, run: bool=False):
+        '''
+        :param reason: which budget ran out
+        :param rows: rows of the url manifest of the query, [] if not started
+        :param run: True if the budget of the run ran out, so no more queries should be started,
+            False if only the budget of the query did
+        '''
+        super().__init__(reason)
+        self.reason = reason
+        self.rows = rows if rows is not None else []
+        self.run = run
+
+class Cancelled(Exception):
+    '''a query was stopped by its cancel event, e.g. its lease of the work queue was lost
+    '''
+    pass
+
+def within_budgets(jobs: Iterable, budgets: List[Budget], on_exhausted: Optional[Callable]=None,
+                   cancel: Optional[threading.Event]=None, on_next: Optional[Callable]=None) -> Iterator:
+    '''yield jobs until one of `budgets` is exhausted, checked before each job is taken from `jobs`
+    :param on_exhausted: called with the reason when the budget runs out
+    :param cancel: stop when this is set
+    :param on_next: called whenever a job is taken
+    '''
+    jobs = iter(jobs)
+    while True:
+        if cancel is not None and cancel.is_set():
+            return
+        for budget in budgets:
+            reason = budget.exhausted()
+            if reason is not None:
+                if on_exhausted is not None:
+                    on_exhausted(reason)
+                return
+        try:
+            job = next(jobs)
+        except StopIteration:
+            return
+        if on_next is not None:
+            on_next()
+        yield job
+
+@contextlib.contextmanager
+def keep_alive(heartbeat: Optional[Callable], interval: float):
+    '''call `heartbeat` every `interval` seconds in a background thread while the block runs,
+    e.g. to keep the lease of a query whose validation takes no jobs. Nothing is done if `heartbeat` is None.
+    '''
+    if heartbeat is None:
+        yield
+        return
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            heartbeat()
+
+    heartbeat()
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+        heartbeat()
+
+def run_jobs(func: Callable, jobs: Iterable, max_workers: int=1) -> List:
+    '''run `func(job)` for every job with at most `max_workers` jobs at once
+    :return: results in the order of `jobs`
+    '''
+    max_workers = max(1, max_workers)
+    if max_workers == 1:
+        return [func(job) for job in jobs]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(func, jobs))
+
+def run_pipeline(func: Callable, jobs: Iterable, max_workers: int=1, queue_size: Optional[int]=None) -> List:
+    '''run `func(job)` in `max_workers` threads while `jobs` is iterated in the calling thread
+
+    `jobs` can be a generator that takes time to produce jobs (e.g. search
+    result pages). Jobs are passed through a queue of `queue_size` so that
+    the producer stays at most `queue_size` jobs ahead of the workers.
+
+    :param queue_size: max jobs waiting for workers, 2 * `max_workers` by default
+    :return: results in the order of `jobs`
+    :raises Exception: the first exception raised by `func`, after all the jobs are done
+    '''
+    max_workers = max(1, max_workers)
+    if queue_size is None:
+        queue_size = 2 * max_workers
+    jobs_queue = queue.Queue(maxsize=max(1, queue_size))
+    results = {}
+    errors = []
+    done = object()
+
+    def worker():
+        while True:
+            item = jobs_queue.get()
+            if item is done:
+                return
+            i, job = item
+            try:
+                results[i] = func(job)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(max_workers)]
+    for t in threads:
+        t.start()
+    try:
+        num_jobs = 0
+        for num_jobs, job in enumerate(jobs, 1):
+            jobs_queue.put((num_jobs - 1, job))
+    finally:
+        for _ in threads:
+            jobs_queue.put(done)
+        for t in threads:
+            t.join()
+
+    if errors:
+        raise errors[0]
+    return [results[i] for i in range(num_jobs)]
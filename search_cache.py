@@ -0,0 +1,128 @@
+'''
+On-disk cache of image urls found on search result pages.
+
+Re-runs of the same queries (e.g. to retry failed downloads, or to top up
+classes in directory mode) read the urls from here instead of searching again.
+
+- one JSON file per (normalized keyword, page index)
+- entries older than `ttl` seconds are ignored and removed
+- least recently used entries are removed when more than `max_entries`,
+  checked when the cache is opened, when this process has added more
+  entries than allowed, and every `CHECK_EVERY` puts for the entries
+  added by other processes
+'''
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import List, Optional, Text, Tuple
+from urllib.parse import parse_qs, urlparse
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'image-collector', 'search')
+CHECK_EVERY = 100
+
+def normalize_keyword(keyword: Text) -> Text:
+    return ' '.join(keyword.lower().split())
+
+def parse_search_url(url: Text) -> Tuple[Text, int]:
+    '''get keyword and page index from search url made by `Google.query_gen`
+    '''
+    params = parse_qs(urlparse(url).query)
+    return params.get('q', [''])[0], int(params.get('ijn', ['0'])[0])
+
+class SearchCache:
+    def __init__(self, cache_dir: Text=DEFAULT_CACHE_DIR, ttl: float=7 * 24 * 3600, max_entries: int=100000):
+        '''
+        :param cache_dir: directory to save the cache
+        :param ttl: seconds an entry is valid
+        :param max_entries: max no. of entries kept
+        '''
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.num_puts = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        # no. of entries at the last eviction plus entries added since
+        self.num_entries = 0
+        self.evict()
+
+    def path(self, keyword: Text, page: int) -> Text:
+        key = '{}\n{}'.format(normalize_keyword(keyword), page)
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, keyword: Text, page: int) -> Optional[List[Text]]:
+        '''
+        :return: cached urls, None if not cached or expired
+        '''
+        path = self.path(keyword, page)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry['created'] > self.ttl:
+            self.remove(path)
+            return None
+        # mark as recently used for the LRU eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry['urls']
+
+    def put(self, keyword: Text, page: int, urls: List[Text]):
+        path = self.path(keyword, page)
+        entry = {'keyword': normalize_keyword(keyword), 'page': page, 'created': time.time(), 'urls': urls}
+        # write to temporary file and rename, for other processes reading the cache
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        is_new = not os.path.exists(path)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.num_puts += 1
+            self.num_entries += is_new
+            check = self.num_entries > self.max_entries or self.num_puts % CHECK_EVERY == 0
+        if check:
+            self.evict()
+
+    def entries(self) -> List[os.DirEntry]:
+        return [e for e in os.scandir(self.cache_dir) if e.name.endswith('.json')]
+
+    def evict(self):
+        '''remove expired entries and the least recently used entries exceeding `max_entries`
+
+        An entry not used for `ttl` seconds (mtime, updated by `get`) is expired
+        without reading it. Entries used recently but created earlier are removed by `get`.
+        '''
+        with self.lock:
+            entries = []
+            expired_before = time.time() - self.ttl
+            for e in self.entries():
+                try:
+                    mtime = e.stat().st_mtime
+                except OSError:
+                    # removed by another process
+                    continue
+                if mtime < expired_before:
+                    self.remove(e.path)
+                else:
+                    entries.append((mtime, e.path))
+            if len(entries) > self.max_entries:
+                entries.sort()
+                for _, path in entries[:len(entries) - self.max_entries]:
+                    self.remove(path)
+                entries = entries[len(entries) - self.max_entries:]
+            self.num_entries = len(entries)
+
+    @staticmethod
+    def remove(path: Text):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
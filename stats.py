@@ -3,6 +3,17 @@
 '''
 Take statistics
 - histogram of the no. of samples for each class
+- distributions of width, height, aspect ratio, file size and format,
+  read from image headers (no full decode) in a process pool.
+  Sizes recorded in the url manifests by validate_images.py are used
+  without opening the files, if the dataset is "[save dir]/images".
+
+Output
+  hist.png: the no. of samples for each class
+  summary.txt: the no. of samples for each class
+  meta_hist.png: histograms of width, height, aspect ratio, file size and format
+  meta_summary.json: totals, percentiles and histograms of the metadata
+  classes.csv: the no. of samples, unreadable files and medians of each class
 
 
 Which data can be dealt with?
@@ -20,19 +31,32 @@ Which data can be dealt with?
   |--...
 '''
 
-from collections import OrderedDict
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import csv
 import glob
+import json
 import matplotlib.pyplot as plt
+import numpy as np
 import os
 import shutil
-from typing import Text
+from typing import Dict, List, Optional, Text, Tuple
+
+from dataset_index import scan_dataset
+from manifest import Manifest
 
 def main(
         dataset_dir: Text,
-        dest_dir: Text='dataset_stats'
+        dest_dir: Text='dataset_stats',
+        use_index: bool=True,
+        metadata: bool=True,
+        workers: Optional[int]=None
         ):
     '''statistics
     :param dataset_dir: dataset directory
+    :param use_index: read unchanged classes from the index of dataset_index.py
+    :param metadata: take statistics of image headers
+    :param workers: the no. of processes to read image headers, the no. of CPUs if None
     '''
 
     # histogram file name
@@ -59,11 +83,8 @@ def main(
         exit()
 
     # basic stats
-    class_dirs = [d for d in glob.glob(os.path.join(dataset_dir, '*')) if os.path.isdir(d)]
-    class_dirnames = [os.path.split(d)[1] for d in class_dirs] # for labels of histogram
-    class_samples = OrderedDict()
-    for dirpath in class_dirs:
-        class_samples[dirpath] = [f for f in glob.glob(os.path.join(dirpath, '*')) if is_img_file(f)]
+    class_samples = scan_dataset(dataset_dir, use_index=use_index)
+    class_dirnames = list(class_samples) # for labels of histogram
     num_class_samples = list(map(len, class_samples.values()))
 
     # histogram of the number of samples for each class
@@ -84,12 +105,148 @@ def main(
     with open(os.path.join(dest_dir, summary_file), 'w') as f:
         f.write(contents)
 
-def is_img_file(fpath: Text):
-    exts = ['.BMP','.GIF','.JPG','.JPEG','.PNG','.TIF','.TIFF']
-    if os.path.splitext(fpath)[1].upper() in exts:
-        return True
+    if metadata:
+        meta_stats(dataset_dir, class_samples, dest_dir, workers=workers)
+
+# bins of the histograms
+WIDTH_BINS = np.arange(0, 4096 + 64, 64)
+ASPECT_BINS = np.linspace(-3, 3, 49) # log2(width / height)
+FILE_SIZE_BINS = np.logspace(2, 8, 49) # 100B to 100MB
+
+def image_meta(job: Tuple[Text, Optional[Tuple[Text, int, int]]]) -> Tuple[int, Text, int, int]:
+    '''metadata of an image, reading only the header
+    :param job: (path, (format, width, height) known from the manifest or None)
+    :return: (file size, format, width, height), format is "" if not readable
+    '''
+    path, known = job
+    try:
+        file_size = os.path.getsize(path)
+    except OSError:
+        return 0, '', 0, 0
+    if known is not None:
+        return (file_size,) + known
+    try:
+        from PIL import Image
+        # Image.open reads only the header, pixels are decoded lazily
+        with Image.open(path) as img:
+            return file_size, img.format or '', img.width, img.height
+    except Exception:
+        return file_size, '', 0, 0
+
+def known_meta(dataset_dir: Text) -> Dict[Text, Tuple[Text, int, int]]:
+    '''metadata recorded by validate_images.py in "[save dir]/urls/[class].csv"
+    :param dataset_dir: "[save dir]/images"
+    :return: relative path of the image -> (format, width, height)
+    '''
+    urls_dir = os.path.join(os.path.dirname(os.path.normpath(dataset_dir)), 'urls')
+    known = {}
+    for urls_file in glob.glob(os.path.join(urls_dir, '*.csv')):
+        class_name = os.path.splitext(os.path.basename(urls_file))[0]
+        for row in Manifest(urls_file).read():
+            if row.get('is_valid') == 1 and row.get('file') and isinstance(row.get('width'), int):
+                known[os.path.join(class_name, row['file'])] = (row['format'], row['width'], row['height'])
+    return known
+
+def collect_meta(dataset_dir: Text, class_samples: Dict[Text, List[Text]], workers: Optional[int]=None) -> Dict[Text, np.ndarray]:
+    '''metadata of all the images in a process pool
+    :param class_samples: class name -> image file names
+    :return: arrays of "class" (index of `class_samples`), "file_size", "format", "width" and "height"
+    '''
+    known = known_meta(dataset_dir)
+    jobs = []
+    classes = []
+    for i, (class_name, files) in enumerate(class_samples.items()):
+        for f in files:
+            rel_path = os.path.join(class_name, f)
+            jobs.append((os.path.join(dataset_dir, rel_path), known.get(rel_path)))
+        classes += [i] * len(files)
+
+    if workers == 1 or len(jobs) <= 1:
+        results = list(map(image_meta, jobs))
     else:
-        return False
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(image_meta, jobs, chunksize=1024))
+    file_sizes, formats, widths, heights = zip(*results) if results else ([], [], [], [])
+    return {
+        'class': np.array(classes, dtype=np.int64),
+        'file_size': np.array(file_sizes, dtype=np.int64),
+        'format': np.array(formats, dtype=object),
+        'width': np.array(widths, dtype=np.int64),
+        'height': np.array(heights, dtype=np.int64),
+        }
+
+def describe(values: np.ndarray, bins: np.ndarray) -> Dict:
+    '''percentiles and histogram, values out of `bins` are counted in the edge bins
+    '''
+    if not len(values):
+        return {'count': 0}
+    percentiles = [1, 5, 25, 50, 75, 95, 99]
+    counts, _ = np.histogram(np.clip(values, bins[0], bins[-1]), bins=bins)
+    return {
+        'count': int(len(values)),
+        'mean': float(np.mean(values)),
+        'min': float(np.min(values)),
+        'max': float(np.max(values)),
+        'percentiles': {str(p): float(v) for p, v in zip(percentiles, np.percentile(values, percentiles))},
+        'histogram': {'bin_edges': bins.tolist(), 'counts': counts.tolist()},
+        }
+
+def meta_stats(dataset_dir: Text, class_samples: Dict[Text, List[Text]], dest_dir: Text, workers: Optional[int]=None):
+    '''take statistics of image headers and write meta_hist.png, meta_summary.json and classes.csv
+    '''
+    meta = collect_meta(dataset_dir, class_samples, workers=workers)
+    readable = meta['format'] != ''
+    widths = meta['width'][readable]
+    heights = meta['height'][readable]
+    aspects = np.log2(np.maximum(widths, 1) / np.maximum(heights, 1))
+    formats = Counter(meta['format'][readable].tolist())
+
+    summary = {
+        'num_images': int(len(meta['class'])),
+        'num_unreadable': int((~readable).sum()),
+        'total_bytes': int(meta['file_size'].sum()),
+        'formats': dict(formats.most_common()),
+        'width': describe(widths, WIDTH_BINS),
+        'height': describe(heights, WIDTH_BINS),
+        'log2_aspect_ratio': describe(aspects, ASPECT_BINS),
+        'file_size': describe(meta['file_size'], FILE_SIZE_BINS),
+        }
+    with open(os.path.join(dest_dir, 'meta_summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    # images are in the order of classes
+    bounds = np.searchsorted(meta['class'], np.arange(len(class_samples) + 1))
+    with open(os.path.join(dest_dir, 'classes.csv'), 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['class', 'num_images', 'num_unreadable', 'median_width', 'median_height',
+                         'median_aspect_ratio', 'median_file_size', 'formats'])
+        for i, class_name in enumerate(class_samples):
+            lo, hi = bounds[i], bounds[i + 1]
+            ok = readable[lo:hi]
+            w = meta['width'][lo:hi][ok]
+            h = meta['height'][lo:hi][ok]
+            median = lambda v: float(np.median(v)) if len(v) else ''
+            writer.writerow([
+                class_name, hi - lo, int((~ok).sum()), median(w), median(h),
+                median(np.maximum(w, 1) / np.maximum(h, 1)), median(meta['file_size'][lo:hi]),
+                ' '.join('{}:{}'.format(k, v) for k, v in Counter(meta['format'][lo:hi][ok].tolist()).most_common())])
+
+    fig, axes = plt.subplots(2, 3, figsize=(15, 8))
+    for ax, values, bins, title in [
+            (axes[0, 0], widths, WIDTH_BINS, 'width'),
+            (axes[0, 1], heights, WIDTH_BINS, 'height'),
+            (axes[0, 2], aspects, ASPECT_BINS, 'log2(width / height)'),
+            (axes[1, 0], meta['file_size'], FILE_SIZE_BINS, 'file size [bytes]')]:
+        ax.hist(np.clip(values, bins[0], bins[-1]), bins=bins)
+        ax.set_title(title)
+    axes[1, 0].set_xscale('log')
+    axes[1, 1].bar(list(formats), list(formats.values()))
+    axes[1, 1].set_title('format')
+    axes[1, 2].axis('off')
+    fig.tight_layout()
+    fig.savefig(os.path.join(dest_dir, 'meta_hist.png'))
+    plt.close(fig)
+    print('{:,} images, {:,} unreadable'.format(summary['num_images'], summary['num_unreadable']))
 
 
 if __name__ == '__main__':
@@ -97,5 +254,8 @@ if __name__ == '__main__':
     psr = argparse.ArgumentParser()
     psr.add_argument('data', help='dataset directory')
     psr.add_argument('-o', '--out', help='output directory', required=False, default='dataset_stats')
+    psr.add_argument('--no-index', help='list all the class directories without the index', action='store_true')
+    psr.add_argument('--no-metadata', help='only count samples without reading image headers', action='store_true')
+    psr.add_argument('-w', '--workers', help='the no. of processes to read image headers, the no. of CPUs by default', type=int, default=None)
     a = psr.parse_args()
-    main(a.data, dest_dir=a.out)
+    main(a.data, dest_dir=a.out, use_index=not a.no_index, metadata=not a.no_metadata, workers=a.workers)
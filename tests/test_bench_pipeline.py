@@ -0,0 +1,18 @@
+import os
+import sys
+from unittest import TestCase
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+import bench_pipeline
+from fake_server import FakeServer
+
+class TestBenchPipeline(TestCase):
+
+    def testOffline(self):
+        with FakeServer(pages=2, per_page=20, error_rate=0.1, min_size=1000, max_size=5000) as server:
+            result = bench_pipeline.run(server.search_url, 30, workers=4, validate=True)
+        # about 10% fail
+        self.assertGreater(result['images'], 20)
+        self.assertLess(result['images'], 30)
+        self.assertGreater(result['images_per_sec'], 0)
+        self.assertLessEqual(result['p50_ms'], result['p99_ms'])
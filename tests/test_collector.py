@@ -0,0 +1,89 @@
+import asyncio
+import contextlib
+import io
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+from collector import Collector, CollectorConfig, Job, Progress, QueryResult
+from fake_server import FakeServer
+
+class TestCollector(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.server = FakeServer(pages=1, per_page=10, min_size=1000, max_size=2000).start()
+        self.config = CollectorConfig(
+            os.path.join(self.tmp.name, 'out'), workers=4, query_workers=2, search_url=self.server.search_url,
+            search_cache=False, validate_workers=1, retry_base_delay=0.01)
+
+    def tearDown(self):
+        self.server.stop()
+        self.tmp.cleanup()
+
+    def testCollect(self):
+        progress = []
+        with contextlib.redirect_stdout(io.StringIO()), Collector(self.config) as c:
+            result = c.collect('dog', 5, on_progress=progress.append)
+            results = list(c.iter_collect([('cat', 3), Job('bird', 2, dirname='n0001-bird')]))
+        self.assertEqual(('dog', 5, 0), (result.query, result.downloaded, result.failed))
+        self.assertEqual(5, len(os.listdir(result.image_dir)))
+        self.assertTrue(os.path.isfile(result.manifest))
+        self.assertEqual(list(range(1, 6)), sorted(p.done for p in progress))
+        self.assertEqual({'cat': 3, 'n0001-bird': 2}, {r.dirname: r.downloaded for r in results})
+
+    def testAsync(self):
+        async def run():
+            async with Collector(self.config) as c:
+                result = await c.acollect('dog', 2)
+                events = [e async for e in c.aiter_collect([('cat', 3), ('bird', 2)], progress=True)]
+            return result, events
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            result, events = asyncio.run(run())
+        self.assertEqual(2, result.downloaded)
+        self.assertEqual(5, sum(isinstance(e, Progress) for e in events))
+        self.assertEqual(['bird', 'cat'], sorted(e.query for e in events if isinstance(e, QueryResult)))
+        # progress of a query comes before its result
+        cat = [i for i, e in enumerate(events) if e.query == 'cat']
+        self.assertIsInstance(events[cat[-1]], QueryResult)
+
+    def testLazyImport(self):
+        code = 'import sys, collector; print(any(m in sys.modules for m in ("requests", "bs4", "lxml")))'
+        out = subprocess.run([sys.executable, '-c', code], cwd=os.path.join(os.path.dirname(__file__), '..'),
+                             stdout=subprocess.PIPE, check=True).stdout
+        self.assertEqual(b'False', out.strip())
+
+    def testRefresh(self):
+        with contextlib.redirect_stdout(io.StringIO()), Collector(self.config._replace(url_db=False)) as c:
+            result = c.collect('dog', 5)
+            self.assertTrue(all(row['etag'] and row['content_length'] for row in result.rows))
+            paths = [os.path.join(result.image_dir, row['file']) for row in result.rows]
+            mtimes = [os.stat(p).st_mtime_ns for p in paths]
+
+            refreshed = c.collect('dog', 5, refresh=True)
+            metrics = c.metrics.snapshot()['counters']
+        self.assertEqual(5, refreshed.downloaded)
+        self.assertEqual(5, metrics['images_not_modified'])
+        self.assertEqual(mtimes, [os.stat(p).st_mtime_ns for p in paths])
+        self.assertEqual([row['sha256'] for row in result.rows], [row['sha256'] for row in refreshed.rows])
+
+    def testNormalize(self):
+        # validated and normalized in a process pool shared by the queries
+        config = self.config._replace(normalize=True, max_edge=16, validate_workers=2)
+        with contextlib.redirect_stdout(io.StringIO()), Collector(config) as c:
+            result = c.collect('dog', 3)
+            metrics = c.metrics.snapshot()['counters']
+        normalized_dir = os.path.join(config.save_dir, 'normalized', 'dog')
+        self.assertEqual(sorted(row['file'] for row in result.rows),
+                         sorted(f for f in os.listdir(normalized_dir) if not f.startswith('.')))
+        self.assertEqual(3, metrics['images_normalized'])
+
+    def testBudgetExhausted(self):
+        with contextlib.redirect_stdout(io.StringIO()), Collector(self.config._replace(workers=1, query_bytes=2500)) as c:
+            result = c.collect('dog', 5)
+        self.assertIn('bytes', result.exhausted)
+        self.assertLess(result.downloaded, 5)
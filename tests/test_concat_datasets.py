@@ -0,0 +1,119 @@
+import os
+import tempfile
+from unittest import TestCase, mock
+
+import concat_datasets
+import dataset_index
+from manifest import Manifest
+
+_index_dir = None
+
+def setUpModule():
+    # keep the dataset indexes of the tests out of the user cache
+    global _index_dir
+    _index_dir = tempfile.TemporaryDirectory()
+    mock.patch.object(dataset_index, 'DEFAULT_INDEX_DIR', _index_dir.name).start()
+
+def tearDownModule():
+    mock.patch.stopall()
+    _index_dir.cleanup()
+
+def make_dataset(root, classes):
+    '''
+    :param classes: class name -> {file name: content}
+    '''
+    for class_name, files in classes.items():
+        os.makedirs(os.path.join(root, 'images', class_name))
+        os.makedirs(os.path.join(root, 'urls'), exist_ok=True)
+        rows = []
+        for f, content in files.items():
+            with open(os.path.join(root, 'images', class_name, f), 'w') as fp:
+                fp.write(content)
+            rows.append({'No.': int(f[:4]), 'url': 'http://example.com/' + content, 'is_downloaded': 1, 'file': f})
+        Manifest(os.path.join(root, 'urls', class_name + '.csv')).write(rows)
+
+class TestConcatDatasets(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.main_set = os.path.join(self.tmp.name, 'main')
+        self.second_set = os.path.join(self.tmp.name, 'second')
+        make_dataset(self.main_set, {'dog': {'0001.jpg': 'd1', '0002.jpg': 'd2'}, 'cat': {'0001.jpg': 'c1'}})
+        make_dataset(self.second_set, {'dog': {'0001.jpg': 'D1', '0003.png': 'D3'}, 'bird': {'0001.jpg': 'b1'}})
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def concat(self, mode, strategy='hardlink'):
+        dest = os.path.join(self.tmp.name, mode + '_' + strategy)
+        concat_datasets.main(mode, self.main_set, self.second_set, dest, strategy=strategy, workers=2)
+        return dest
+
+    def read(self, dest, class_name):
+        '''{file name: content}, and (No., url, file) of the manifest
+        '''
+        class_dir = os.path.join(dest, 'images', class_name)
+        files = {}
+        for f in os.listdir(class_dir):
+            with open(os.path.join(class_dir, f)) as fp:
+                files[f] = fp.read()
+        rows = Manifest(os.path.join(dest, 'urls', class_name + '.csv')).read()
+        return files, [(row['No.'], row['url'][-2:], row['file']) for row in rows]
+
+    def testMerge(self):
+        dest = self.concat('merge')
+        files, rows = self.read(dest, 'dog')
+        self.assertEqual({'0001.jpg': 'd1', '0002.jpg': 'd2', '0003.png': 'D3'}, files)
+        self.assertEqual([(1, 'd1', '0001.jpg'), (2, 'd2', '0002.jpg'), (3, 'D3', '0003.png')], rows)
+        self.assertEqual({'0001.jpg': 'b1'}, self.read(dest, 'bird')[0])
+        # hard links, no extra disk
+        self.assertEqual(2, os.stat(os.path.join(dest, 'images', 'dog', '0003.png')).st_nlink)
+
+    def testAddImage(self):
+        dest = self.concat('add_image', strategy='copy')
+        files, rows = self.read(dest, 'dog')
+        self.assertEqual({'0001.jpg': 'd1', '0002.jpg': 'd2', '0001_2.jpg': 'D1', '0003.png': 'D3'}, files)
+        self.assertEqual([(1, 'd1', '0001.jpg'), (2, 'd2', '0002.jpg'), (3, 'D3', '0003.png'), (4, 'D1', '0001_2.jpg')], rows)
+        self.assertEqual(1, os.stat(os.path.join(dest, 'images', 'dog', '0001_2.jpg')).st_nlink)
+
+    def testReplace(self):
+        dest = self.concat('replace')
+        self.assertEqual({'0001.jpg': 'd1', '0002.jpg': 'd2'}, self.read(dest, 'dog')[0])
+        self.assertEqual(['bird', 'cat', 'dog'], sorted(os.listdir(os.path.join(dest, 'images'))))
+
+    def testAddClass(self):
+        dest = self.concat('add_class')
+        self.assertEqual(['bird', 'cat', 'dog', 'dog_2'], sorted(os.listdir(os.path.join(dest, 'images'))))
+        files, rows = self.read(dest, 'dog_2')
+        self.assertEqual({'0001.jpg': 'D1', '0003.png': 'D3'}, files)
+        self.assertEqual([(1, 'D1', '0001.jpg'), (3, 'D3', '0003.png')], rows)
+
+class TestContentDedup(TestCase):
+
+    def testSameContentsAreSkipped(self):
+        with tempfile.TemporaryDirectory() as d:
+            main_set = os.path.join(d, 'main')
+            second_set = os.path.join(d, 'second')
+            make_dataset(main_set, {'dog': {'0001.jpg': 'd1', '0002.jpg': 'd2'}})
+            make_dataset(second_set, {'dog': {'0001.jpg': 'd2', '0002.jpg': 'x', '0005.jpg': 'd1', '0007.jpg': 'x'}})
+            # the second copy of "x" refers to the first one
+            manifest = Manifest(os.path.join(second_set, 'urls', 'dog.csv'))
+            rows = manifest.read()
+            rows[3]['duplicate_of'] = os.path.join('images', 'dog', '0002.jpg')
+            manifest.write(rows)
+
+            for mode, expected in [
+                    ('merge', {'0001.jpg': 'd1', '0002.jpg': 'd2', '0007.jpg': 'x'}),
+                    ('add_image', {'0001.jpg': 'd1', '0002.jpg': 'd2', '0002_2.jpg': 'x'})]:
+                dest = os.path.join(d, mode)
+                concat_datasets.main(mode, main_set, second_set, dest, workers=2)
+                files, rows = TestConcatDatasets.read(None, dest, 'dog')
+                self.assertEqual(expected, files, mode)
+                # rebuilt to match the images kept
+                rows = Manifest(os.path.join(dest, 'urls', 'dog.csv')).read()
+                self.assertEqual(sorted(expected), sorted(row['file'] for row in rows))
+                # the original of "0007.jpg" was skipped by name
+                self.assertEqual([''] * 3, [row['duplicate_of'] for row in rows])
+
+            # hashes are cached
+            self.assertTrue(os.path.isfile(os.path.join(second_set, '.hash_index.csv')))
@@ -0,0 +1,59 @@
+import os
+import tempfile
+from unittest import TestCase, mock
+
+import dataset_index
+from dataset_index import DatasetIndex, default_index_path, scan_dataset
+
+class TestDatasetIndex(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        for class_name, files in [('dog', ['0002.jpg', '0001.PNG', 'notes.txt']), ('cat', ['0001.webp'])]:
+            os.makedirs(os.path.join(self.root, class_name))
+            for f in files:
+                open(os.path.join(self.root, class_name, f), 'w').close()
+        os.makedirs(os.path.join(self.root, 'dog', 'sub.jpg'))
+        open(os.path.join(self.root, 'top.jpg'), 'w').close()
+        self.cache = tempfile.TemporaryDirectory()
+        self.patch = mock.patch.object(dataset_index, 'DEFAULT_INDEX_DIR', self.cache.name)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        self.cache.cleanup()
+        self.tmp.cleanup()
+
+    def testScan(self):
+        expected = [('cat', ['0001.webp']), ('dog', ['0001.PNG', '0002.jpg'])]
+        self.assertEqual(expected, list(scan_dataset(self.root, use_index=False).items()))
+        self.assertEqual([], os.listdir(self.cache.name))
+        self.assertEqual(expected, list(scan_dataset(self.root).items()))
+        # the index is in the cache, nothing is added to the dataset
+        self.assertEqual(['cat', 'dog', 'top.jpg'], sorted(os.listdir(self.root)))
+        self.assertTrue(os.path.isfile(default_index_path(self.root)))
+        self.assertEqual(default_index_path(self.root), default_index_path(os.path.join(self.root, 'dog', '..')))
+
+    def testUnchangedClassesFromIndex(self):
+        self.assertEqual(2, self.scan()[1])
+        self.assertEqual(0, self.scan()[1])
+
+        open(os.path.join(self.root, 'dog', '0003.jpg'), 'w').close()
+        # make sure the mtime changes on file systems of coarse timestamps
+        st = os.stat(os.path.join(self.root, 'dog'))
+        os.utime(os.path.join(self.root, 'dog'), ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        classes, num_listed = self.scan()
+        self.assertEqual(1, num_listed)
+        self.assertEqual(['0001.PNG', '0002.jpg', '0003.jpg'], classes['dog'])
+        self.assertEqual(['0001.webp'], classes['cat'])
+
+    def testRecentDirectoriesAreNotIndexed(self):
+        index = DatasetIndex(self.root, min_age=3600)
+        index.scan()
+        index.scan()
+        self.assertEqual(2, index.num_listed)
+
+    def scan(self):
+        index = DatasetIndex(self.root, min_age=0)
+        return index.scan(), index.num_listed
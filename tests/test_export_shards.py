@@ -0,0 +1,81 @@
+import os
+import tempfile
+from unittest import TestCase, mock
+
+import dataset_index
+import export_shards
+from export_shards import ShardReader, plan_shards
+
+_index_dir = None
+
+def setUpModule():
+    # keep the dataset indexes of the tests out of the user cache
+    global _index_dir
+    _index_dir = tempfile.TemporaryDirectory()
+    mock.patch.object(dataset_index, 'DEFAULT_INDEX_DIR', _index_dir.name).start()
+
+def tearDownModule():
+    mock.patch.stopall()
+    _index_dir.cleanup()
+
+class TestPlanShards(TestCase):
+
+    def testSplit(self):
+        self.assertEqual([[0, 1], [2, 3], [4]], plan_shards([4, 5, 8, 2, 1], 10))
+        # larger than a shard
+        self.assertEqual([[0], [1]], plan_shards([20, 1], 10))
+        self.assertEqual([], plan_shards([], 10))
+
+class TestExport(TestCase):
+
+    def testExportAndRead(self):
+        with tempfile.TemporaryDirectory() as d:
+            data = os.path.join(d, 'images')
+            contents = {}
+            for class_name in ['cat', 'dog']:
+                os.makedirs(os.path.join(data, class_name))
+                for i in range(1, 8):
+                    key = os.path.join(class_name, '{:04d}.jpg'.format(i))
+                    contents[key] = (class_name * i * 10).encode()
+                    with open(os.path.join(data, key), 'wb') as f:
+                        f.write(contents[key])
+            out = os.path.join(d, 'shards')
+
+            for shuffle in [False, True]:
+                export_shards.main(data, out, shard_size=100, workers=3, shuffle=shuffle)
+                reader = ShardReader(out)
+                with open(os.path.join(out, 'keys.txt')) as f:
+                    keys = f.read().split()
+                self.assertEqual(14, len(reader))
+                self.assertEqual(sorted(contents), sorted(keys))
+                self.assertGreater(reader.index['shard'].max(), 1)
+                for i, key in enumerate(keys):
+                    view, label = reader[i]
+                    self.assertEqual(contents[key], bytes(view))
+                    self.assertEqual(key.split(os.sep)[0], reader.labels[label])
+
+                streamed = sorted(bytes(view) for view, _ in reader.stream(shuffle=True, seed=1))
+                self.assertEqual(sorted(contents.values()), streamed)
+                self.assertEqual(5, len(list(reader.sample(5, seed=0))))
+                del view
+                reader.close()
+
+    def testReexportRemovesStaleShards(self):
+        with tempfile.TemporaryDirectory() as d:
+            data = os.path.join(d, 'images')
+            os.makedirs(os.path.join(data, 'cat'))
+            for i in range(1, 6):
+                with open(os.path.join(data, 'cat', '{:04d}.jpg'.format(i)), 'wb') as f:
+                    f.write(b'x' * 50)
+            out = os.path.join(d, 'shards')
+            export_shards.main(data, out, shard_size=50, workers=2)
+            self.assertEqual(5, len([f for f in os.listdir(out) if f.startswith('shard-')]))
+            with open(os.path.join(out, 'shard-00009.bin.tmp'), 'wb') as f:
+                f.write(b'unfinished')
+
+            export_shards.main(data, out, shard_size=1000, workers=2)
+            self.assertEqual(['shard-00000.bin'], sorted(f for f in os.listdir(out) if f.startswith('shard-')))
+            reader = ShardReader(out)
+            self.assertEqual(5, len(reader))
+            self.assertEqual([b'x' * 50] * 5, [bytes(view) for view, _ in reader.stream()])
+            reader.close()
@@ -0,0 +1,41 @@
+import os
+from unittest import TestCase
+
+from extractors import FallbackExtractor, LxmlExtractor, ScanExtractor, SoupExtractor, get_extractor
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'isch_page.html')
+
+class TestExtractors(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with open(FIXTURE) as f:
+            cls.page = f.read()
+
+    def testSameUrls(self):
+        expected = SoupExtractor().extract(self.page)
+        self.assertEqual(100, len(expected))
+        self.assertEqual('https://images.dog.ceo/images/0000/shiba_inu.jpg?w=800&h=600', expected[0])
+        for extractor in [ScanExtractor(), LxmlExtractor(), get_extractor('auto')]:
+            self.assertEqual(expected, extractor.extract(self.page), extractor.name)
+
+    def testEmptyPage(self):
+        for name in ['auto', 'scan', 'lxml', 'soup']:
+            self.assertEqual([], get_extractor(name).extract('<html><body></body></html>'), name)
+
+    def testFallback(self):
+        # nested element in .rg_meta, which the scanner does not handle
+        page = '<div class="notranslate rg_meta"><span>{"ou": "http://a/1.jpg"}</span></div>'
+        self.assertEqual([], ScanExtractor().extract(page))
+        self.assertEqual(['http://a/1.jpg'], FallbackExtractor([ScanExtractor(), SoupExtractor()]).extract(page))
+
+    def testTruncatedMeta(self):
+        page = '<div class="rg_meta notranslate">{"id": "x", "ou":"http://a/1.jp</div>'
+        with self.assertRaises(ValueError):
+            ScanExtractor().extract(page)
+        # every extractor fails, the page has no urls instead of stopping the query
+        self.assertEqual([], get_extractor('auto').extract(page))
+
+    def testInvalidName(self):
+        with self.assertRaises(RuntimeError):
+            get_extractor('regex')
@@ -0,0 +1,42 @@
+import os
+import tempfile
+from unittest import TestCase, mock
+
+import file_links
+from file_links import link_file, link_files
+
+class TestLinkFile(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, 'src.jpg')
+        with open(self.src, 'wb') as f:
+            f.write(b'x' * 100000)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def dest(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def testStrategies(self):
+        self.assertEqual('hardlink', link_file(self.src, self.dest('a.jpg')))
+        self.assertEqual(2, os.stat(self.src).st_nlink)
+        for strategy in ['reflink', 'copy']:
+            used = link_file(self.src, self.dest(strategy), strategy)
+            self.assertIn(used, ['reflink', 'copy'])
+            with open(self.dest(strategy), 'rb') as f:
+                self.assertEqual(b'x' * 100000, f.read())
+        self.assertEqual(2, os.stat(self.src).st_nlink)
+
+    def testFallback(self):
+        # e.g. another file system
+        with mock.patch('os.link', side_effect=OSError(18, 'Invalid cross-device link')), \
+                mock.patch.object(file_links, 'reflink', side_effect=OSError(95, 'Operation not supported')):
+            self.assertEqual('copy', link_file(self.src, self.dest('a.jpg')))
+        self.assertEqual(1, os.stat(self.src).st_nlink)
+        self.assertEqual(100000, os.path.getsize(self.dest('a.jpg')))
+
+    def testLinkFiles(self):
+        used = link_files([(self.src, self.dest('{}.jpg'.format(i))) for i in range(20)], workers=4)
+        self.assertEqual({'hardlink': 20}, dict(used))
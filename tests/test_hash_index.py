@@ -0,0 +1,52 @@
+import hashlib
+import os
+import tempfile
+from unittest import TestCase, mock
+
+import hash_index
+from hash_index import HashIndex
+
+class TestHashIndex(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.paths = ['{}.jpg'.format(i) for i in range(10)]
+        for p in self.paths:
+            with open(os.path.join(self.root, p), 'w') as f:
+                f.write(p)
+        self.expected = {p: hashlib.sha256(p.encode()).hexdigest() for p in self.paths}
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def testResumeAndCache(self):
+        real_sha256 = hash_index.file_sha256
+
+        def failing_sha256(path):
+            if path.endswith('7.jpg'):
+                raise OSError('interrupted')
+            return real_sha256(path)
+
+        # the other files are saved in the index even if one fails
+        with mock.patch.object(hash_index, 'file_sha256', failing_sha256):
+            with self.assertRaises(OSError):
+                HashIndex(self.root, workers=3).hashes(self.paths)
+
+        index = HashIndex(self.root, workers=3)
+        self.assertEqual(self.expected, index.hashes(self.paths))
+        self.assertEqual(1, index.num_hashed)
+        self.assertEqual(self.expected, index.hashes(self.paths))
+        self.assertEqual(0, index.num_hashed)
+
+        # changed files are hashed again
+        with open(os.path.join(self.root, '3.jpg'), 'w') as f:
+            f.write('changed!')
+        self.assertEqual(hashlib.sha256(b'changed!').hexdigest(), index.hashes(self.paths)['3.jpg'])
+        self.assertEqual(1, index.num_hashed)
+
+    def testKnown(self):
+        index = HashIndex(self.root, index_path='')
+        hashes = index.hashes(self.paths[:2], known={self.paths[0]: 'recorded'})
+        self.assertEqual({self.paths[0]: 'recorded', self.paths[1]: self.expected[self.paths[1]]}, hashes)
+        self.assertFalse(os.path.exists(os.path.join(self.root, '.hash_index.csv')))
@@ -0,0 +1,158 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from http_client import DownloadRejected, PooledHttpClient, stream_to_file
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/etag':
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.send_header('ETag', '"v1"')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('ETag', '"v1"')
+            self.send_header('Last-Modified', 'Mon, 01 Jan 2024 00:00:00 GMT')
+            self.send_header('Content-Length', '5')
+            self.end_headers()
+            self.wfile.write(b'image')
+            return
+        if self.path in ('/drip', '/stall'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', '100')
+            self.end_headers()
+            self.wfile.flush()
+            try:
+                if self.path == '/stall':
+                    time.sleep(5)
+                # a byte every 50 ms, 5 seconds in total
+                for _ in range(100):
+                    self.wfile.write(b'x')
+                    self.wfile.flush()
+                    time.sleep(0.05)
+            except OSError:
+                pass
+            return
+        if self.path == '/html':
+            content_type, body = 'text/html', b'<html></html>'
+        elif self.path == '/large':
+            content_type, body = 'image/jpeg', b'x' * 1000
+        else:
+            content_type, body = 'image/jpeg', b'image'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        if self.path == '/chunked':
+            # no Content-Length, the size is known only while reading
+            body = b'x' * 1000
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class TestPooledHttpClient(TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testConnectionReuse(self):
+        client = PooledHttpClient(pool_size=2)
+        for i in range(5):
+            self.assertEqual(b'image', client.get(self.url + str(i), timeout=5).content)
+        stats = client.stats()
+        client.close()
+
+        self.assertEqual(5, stats['requests'])
+        self.assertEqual(1, stats['hosts'])
+        self.assertEqual(1, stats['connections'])
+        self.assertEqual(4, stats['reused'])
+
+class TestStreamToFile(TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.client = PooledHttpClient()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dest_path = os.path.join(self.tmp_dir.name, '0001.jpg')
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp_dir.cleanup()
+
+    def assertNothingSaved(self):
+        self.assertEqual([], os.listdir(self.tmp_dir.name))
+
+    def testSave(self):
+        downloaded = stream_to_file(self.client, self.url + '/image', self.dest_path, max_bytes=100)
+        self.assertEqual(5, downloaded.size)
+        self.assertEqual(hashlib.sha256(b'image').hexdigest(), downloaded.sha256)
+        with open(self.dest_path, 'rb') as f:
+            self.assertEqual(b'image', f.read())
+        self.assertEqual(['0001.jpg'], os.listdir(self.tmp_dir.name))
+
+    def testConditional(self):
+        downloaded = stream_to_file(self.client, self.url + '/etag', self.dest_path)
+        self.assertEqual(('"v1"', 'Mon, 01 Jan 2024 00:00:00 GMT', 5, False),
+                         (downloaded.etag, downloaded.last_modified, downloaded.content_length, downloaded.not_modified))
+        mtime = os.stat(self.dest_path).st_mtime_ns
+
+        downloaded = stream_to_file(self.client, self.url + '/etag', self.dest_path,
+                                    etag=downloaded.etag, last_modified=downloaded.last_modified)
+        self.assertTrue(downloaded.not_modified)
+        self.assertEqual((0, '"v1"'), (downloaded.size, downloaded.etag))
+        self.assertEqual(mtime, os.stat(self.dest_path).st_mtime_ns)
+        self.assertEqual(['0001.jpg'], os.listdir(self.tmp_dir.name))
+
+    def testRejectContentType(self):
+        with self.assertRaises(DownloadRejected):
+            stream_to_file(self.client, self.url + '/html', self.dest_path)
+        self.assertNothingSaved()
+
+    def testRejectContentLength(self):
+        with self.assertRaises(DownloadRejected):
+            stream_to_file(self.client, self.url + '/large', self.dest_path, max_bytes=100)
+        self.assertNothingSaved()
+
+    def testRejectWhileReading(self):
+        with self.assertRaises(DownloadRejected):
+            stream_to_file(self.client, self.url + '/chunked', self.dest_path, max_bytes=100, chunk_size=10)
+        self.assertNothingSaved()
+
+    def testDeadline(self):
+        with self.assertRaises(DownloadRejected):
+            stream_to_file(self.client, self.url + '/image', self.dest_path, deadline=0)
+        self.assertNothingSaved()
+
+    def testDeadlineSlowHost(self):
+        for path in ['/drip', '/stall']:
+            start = time.monotonic()
+            with self.assertRaises(DownloadRejected):
+                stream_to_file(self.client, self.url + path, self.dest_path, deadline=start + 1)
+            # given up soon after the deadline, not when the body or the read timeout ends
+            self.assertLess(time.monotonic() - start, 1.5, path)
+            self.assertNothingSaved()
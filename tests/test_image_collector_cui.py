@@ -1,9 +1,24 @@
+import contextlib
 import glob
+import hashlib
+import io
 import os
 import shutil
-from unittest import TestCase
+import tempfile
+import threading
+import time
+from unittest import TestCase, mock
 
-from image_collector_cui import main
+from PIL import Image
+
+import image_collector_cui
+from dedup import ContentIndex
+from http_client import Downloaded
+from image_collector_cui import Google, main
+from manifest import Manifest
+from scheduler import Budget, BudgetExhausted, Cancelled
+from url_db import UrlDB
+from work_queue import DONE, LEASED, PENDING, WorkQueue
 
 class TestMain(TestCase):
 
@@ -70,6 +85,26 @@ class TestMain(TestCase):
         # delete tmp
         shutil.rmtree(out_dir)
 
+    def testFailedQuery(self):
+        searched = []
+
+        def fake_search(self, keyword, maximum):
+            searched.append(keyword)
+            if keyword == 'query 1':
+                raise RuntimeError('broken page')
+            return iter([])
+
+        with tempfile.TemporaryDirectory() as d, \
+                mock.patch.object(Google, 'iter_search', fake_search), \
+                contextlib.redirect_stdout(io.StringIO()) as out:
+            query_file = os.path.join(d, 'queries.txt')
+            with open(query_file, 'w') as f:
+                f.writelines('query {}\n'.format(i) for i in range(3))
+            main([None, query_file, 1, d])
+        # the queries after the failed one are run
+        self.assertEqual(['query 0', 'query 1', 'query 2'], searched)
+        self.assertIn("1 queries failed: ['query 1']", out.getvalue())
+
     def testArgQuery(self):
         query = 'johnny depp'
         search_len = 2
@@ -99,3 +134,335 @@ class TestMain(TestCase):
 
         # delete tmp
         shutil.rmtree(out_dir)
+
+
+def save(dest_path, content):
+    '''write file like `download_img_with_retry`
+    '''
+    with open(dest_path, 'wb') as f:
+        f.write(content)
+    return Downloaded(len(content), hashlib.sha256(content).hexdigest())
+
+class TestDownloadAll(TestCase):
+
+    def testOrderAndFiles(self):
+        urls = ['http://example.com/{}.jpg'.format(i) for i in range(10)]
+
+        def fake_download(url, dest_path, **kwargs):
+            # fail on every third url
+            if urls.index(url) % 3 == 2:
+                return None
+            return save(dest_path, url.encode())
+
+        with tempfile.TemporaryDirectory() as d, \
+                mock.patch.object(image_collector_cui, 'download_img_with_retry', fake_download):
+            logs = image_collector_cui.download_all(urls, d, {}, workers=4)
+
+            self.assertEqual(
+                [(i + 1, url, int(i % 3 != 2)) for i, url in enumerate(urls)],
+                [(row['No.'], row['url'], row['is_downloaded']) for row in logs])
+            for i, url in enumerate(urls):
+                fpath = os.path.join(d, str(i + 1).zfill(4) + '.jpg')
+                self.assertEqual(i % 3 != 2, os.path.isfile(fpath))
+
+    def testDedup(self):
+        contents = {'a': b'x', 'b': b'y', 'c': b'x', 'd': b'x'}
+        urls = sorted(contents)
+
+        def fake_download(url, dest_path, **kwargs):
+            return save(dest_path, contents[url])
+
+        for action in ['report', 'skip', 'hardlink']:
+            with tempfile.TemporaryDirectory() as d, \
+                    mock.patch.object(image_collector_cui, 'download_img_with_retry', fake_download):
+                content_index = ContentIndex(d, action=action)
+                logs = image_collector_cui.download_all(urls, d, {}, workers=1, content_index=content_index)
+
+                self.assertEqual([None, None, '0001.jpg', '0001.jpg'], [row.get('duplicate_of') for row in logs])
+                self.assertEqual(hashlib.sha256(b'x').hexdigest(), logs[2]['sha256'])
+                self.assertEqual(action != 'skip', os.path.isfile(os.path.join(d, '0003.jpg')))
+                if action == 'hardlink':
+                    self.assertEqual(3, os.stat(os.path.join(d, '0001.jpg')).st_nlink)
+
+
+class TestIterImageSearch(TestCase):
+
+    @staticmethod
+    def page(urls):
+        return '<html><body>{}</body></html>'.format(''.join(
+            '<div class="rg_meta notranslate">{{"ou": "{}"}}</div>'.format(url) for url in urls))
+
+    def testYieldPageByPage(self):
+        pages = [self.page(['a', 'b']), None, self.page(['c', 'd']), self.page(['e', 'f'])]
+        google = Google()
+        with mock.patch.object(google, 'request_with_retry', side_effect=pages):
+            urls = google.iter_search('dog', maximum=5)
+            self.assertEqual('a', next(urls))
+            self.assertEqual(['b', 'c', 'd', 'e'], list(urls))
+
+    def testGiveUpFailedPages(self):
+        google = Google()
+        with mock.patch.object(google, 'request_with_retry', return_value=None) as request:
+            self.assertEqual([], google.search('dog', maximum=5))
+            self.assertEqual(3, request.call_count)
+
+
+class TestResume(TestCase):
+
+    def testResume(self):
+        urls = ['http://example.com/{}.jpg'.format(c) for c in 'abcdef']
+        requested = []
+        failing = set([urls[1]])
+
+        def fake_download(url, dest_path, **kwargs):
+            requested.append(url)
+            if url in failing:
+                return None
+            return save(dest_path, url.encode())
+
+        def fake_search(self, keyword, maximum):
+            return iter(urls[:maximum])
+
+        with tempfile.TemporaryDirectory() as d, \
+                mock.patch.object(image_collector_cui, 'download_img_with_retry', fake_download), \
+                mock.patch.object(Google, 'iter_search', fake_search):
+            manifest = Manifest(os.path.join(d, 'urls', 'dog.csv'))
+
+            main([None, 'dog', 3, d])
+            self.assertEqual([1, 0, 1], [row['is_downloaded'] for row in manifest.read()])
+
+            # retry only the failed one
+            failing.clear()
+            requested.clear()
+            main([None, 'dog', 3, d], resume=True)
+            self.assertEqual([urls[1]], requested)
+            self.assertEqual([1, 1, 1], [row['is_downloaded'] for row in manifest.read()])
+
+            # top up with new urls
+            requested.clear()
+            main([None, 'dog', 5, d], resume=True)
+            self.assertEqual(urls[3:5], requested)
+            rows = manifest.read()
+            self.assertEqual([1, 2, 3, 4, 5], [row['No.'] for row in rows])
+            self.assertEqual(urls[:5], [row['url'] for row in rows])
+            self.assertEqual(5, len(os.listdir(os.path.join(d, 'images', 'dog'))))
+
+    def testResumeAfterValidation(self):
+        urls = ['http://example.com/{}.jpg'.format(c) for c in 'abcdef']
+        requested = []
+        png = io.BytesIO()
+        Image.new('RGB', (4, 3)).save(png, format='PNG')
+
+        def fake_download(url, dest_path, **kwargs):
+            requested.append(url)
+            # only the first one is an image
+            return save(dest_path, png.getvalue() if url == urls[0] else b'<html></html>')
+
+        def fake_search(self, keyword, maximum):
+            return iter(urls[:maximum])
+
+        with tempfile.TemporaryDirectory() as d, \
+                mock.patch.object(image_collector_cui, 'download_img_with_retry', fake_download), \
+                mock.patch.object(Google, 'iter_search', fake_search):
+            main([None, 'dog', 2, d], validate=True, validate_workers=1)
+            rows = Manifest(os.path.join(d, 'urls', 'dog.csv')).read()
+            self.assertEqual([('0001.png', 1), ('', 0)], [(row['file'], row['is_valid']) for row in rows])
+            self.assertEqual(['0002.jpg'], os.listdir(os.path.join(d, 'quarantine', 'dog')))
+
+            # invalid ones are not downloaded again
+            requested.clear()
+            main([None, 'dog', 2, d], validate=True, validate_workers=1, resume=True)
+            self.assertEqual([urls[2]], requested)
+
+
+class TestUrlDB(TestCase):
+
+    def testReuseAndSkip(self):
+        urls = ['http://example.com/{}.jpg'.format(c) for c in 'abc']
+        requested = []
+
+        def fake_download(url, dest_path, **kwargs):
+            requested.append(url)
+            if url == urls[2]:
+                return None
+            return save(dest_path, url.encode())
+
+        def fake_search(self, keyword, maximum):
+            return iter(urls[:maximum])
+
+        with tempfile.TemporaryDirectory() as d, \
+                mock.patch.object(image_collector_cui, 'download_img_with_retry', fake_download), \
+                mock.patch.object(Google, 'iter_search', fake_search):
+            url_db = UrlDB(os.path.join(d, 'urls.sqlite3'), dead_after=1)
+            main([None, 'dog', 3, d], url_db=url_db)
+            self.assertEqual(urls, requested)
+
+            # the same urls for another query are not requested again
+            requested.clear()
+            main([None, 'puppy', 3, d], url_db=url_db)
+            self.assertEqual([], requested)
+            with open(os.path.join(d, 'images', 'puppy', '0002.jpg'), 'rb') as f:
+                self.assertEqual(urls[1].encode(), f.read())
+            rows = Manifest(os.path.join(d, 'urls', 'puppy.csv')).read()
+            self.assertEqual([1, 1, 0], [row['is_downloaded'] for row in rows])
+            self.assertEqual(['dog', 'puppy'], url_db.classes(urls[0]))
+            url_db.close()
+
+
+class TestWorkQueue(TestCase):
+
+    def testSplitQueries(self):
+        searched = []
+
+        def fake_search(self, keyword, maximum):
+            searched.append(keyword)
+            return iter([])
+
+        with tempfile.TemporaryDirectory() as d, \
+                mock.patch.object(Google, 'iter_search', fake_search):
+            query_file = os.path.join(d, 'queries.txt')
+            with open(query_file, 'w') as f:
+                f.writelines('query {}\n'.format(i) for i in range(6))
+            queue_path = os.path.join(d, 'queue.sqlite3')
+            queues = [WorkQueue(queue_path, worker_id=str(i)) for i in range(3)]
+            # two workers given the same query file
+            threads = [
+                threading.Thread(target=main, args=([None, query_file, 1, d],), kwargs={'work_queue': q})
+                for q in queues[:2]]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(['query {}'.format(i) for i in range(6)], sorted(searched))
+
+            # a finished queue runs nothing again
+            main([None, query_file, 1, d], work_queue=queues[2])
+            self.assertEqual(6, len(searched))
+            for q in queues:
+                q.close()
+
+    def testCancel(self):
+        urls = ['http://example.com/{}.jpg'.format(i) for i in range(10)]
+        cancel = threading.Event()
+        beats = []
+
+        def fake_download(url, dest_path, **kwargs):
+            if url.endswith('/2.jpg'):
+                # the lease was lost
+                cancel.set()
+            return save(dest_path, url.encode())
+
+        def fake_search(self, keyword, maximum):
+            return iter(urls[:maximum])
+
+        with tempfile.TemporaryDirectory() as d, \
+                mock.patch.object(image_collector_cui, 'download_img_with_retry', fake_download), \
+                mock.patch.object(Google, 'iter_search', fake_search):
+            with self.assertRaises(Cancelled):
+                image_collector_cui.collect('dog', 10, d, workers=1, cancel=cancel, heartbeat=lambda: beats.append(1))
+            self.assertEqual(3, len(os.listdir(os.path.join(d, 'images', 'dog'))))
+            # urls are taken a few ahead of the downloads, but not all of them
+            self.assertTrue(3 <= len(beats) < 10, len(beats))
+
+    def testKeepLeaseWhileValidating(self):
+        urls = ['http://example.com/{}.jpg'.format(i) for i in range(3)]
+
+        def fake_download(url, dest_path, **kwargs):
+            return save(dest_path, url.encode())
+
+        def fake_search(self, keyword, maximum):
+            return iter(urls[:maximum])
+
+        def slow_validate(*args, **kwargs):
+            # much longer than the lease, and no url is taken meanwhile
+            time.sleep(1)
+
+        with tempfile.TemporaryDirectory() as d, \
+                mock.patch.object(image_collector_cui, 'download_img_with_retry', fake_download), \
+                mock.patch.object(image_collector_cui, 'validate_class', slow_validate), \
+                mock.patch.object(image_collector_cui, 'HEARTBEAT_SECONDS', 0.05), \
+                mock.patch.object(Google, 'iter_search', fake_search):
+            path = os.path.join(d, 'queue.sqlite3')
+            a = WorkQueue(path, lease_seconds=0.3, worker_id='a')
+            b = WorkQueue(path, lease_seconds=60, worker_id='b')
+            a.add([('dog', 'dog')])
+
+            def run(job, lease):
+                image_collector_cui.collect('dog', 3, d, workers=1, validate=True, cancel=lease.cancelled, heartbeat=lease.progress)
+
+            thread = threading.Thread(target=a.run, args=(run,), kwargs={'poll_seconds': 0.05})
+            thread.start()
+            while a.stats().get(LEASED) is None:
+                time.sleep(0.01)
+            taken = []
+            while thread.is_alive():
+                job = b.lease()
+                if job is not None:
+                    taken.append(job)
+                    b.release(job, 'taken over')
+                time.sleep(0.05)
+            thread.join()
+            self.assertEqual([], taken)
+            self.assertEqual({DONE: 1}, a.stats())
+            a.close()
+            b.close()
+
+
+class TestBudget(TestCase):
+
+    def testStopAndResume(self):
+        urls = ['http://example.com/{}.jpg'.format(i) for i in range(10)]
+
+        def fake_download(url, dest_path, **kwargs):
+            return save(dest_path, url.encode().ljust(100))
+
+        def fake_search(self, keyword, maximum):
+            return iter(urls[:maximum])
+
+        with tempfile.TemporaryDirectory() as d, \
+                mock.patch.object(image_collector_cui, 'download_img_with_retry', fake_download), \
+                mock.patch.object(Google, 'iter_search', fake_search):
+            main([None, 'dog', 10, d], workers=1, query_bytes=300)
+            rows = Manifest(os.path.join(d, 'urls', 'dog.csv')).read()
+            self.assertEqual(3, sum(row['is_downloaded'] for row in rows))
+
+            main([None, 'dog', 10, d], workers=2, resume=True)
+            rows = Manifest(os.path.join(d, 'urls', 'dog.csv')).read()
+            self.assertEqual(10, sum(row['is_downloaded'] for row in rows))
+            self.assertEqual(10, len(os.listdir(os.path.join(d, 'images', 'dog'))))
+
+            # nothing is searched once the budget of the run is exhausted
+            run_budget = Budget(seconds=0)
+            with self.assertRaises(BudgetExhausted) as cm:
+                image_collector_cui.collect('cat', 10, d, run_budget=run_budget)
+            self.assertTrue(cm.exception.run)
+            self.assertFalse(os.path.exists(os.path.join(d, 'images', 'cat')))
+
+    def testQueueKeepsQueriesOutOfBudget(self):
+        urls = ['http://example.com/{}.jpg'.format(i) for i in range(10)]
+
+        def fake_download(url, dest_path, **kwargs):
+            return save(dest_path, url.encode().ljust(100))
+
+        def fake_search(self, keyword, maximum):
+            return iter(urls[:maximum])
+
+        with tempfile.TemporaryDirectory() as d, \
+                mock.patch.object(image_collector_cui, 'download_img_with_retry', fake_download), \
+                mock.patch.object(Google, 'iter_search', fake_search):
+            query_file = os.path.join(d, 'queries.txt')
+            with open(query_file, 'w') as f:
+                f.writelines('query {}\n'.format(i) for i in range(3))
+            q = WorkQueue(os.path.join(d, 'queue.sqlite3'))
+            # nothing is collected, nothing is done
+            main([None, query_file, 10, d], work_queue=q, run_budget=Budget(seconds=0))
+            self.assertEqual({PENDING: 3}, q.stats())
+
+            # queries stopped by their budgets are pending, and resumed by the next run
+            main([None, query_file, 10, d], work_queue=q, workers=1, query_bytes=300)
+            self.assertEqual({PENDING: 3}, q.stats())
+            main([None, query_file, 10, d], work_queue=q, workers=1)
+            self.assertEqual({DONE: 3}, q.stats())
+            rows = Manifest(os.path.join(d, 'urls', 'query_0.csv')).read()
+            self.assertEqual(10, sum(row['is_downloaded'] for row in rows))
+            q.close()
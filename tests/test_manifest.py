@@ -0,0 +1,30 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from manifest import Manifest
+
+class TestManifest(TestCase):
+
+    def testAppendAndRead(self):
+        with tempfile.TemporaryDirectory() as d:
+            manifest = Manifest(os.path.join(d, 'dog.csv'))
+            manifest.start([{'No.': 1, 'url': 'a', 'is_downloaded': 0}])
+            manifest.append({'No.': 2, 'url': 'b', 'is_downloaded': 1})
+            manifest.append({'No.': 1, 'url': 'a', 'is_downloaded': 1})
+
+            # readable before finish, e.g. after a crash
+            self.assertEqual(
+                [(1, 'a', 1), (2, 'b', 1)],
+                [(row['No.'], row['url'], row['is_downloaded']) for row in manifest.read()])
+
+            # a line broken by a crash is ignored
+            with open(manifest.path, 'a') as f:
+                f.write('3,c,')
+            manifest.close()
+            self.assertEqual(2, len(manifest.read()))
+
+            manifest.finish([{'No.': 2, 'url': 'b', 'is_downloaded': 1}, {'No.': 1, 'url': 'a', 'is_downloaded': 1}])
+            with open(manifest.path) as f:
+                self.assertEqual('No.,url,is_downloaded,sha256,duplicate_of,file,format,width,height,is_valid,etag,last_modified,content_length\n'
+                                 '1,a,1,,,,,,,,,,\n2,b,1,,,,,,,,,,\n', f.read())
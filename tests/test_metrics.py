@@ -0,0 +1,108 @@
+import json
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+from metrics import BUCKETS, Metrics, Profiler, stage
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.events_path = os.path.join(self.tmp.name, 'metrics', 'events.jsonl')
+        self.prom_path = os.path.join(self.tmp.name, 'metrics', 'metrics.prom')
+        self.metrics = Metrics(self.events_path, self.prom_path, buffer_size=2)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def testStage(self):
+        with self.metrics.stage('download', url='http://a') as event:
+            event['bytes'] = 10
+        with self.metrics.stage('download', url='http://b') as event:
+            event['ok'] = False
+        with self.assertRaises(ValueError):
+            with self.metrics.stage('parse'):
+                raise ValueError()
+        self.metrics.observe('write', 200.0)
+
+        stages = self.metrics.snapshot()['stages']
+        self.assertEqual((2, 1), (stages['download']['count'], stages['download']['errors']))
+        self.assertEqual((1, 1), (stages['parse']['count'], stages['parse']['errors']))
+        # longer than the last bound
+        self.assertEqual(1, stages['write']['buckets'][len(BUCKETS)])
+
+        self.metrics.export()
+        with open(self.events_path) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual(['download', 'download', 'parse', 'write'], [e['stage'] for e in events])
+        self.assertEqual(('http://a', 10, True), (events[0]['url'], events[0]['bytes'], events[0]['ok']))
+        self.assertFalse(events[1]['ok'])
+
+    def testPrometheus(self):
+        self.metrics.observe('download', 0.2)
+        self.metrics.observe('download', 0.02, ok=False)
+        self.metrics.count('bytes_downloaded', 100)
+        self.metrics.count('bytes_downloaded', 50)
+        self.metrics.export()
+        with open(self.prom_path) as f:
+            lines = f.read().splitlines()
+        self.assertIn('image_collector_stage_seconds_bucket{stage="download",le="0.025"} 1', lines)
+        self.assertIn('image_collector_stage_seconds_bucket{stage="download",le="0.25"} 2', lines)
+        self.assertIn('image_collector_stage_seconds_bucket{stage="download",le="+Inf"} 2', lines)
+        self.assertIn('image_collector_stage_seconds_count{stage="download"} 2', lines)
+        self.assertIn('image_collector_stage_errors_total{stage="download"} 1', lines)
+        self.assertIn('image_collector_bytes_downloaded_total 150', lines)
+        self.assertIn('download', self.metrics.summary())
+
+    def testThreads(self):
+        def run():
+            for _ in range(100):
+                self.metrics.observe('download', 0.001)
+                self.metrics.count('images_downloaded')
+
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.metrics.export()
+        self.assertEqual(400, self.metrics.snapshot()['stages']['download']['count'])
+        self.assertEqual(400, self.metrics.snapshot()['counters']['images_downloaded'])
+        with open(self.events_path) as f:
+            self.assertEqual(400, len(f.readlines()))
+
+    def testExportFromThreads(self):
+        errors = []
+
+        def run():
+            for _ in range(20):
+                self.metrics.count('images_downloaded')
+                try:
+                    self.metrics.export()
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([], errors)
+        with open(self.prom_path) as f:
+            self.assertIn('image_collector_images_downloaded_total 80', f.read())
+        # no temporary files left
+        self.assertEqual(['metrics.prom'], os.listdir(os.path.dirname(self.prom_path)))
+
+    def testNoMetrics(self):
+        with stage(None, 'download') as event:
+            event['ok'] = False
+
+    def testProfiler(self):
+        dest = os.path.join(self.tmp.name, 'profile')
+        with Profiler(dest):
+            t = threading.Thread(target=lambda: sum(range(1000)))
+            t.start()
+            t.join()
+        self.assertEqual(['cprofile.pstats', 'tracemalloc.snapshot', 'tracemalloc_top.txt'], sorted(os.listdir(dest)))
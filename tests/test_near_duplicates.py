@@ -0,0 +1,68 @@
+import os
+import tempfile
+from unittest import TestCase, mock
+
+import numpy as np
+from PIL import Image
+
+import dataset_index
+import near_duplicates
+from near_duplicates import find_pairs, hamming
+
+_index_dir = None
+
+def setUpModule():
+    # keep the dataset indexes of the tests out of the user cache
+    global _index_dir
+    _index_dir = tempfile.TemporaryDirectory()
+    mock.patch.object(dataset_index, 'DEFAULT_INDEX_DIR', _index_dir.name).start()
+
+def tearDownModule():
+    mock.patch.stopall()
+    _index_dir.cleanup()
+
+class TestFindPairs(TestCase):
+
+    def testSameAsBruteForce(self):
+        rng = np.random.default_rng(0)
+        hashes = rng.integers(0, 2 ** 63, size=500, dtype=np.uint64) * np.uint64(2)
+        # plant near duplicates by flipping a few bits
+        for i in range(50):
+            flips = rng.choice(64, size=rng.integers(0, 6), replace=False)
+            hashes[450 + i] = hashes[i] ^ np.uint64(sum(1 << int(b) for b in flips))
+
+        for threshold in [0, 3, 5]:
+            expected = [
+                (i, j, d)
+                for i in range(len(hashes))
+                for j, d in enumerate(hamming(hashes[i], hashes).tolist())
+                if i < j and d <= threshold]
+            self.assertEqual(expected, [tuple(p) for p in find_pairs(hashes, threshold).tolist()], threshold)
+
+    def testEmpty(self):
+        self.assertEqual((0, 3), find_pairs(np.zeros(0, dtype=np.uint64)).shape)
+
+class TestMain(TestCase):
+
+    def testResizedCopy(self):
+        x, y = np.meshgrid(np.linspace(0, 1, 200), np.linspace(0, 1, 150))
+        pattern = (np.sin(x * 9) * np.cos(y * 7) * 127 + 128).astype(np.uint8)
+        with tempfile.TemporaryDirectory() as d:
+            os.makedirs(os.path.join(d, 'data', 'a'))
+            os.makedirs(os.path.join(d, 'data', 'b'))
+            img = Image.fromarray(pattern).convert('RGB')
+            img.save(os.path.join(d, 'data', 'a', '0001.jpg'), quality=95)
+            img.resize((100, 75)).save(os.path.join(d, 'data', 'b', '0001.jpg'), quality=60)
+            Image.fromarray(255 - pattern.T).save(os.path.join(d, 'data', 'b', '0002.png'))
+            with open(os.path.join(d, 'data', 'b', '0003.jpg'), 'w') as f:
+                f.write('<html>not an image</html>')
+
+            for method in ['dhash', 'phash']:
+                out = os.path.join(d, 'out_' + method)
+                pairs = near_duplicates.main(os.path.join(d, 'data'), dest_dir=out, method=method, workers=1)
+                with open(os.path.join(out, 'paths.txt')) as f:
+                    paths = f.read().split()
+                self.assertEqual(3, len(paths))
+                self.assertEqual(
+                    [(os.path.join('a', '0001.jpg'), os.path.join('b', '0001.jpg'))],
+                    [(paths[i], paths[j]) for i, j, _ in pairs], method)
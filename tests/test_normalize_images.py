@@ -0,0 +1,63 @@
+import contextlib
+import io
+import os
+import tempfile
+from unittest import TestCase
+
+from PIL import Image
+
+import normalize_images
+from normalize_images import INDEX_FILE, Settings, normalize_class
+
+class TestNormalizeImages(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, 'images', 'dog')
+        self.dest = os.path.join(self.tmp.name, 'normalized', 'dog')
+        os.makedirs(self.src)
+        Image.new('RGB', (1200, 800), (200, 10, 10)).save(os.path.join(self.src, '0001.jpg'), quality=98)
+        Image.new('RGBA', (40, 60), (0, 0, 255, 128)).save(os.path.join(self.src, '0002.png'))
+        with open(os.path.join(self.src, '0003.jpg'), 'wb') as f:
+            f.write(b'<html>503 Service Unavailable</html>')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def testNormalize(self):
+        result = normalize_class(self.src, self.dest, Settings(max_edge=300), workers=2)
+        self.assertEqual((2, 0, ['0003.jpg'], 0), result[:4])
+        self.assertEqual([INDEX_FILE, '0001.jpg', '0002.jpg'], sorted(os.listdir(self.dest)))
+        with Image.open(os.path.join(self.dest, '0001.jpg')) as img:
+            self.assertEqual(('JPEG', (300, 200)), (img.format, img.size))
+        # smaller images are not enlarged, alpha is dropped for JPEG
+        with Image.open(os.path.join(self.dest, '0002.jpg')) as img:
+            self.assertEqual(('RGB', (40, 60)), (img.mode, img.size))
+        self.assertGreater(result.bytes_saved, 0)
+        self.assertEqual(result.bytes_before - result.bytes_after, result.bytes_saved)
+
+    def testIncremental(self):
+        normalize_class(self.src, self.dest, Settings(max_edge=300), workers=1)
+        mtime = os.stat(os.path.join(self.dest, '0002.jpg')).st_mtime_ns
+
+        Image.new('RGB', (500, 500)).save(os.path.join(self.src, '0001.jpg'))
+        os.remove(os.path.join(self.src, '0003.jpg'))
+        result = normalize_class(self.src, self.dest, Settings(max_edge=300), workers=1)
+        self.assertEqual((1, 1, [], 0), result[:4])
+        self.assertEqual(mtime, os.stat(os.path.join(self.dest, '0002.jpg')).st_mtime_ns)
+        with Image.open(os.path.join(self.dest, '0001.jpg')) as img:
+            self.assertEqual((300, 300), img.size)
+
+        # other settings normalize all again, outputs of removed sources are removed
+        os.remove(os.path.join(self.src, '0002.png'))
+        result = normalize_class(self.src, self.dest, Settings(max_edge=None, format='PNG'), workers=1)
+        self.assertEqual((1, 0, [], 2), result[:4])
+        self.assertEqual([INDEX_FILE, '0001.png'], sorted(os.listdir(self.dest)))
+
+    def testMain(self):
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            total = normalize_images.main(os.path.join(self.tmp.name, 'images'), os.path.join(self.tmp.name, 'normalized'),
+                                          Settings(max_edge=100, format='WEBP', quality=80), workers=1)
+        self.assertEqual(2, total.normalized)
+        self.assertIn('dog: 2 normalized', out.getvalue())
+        self.assertTrue(os.path.isfile(os.path.join(self.dest, '0001.webp')))
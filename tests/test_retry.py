@@ -0,0 +1,108 @@
+from datetime import datetime, timezone
+from unittest import TestCase
+
+import requests
+from requests.exceptions import ConnectionError, HTTPError
+
+from http_client import DownloadRejected
+from retry import CircuitBreaker, CircuitOpen, RetryPolicy, is_congestion, parse_retry_after
+
+def http_error(status, retry_after=None):
+    res = requests.Response()
+    res.status_code = status
+    if retry_after is not None:
+        res.headers['Retry-After'] = retry_after
+    return HTTPError(response=res)
+
+class Failing:
+    '''raise given exceptions in order, then return "ok"
+    '''
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+class TestRetryPolicy(TestCase):
+
+    def setUp(self):
+        self.sleeps = []
+        self.policy = RetryPolicy(max_try=3, base_delay=1, max_delay=10, sleep=self.sleeps.append, rand=lambda: 1.0)
+
+    def testBackoff(self):
+        func = Failing(ConnectionError(), ConnectionError())
+        self.assertEqual('ok', self.policy.call('http://a.example.com/x', func))
+        self.assertEqual(3, func.calls)
+        self.assertEqual([1, 2], self.sleeps)
+
+    def testGiveUp(self):
+        func = Failing(ConnectionError(), ConnectionError(), ConnectionError())
+        with self.assertRaises(ConnectionError):
+            self.policy.call('http://a.example.com/x', func)
+        self.assertEqual(3, func.calls)
+
+    def testNoRetryOnNotFound(self):
+        func = Failing(http_error(404))
+        with self.assertRaises(HTTPError):
+            self.policy.call('http://a.example.com/x', func)
+        self.assertEqual(1, func.calls)
+
+    def testRetryAfter(self):
+        func = Failing(http_error(429, '5'))
+        self.assertEqual('ok', self.policy.call('http://a.example.com/x', func))
+        self.assertEqual([5], self.sleeps)
+
+        # too long to wait
+        func = Failing(http_error(503, '3600'))
+        with self.assertRaises(HTTPError):
+            self.policy.call('http://a.example.com/x', func)
+        self.assertEqual(1, func.calls)
+
+    def testCircuitBreaker(self):
+        policy = RetryPolicy(max_try=1, breaker=CircuitBreaker(failure_threshold=2, reset_seconds=60))
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                policy.call('http://dead.example.com/x', Failing(ConnectionError()))
+        func = Failing()
+        with self.assertRaises(CircuitOpen):
+            policy.call('http://dead.example.com/y', func)
+        self.assertEqual(0, func.calls)
+
+        # other hosts are not affected
+        self.assertEqual('ok', policy.call('http://alive.example.com/x', Failing()))
+
+class TestCircuitBreaker(TestCase):
+
+    def testHalfOpen(self):
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=1, reset_seconds=10, clock=lambda: now[0])
+        breaker.record_failure('a')
+        self.assertFalse(breaker.allow('a'))
+        now[0] = 10
+        # one trial request is allowed after reset_seconds
+        self.assertTrue(breaker.allow('a'))
+        self.assertFalse(breaker.allow('a'))
+        breaker.record_success('a')
+        self.assertTrue(breaker.allow('a'))
+
+class TestIsCongestion(TestCase):
+
+    def testErrors(self):
+        for e in [http_error(429), http_error(503), ConnectionError(), requests.Timeout()]:
+            self.assertTrue(is_congestion(e), e)
+        for e in [http_error(404), http_error(403), DownloadRejected('not an image')]:
+            self.assertFalse(is_congestion(e), e)
+
+class TestParseRetryAfter(TestCase):
+
+    def testParse(self):
+        now = datetime(2019, 5, 1, tzinfo=timezone.utc)
+        self.assertEqual(120, parse_retry_after('120'))
+        self.assertEqual(30, parse_retry_after('Wed, 01 May 2019 00:00:30 GMT', now=now))
+        self.assertEqual(30, parse_retry_after('Wed, 01 May 2019 00:00:30 -0000', now=now))
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('soon'))
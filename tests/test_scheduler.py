@@ -0,0 +1,171 @@
+import threading
+from unittest import TestCase
+
+from scheduler import AdaptiveConcurrency, Budget, HostRateLimiter, TokenBucket, run_jobs, run_pipeline, within_budgets
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, sec):
+        self.now += sec
+
+class TestTokenBucket(TestCase):
+
+    def testBurstThenRate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(2, capacity=3, clock=clock, sleep=clock.sleep)
+
+        # burst of `capacity` requests does not wait
+        for _ in range(3):
+            bucket.acquire()
+        self.assertEqual(0, clock.now)
+
+        # then 2 requests per second
+        for _ in range(4):
+            bucket.acquire()
+        self.assertAlmostEqual(2.0, clock.now)
+
+    def testInvalidRate(self):
+        with self.assertRaises(ValueError):
+            TokenBucket(0)
+        with self.assertRaises(ValueError):
+            TokenBucket(2.0, capacity=0.5)
+        with self.assertRaises(ValueError):
+            TokenBucket(2.0, capacity=3).acquire(4)
+
+class TestHostRateLimiter(TestCase):
+
+    def testBucketPerHost(self):
+        limiter = HostRateLimiter(5, host_rates={'www.google.co.jp': 1})
+        a = limiter.bucket('a.example.com')
+        self.assertIs(a, limiter.bucket('a.example.com'))
+        self.assertIsNot(a, limiter.bucket('b.example.com'))
+        self.assertEqual(5, a.rate)
+        self.assertEqual(1, limiter.bucket('www.google.co.jp').rate)
+
+class TestRunJobs(TestCase):
+
+    def testConcurrencyCapAndOrder(self):
+        lock = threading.Lock()
+        running = [0, 0] # current, max
+
+        def job(x):
+            with lock:
+                running[0] += 1
+                running[1] = max(running[1], running[0])
+            threading.Event().wait(0.01)
+            with lock:
+                running[0] -= 1
+            return x * 2
+
+        self.assertEqual([x * 2 for x in range(20)], run_jobs(job, range(20), max_workers=3))
+        self.assertLessEqual(running[1], 3)
+
+class TestRunPipeline(TestCase):
+
+    def testOrderAndBoundedQueue(self):
+        produced = []
+        consumed = []
+        lock = threading.Lock()
+
+        def jobs():
+            for x in range(30):
+                with lock:
+                    # the producer never runs far ahead of the workers
+                    self.assertLessEqual(len(produced) - len(consumed), 2 + 2 + 1)
+                produced.append(x)
+                yield x
+
+        def job(x):
+            threading.Event().wait(0.001)
+            with lock:
+                consumed.append(x)
+            return x * 2
+
+        self.assertEqual([x * 2 for x in range(30)], run_pipeline(job, jobs(), max_workers=2, queue_size=2))
+
+    def testError(self):
+        def job(x):
+            if x == 3:
+                raise ValueError(x)
+            return x
+
+        with self.assertRaises(ValueError):
+            run_pipeline(job, range(10), max_workers=3)
+        self.assertEqual([], run_pipeline(job, [], max_workers=3))
+
+class TestAdaptiveConcurrency(TestCase):
+
+    def testIncreaseAndDecrease(self):
+        c = AdaptiveConcurrency(min_limit=2, max_limit=8)
+        for _ in range(50):
+            c.acquire()
+            c.record(0.1)
+            c.release()
+        self.assertEqual(8, c.stats()['limit'])
+
+        # a window of errors halves the limit once
+        for _ in range(10):
+            c.record(congested=True)
+        self.assertEqual((4, 1), (c.stats()['limit'], c.stats()['decreases']))
+
+        # latency far above the baseline is congestion
+        for _ in range(40):
+            c.record(5.0)
+        self.assertEqual(2, c.stats()['limit'])
+
+    def testFailureRate(self):
+        # congestion of 1 in 10 attempts is below the rate, the limit keeps growing
+        c = AdaptiveConcurrency(min_limit=1, max_limit=32)
+        for i in range(2000):
+            c.record(0.2, congested=i % 10 == 0)
+        self.assertEqual((32, 0), (c.stats()['limit'], c.stats()['decreases']))
+
+        for _ in range(100):
+            c.record(0.2, congested=True)
+        self.assertLess(c.stats()['limit'], 8)
+
+    def testLimitInFlight(self):
+        c = AdaptiveConcurrency(min_limit=2, max_limit=2)
+        in_flight = []
+        lock = threading.Lock()
+
+        def job(x):
+            c.acquire()
+            with lock:
+                in_flight.append(c.stats()['in_flight'])
+            c.record(0.01)
+            c.release()
+
+        run_jobs(job, range(20), max_workers=8)
+        self.assertLessEqual(max(in_flight), 2)
+
+class TestBudget(TestCase):
+
+    def testBudget(self):
+        clock = FakeClock()
+        budget = Budget(seconds=10, max_bytes=100, clock=clock)
+        self.assertIsNone(budget.exhausted())
+        budget.add(100)
+        self.assertIn('bytes', budget.exhausted())
+
+        budget = Budget(seconds=10, clock=clock)
+        clock.now += 4
+        self.assertEqual(6, budget.remaining_seconds())
+        clock.now += 6
+        self.assertIn('deadline', budget.exhausted())
+        self.assertIsNone(Budget().remaining_seconds())
+
+    def testWithinBudgets(self):
+        budget = Budget(max_bytes=3)
+        reasons = []
+        taken = []
+        for job in within_budgets(range(10), [budget], on_exhausted=reasons.append):
+            taken.append(job)
+            budget.add(1)
+        self.assertEqual([0, 1, 2], taken)
+        self.assertEqual(1, len(reasons))
@@ -0,0 +1,69 @@
+import os
+import tempfile
+import time
+from unittest import TestCase, mock
+
+from image_collector_cui import Google
+from search_cache import SearchCache, parse_search_url
+
+class TestSearchCache(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def testGetPut(self):
+        cache = SearchCache(self.tmp_dir.name)
+        self.assertIsNone(cache.get('Shiba Inu', 0))
+        cache.put('Shiba Inu', 0, ['a', 'b'])
+        # keyword is normalized
+        self.assertEqual(['a', 'b'], cache.get('  shiba   inu ', 0))
+        self.assertIsNone(cache.get('shiba inu', 1))
+
+    def testTtl(self):
+        cache = SearchCache(self.tmp_dir.name, ttl=60)
+        cache.put('dog', 0, ['a'])
+        with mock.patch('time.time', return_value=time.time() + 61):
+            self.assertIsNone(cache.get('dog', 0))
+        self.assertEqual([], os.listdir(self.tmp_dir.name))
+
+    def testLru(self):
+        cache = SearchCache(self.tmp_dir.name, max_entries=2)
+        cache.put('dog', 0, ['a'])
+        os.utime(cache.path('dog', 0), (0, 0))
+        cache.put('dog', 1, ['b'])
+        os.utime(cache.path('dog', 1), (1, 1))
+        # recently used
+        cache.get('dog', 0)
+        cache.put('dog', 2, ['c'])
+        self.assertEqual(['a'], cache.get('dog', 0))
+        self.assertIsNone(cache.get('dog', 1))
+        self.assertEqual(['c'], cache.get('dog', 2))
+
+    def testEvictOnOpen(self):
+        cache = SearchCache(self.tmp_dir.name, ttl=60)
+        for page in range(3):
+            cache.put('dog', page, ['a'])
+        # not used for longer than ttl
+        os.utime(cache.path('dog', 0), (0, 0))
+        cache = SearchCache(self.tmp_dir.name, ttl=60, max_entries=1)
+        self.assertEqual(1, len(cache.entries()))
+        self.assertIsNone(cache.get('dog', 0))
+
+    def testSkipSearch(self):
+        cache = SearchCache(self.tmp_dir.name)
+        page = '<div class="rg_meta notranslate">{"ou": "http://a/1.jpg"}</div>'
+        google = Google(search_cache=cache)
+        with mock.patch.object(google, 'request_with_retry', side_effect=[page, '']) as request:
+            self.assertEqual(['http://a/1.jpg'], google.search('dog', maximum=10))
+            self.assertEqual(2, request.call_count)
+        # the empty last page (e.g. a consent page) is not cached and is requested again
+        with mock.patch.object(google, 'request_with_retry', side_effect=['']) as request:
+            self.assertEqual(['http://a/1.jpg'], google.search('Dog', maximum=10))
+            self.assertEqual(1, request.call_count)
+
+    def testParseSearchUrl(self):
+        url = next(Google().query_gen('shiba inu'))
+        self.assertEqual(('shiba inu', 0), parse_search_url(url))
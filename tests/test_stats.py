@@ -0,0 +1,62 @@
+import csv
+import json
+import os
+import tempfile
+from unittest import TestCase, mock
+
+import matplotlib
+matplotlib.use('Agg')
+from PIL import Image
+
+import dataset_index
+from manifest import Manifest
+import stats
+
+_index_dir = None
+
+def setUpModule():
+    # keep the dataset indexes of the tests out of the user cache
+    global _index_dir
+    _index_dir = tempfile.TemporaryDirectory()
+    mock.patch.object(dataset_index, 'DEFAULT_INDEX_DIR', _index_dir.name).start()
+
+def tearDownModule():
+    mock.patch.stopall()
+    _index_dir.cleanup()
+
+class TestStats(TestCase):
+
+    def testMetadata(self):
+        with tempfile.TemporaryDirectory() as d:
+            images = os.path.join(d, 'images')
+            os.makedirs(os.path.join(images, 'cat'))
+            os.makedirs(os.path.join(images, 'dog'))
+            Image.new('RGB', (40, 20)).save(os.path.join(images, 'cat', '0001.jpg'))
+            Image.new('RGB', (30, 30)).save(os.path.join(images, 'cat', '0002.png'))
+            with open(os.path.join(images, 'dog', '0001.jpg'), 'w') as f:
+                f.write('<html></html>')
+            # recorded by validate_images.py, not opened
+            open(os.path.join(images, 'dog', '0002.gif'), 'w').close()
+            os.makedirs(os.path.join(d, 'urls'))
+            Manifest(os.path.join(d, 'urls', 'dog.csv')).write([
+                {'No.': 2, 'url': 'b', 'is_downloaded': 1, 'file': '0002.gif', 'format': 'GIF',
+                 'width': 10, 'height': 5, 'is_valid': 1}])
+
+            out = os.path.join(d, 'out')
+            stats.main(images, dest_dir=out, workers=1)
+
+            with open(os.path.join(out, 'meta_summary.json')) as f:
+                summary = json.load(f)
+            self.assertEqual(4, summary['num_images'])
+            self.assertEqual(1, summary['num_unreadable'])
+            self.assertEqual({'JPEG': 1, 'PNG': 1, 'GIF': 1}, summary['formats'])
+            self.assertEqual(30.0, summary['width']['percentiles']['50'])
+            self.assertEqual(3, sum(summary['height']['histogram']['counts']))
+            with open(os.path.join(out, 'classes.csv')) as f:
+                rows = list(csv.DictReader(f))
+            self.assertEqual(['cat', 'dog'], [row['class'] for row in rows])
+            self.assertEqual(['2', '2'], [row['num_images'] for row in rows])
+            self.assertEqual(['0', '1'], [row['num_unreadable'] for row in rows])
+            self.assertEqual('GIF:1', rows[1]['formats'])
+            for name in ['hist.png', 'summary.txt', 'meta_hist.png']:
+                self.assertTrue(os.path.isfile(os.path.join(out, name)), name)
@@ -0,0 +1,58 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from url_db import FAILED, INVALID, UrlDB
+
+class TestUrlDB(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.now = 1000.0
+        self.db = UrlDB(os.path.join(self.tmp.name, 'urls.sqlite3'), batch_size=2, dead_after=2,
+                        retry_after=100, clock=lambda: self.now)
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def testRecordAndLookup(self):
+        path = os.path.join(self.tmp.name, 'images', 'dog', '0001.jpg')
+        os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+        self.db.record('http://a', 'dog', sha256='x', size=3, path=path)
+        self.db.add_class('http://a', 'puppy')
+
+        record = self.db.lookup('http://a')
+        self.assertEqual(('ok', 'x', 3, os.path.join('images', 'dog', '0001.jpg')),
+                         (record['status'], record['sha256'], record['size'], record['path']))
+        self.assertEqual(path, self.db.saved_file(record))
+        self.assertEqual(['dog', 'puppy'], self.db.classes('http://a'))
+        self.assertEqual([('http://a', 2)], self.db.shared_urls())
+        self.assertIsNone(self.db.lookup('http://b'))
+
+        os.remove(path)
+        self.assertIsNone(self.db.saved_file(record))
+
+    def testDeadUrls(self):
+        self.db.record('http://a', 'dog', status=FAILED)
+        self.assertFalse(self.db.is_dead(self.db.lookup('http://a')))
+        self.db.record('http://a', 'dog', status=FAILED)
+        self.assertTrue(self.db.is_dead(self.db.lookup('http://a')))
+        # retried after a while
+        self.now += 200
+        self.assertFalse(self.db.is_dead(self.db.lookup('http://a')))
+        # a success resets the failures
+        self.db.record('http://a', 'dog', sha256='x', size=1)
+        self.assertEqual(0, self.db.lookup('http://a')['failures'])
+
+        self.db.record('http://b', 'dog', status=INVALID, attempted=False)
+        self.assertTrue(self.db.is_dead(self.db.lookup('http://b')))
+        self.assertEqual({'ok': 1, 'invalid': 1}, self.db.stats())
+
+    def testSharedByProcesses(self):
+        self.db.record('http://a', 'dog', sha256='x', size=1)
+        self.db.flush()
+        other = UrlDB(self.db.path)
+        self.assertEqual('x', other.lookup('http://a')['sha256'])
+        other.close()
@@ -0,0 +1,103 @@
+import io
+import os
+import tempfile
+from unittest import TestCase
+
+from PIL import Image
+
+from dedup import ContentIndex
+from manifest import Manifest
+import validate_images
+from validate_images import process_pool, sniff_format, validate_class, validate_file, validate_files
+
+def image_bytes(fmt, size=(8, 6)):
+    buf = io.BytesIO()
+    Image.new('RGB', size, (200, 10, 10)).save(buf, format=fmt)
+    return buf.getvalue()
+
+class TestSniffFormat(TestCase):
+
+    def testFormats(self):
+        for fmt in ['JPEG', 'PNG', 'GIF', 'WEBP', 'BMP', 'TIFF']:
+            self.assertEqual(fmt, sniff_format(image_bytes(fmt)[:32]))
+        self.assertIsNone(sniff_format(b'<!DOCTYPE html><html>'))
+        self.assertIsNone(sniff_format(b''))
+
+class TestValidateFile(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def testValid(self):
+        result = validate_file(self.write('0001.jpg', image_bytes('PNG', (8, 6))))
+        self.assertEqual(('PNG', 8, 6, 1), (result['format'], result['width'], result['height'], result['is_valid']))
+
+    def testInvalid(self):
+        jpeg = image_bytes('JPEG')
+        for name, data, reason in [
+                ('html.jpg', b'<html>503 Service Unavailable</html>', 'unknown format'),
+                ('truncated.jpg', jpeg[:len(jpeg) // 2], 'truncated'),
+                ('broken.png', b'\x89PNG\r\n\x1a\n' + b'\x00' * 32 + b'IEND\xaeB`\x82', 'broken')]:
+            result = validate_file(self.write(name, data))
+            self.assertEqual(0, result['is_valid'], name)
+            self.assertTrue(result['reason'].startswith(reason), result['reason'])
+
+    def testSharedPool(self):
+        paths = [self.write('{}.png'.format(i), image_bytes('PNG')) for i in range(3)]
+        with process_pool(2) as pool:
+            # the processes are reused by the next call
+            for _ in range(2):
+                self.assertEqual([1, 1, 1], [r['is_valid'] for r in validate_files(paths, pool=pool)])
+
+class TestValidateClass(TestCase):
+
+    def testRenameAndQuarantine(self):
+        with tempfile.TemporaryDirectory() as d:
+            dest_dir = os.path.join(d, 'images', 'dog')
+            os.makedirs(dest_dir)
+            os.makedirs(os.path.join(d, 'urls'))
+            for name, data in [('0001.jpg', image_bytes('JPEG')), ('0002.jpg', image_bytes('PNG')),
+                               ('0003.jpg', b'<html></html>'), ('0004.jpg', image_bytes('PNG'))]:
+                with open(os.path.join(dest_dir, name), 'wb') as f:
+                    f.write(data)
+            rows = [
+                {'No.': 1, 'url': 'a', 'is_downloaded': 1, 'sha256': 'x'},
+                {'No.': 2, 'url': 'b', 'is_downloaded': 1, 'sha256': 'y'},
+                {'No.': 3, 'url': 'c', 'is_downloaded': 1, 'sha256': 'z'},
+                {'No.': 4, 'url': 'd', 'is_downloaded': 1, 'sha256': 'y',
+                 'duplicate_of': os.path.join('images', 'dog', '0002.jpg')},
+                {'No.': 5, 'url': 'e', 'is_downloaded': 0},
+            ]
+            Manifest(os.path.join(d, 'urls', 'dog.csv')).write(rows)
+            index = ContentIndex(d).load_manifests()
+
+            rows = validate_class(dest_dir, rows, os.path.join(d, 'quarantine', 'dog'), workers=1, content_index=index)
+
+            self.assertEqual(['0001.jpg', '0002.png', '0004.png'], sorted(os.listdir(dest_dir)))
+            self.assertEqual(['0003.jpg'], os.listdir(os.path.join(d, 'quarantine', 'dog')))
+            self.assertEqual([1, 1, 0, 1, None], [row.get('is_valid') for row in rows])
+            self.assertEqual('0002.png', rows[1]['file'])
+            self.assertEqual(os.path.join('images', 'dog', '0002.png'), rows[3]['duplicate_of'])
+            self.assertEqual(os.path.join('images', 'dog', '0002.png'), index.paths['y'])
+
+    def testMain(self):
+        with tempfile.TemporaryDirectory() as d:
+            os.makedirs(os.path.join(d, 'images', 'cat'))
+            os.makedirs(os.path.join(d, 'urls'))
+            with open(os.path.join(d, 'images', 'cat', '0001.jpg'), 'wb') as f:
+                f.write(image_bytes('GIF'))
+            Manifest(os.path.join(d, 'urls', 'cat.csv')).write([{'No.': 1, 'url': 'a', 'is_downloaded': 1}])
+
+            validate_images.main(d, workers=1)
+
+            row, = Manifest(os.path.join(d, 'urls', 'cat.csv')).read()
+            self.assertEqual(('0001.gif', 'GIF', 8, 6, 1), (row['file'], row['format'], row['width'], row['height'], row['is_valid']))
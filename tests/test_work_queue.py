@@ -0,0 +1,156 @@
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from scheduler import BudgetExhausted, Cancelled
+from work_queue import DONE, FAILED, LEASED, PENDING, WorkQueue
+
+class TestWorkQueue(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'queue.sqlite3')
+        self.now = 1000.0
+        self.queues = []
+
+    def tearDown(self):
+        for q in self.queues:
+            q.close()
+        self.tmp.cleanup()
+
+    def queue(self, worker_id, **kwargs):
+        q = WorkQueue(self.path, lease_seconds=60, max_attempts=2, worker_id=worker_id, clock=lambda: self.now, **kwargs)
+        self.queues.append(q)
+        return q
+
+    def testLease(self):
+        a = self.queue('a')
+        b = self.queue('b')
+        self.assertEqual(2, a.add([('dog', 'dog'), ('cat', 'cat')]))
+        # added by another worker before
+        self.assertEqual(0, b.add([('dog', 'dog'), ('cat', 'cat')]))
+
+        job_a = a.lease()
+        job_b = b.lease()
+        self.assertEqual(('dog', 1), (job_a.dirname, job_a.attempts))
+        self.assertEqual('cat', job_b.dirname)
+        self.assertIsNone(a.lease())
+
+        self.assertTrue(a.complete(job_a))
+        self.assertEqual({DONE: 1, LEASED: 1}, a.stats())
+
+    def testExpireAndHeartbeat(self):
+        a = self.queue('a')
+        b = self.queue('b')
+        a.add([('dog', 'dog'), ('cat', 'cat')])
+        job_dog = a.lease()
+        job_cat = a.lease()
+
+        self.now += 50
+        self.assertEqual([], a.heartbeat())
+        self.now += 50
+        # "cat" hung, only the lease of "dog" is renewed
+        a.lease_of(job_dog).progress()
+        self.assertEqual([], a.heartbeat())
+        self.now += 20
+        job = b.lease()
+        self.assertEqual(('cat', 2), (job.dirname, job.attempts))
+        self.assertIsNone(b.lease())
+
+        # "a" lost "cat" to "b", and cancels it
+        cat = a.lease_of(job_cat)
+        self.assertEqual(['cat'], a.heartbeat())
+        self.assertTrue(cat.cancelled.is_set())
+        self.assertFalse(a.lease_of(job_dog).cancelled.is_set())
+        self.assertFalse(a.complete(job_cat))
+        self.assertTrue(a.complete(job_dog))
+        self.assertTrue(b.complete(job))
+        self.assertEqual({DONE: 2}, a.stats())
+
+    def testFail(self):
+        a = self.queue('a')
+        a.add([('dog', 'dog')])
+        a.fail(a.lease(), 'error')
+        self.assertEqual({PENDING: 1}, a.stats())
+        a.fail(a.lease(), 'error')
+        self.assertEqual({FAILED: 1}, a.stats())
+        self.assertIsNone(a.lease())
+
+        self.assertEqual(1, a.reset())
+        self.assertEqual(1, a.lease().attempts)
+
+    def testBudgetExhausted(self):
+        a = self.queue('a')
+        a.add([('q{}'.format(i), 'q{}'.format(i)) for i in range(3)])
+
+        def out_of_run_budget(job, lease):
+            raise BudgetExhausted('deadline', run=True)
+
+        # the first query is released without an attempt, and no more are leased
+        a.run(out_of_run_budget, workers=1, poll_seconds=0.01)
+        self.assertEqual({PENDING: 3}, a.stats())
+        ran = []
+
+        def out_of_query_budget(job, lease):
+            ran.append((job.dirname, job.attempts, job.error))
+            if job.dirname == 'q1':
+                raise BudgetExhausted('bytes', run=False)
+
+        # a query out of its budget is not leased again by this process
+        a.run(out_of_query_budget, workers=1, poll_seconds=0.01)
+        self.assertEqual({DONE: 2, PENDING: 1}, a.stats())
+        self.assertEqual([('q0', 1, 'budget exhausted: deadline'), ('q1', 1, None), ('q2', 1, None)], ran)
+        self.assertEqual(('q1', 1, 'budget exhausted: bytes'), a.lease()[1:])
+
+    def testCancelHungQuery(self):
+        a = WorkQueue(self.path, lease_seconds=0.3, worker_id='a')
+        b = WorkQueue(self.path, lease_seconds=60, worker_id='b')
+        self.queues += [a, b]
+        a.add([('dog', 'dog')])
+        cancelled = []
+
+        def hung(job, lease):
+            # no progress, so the lease is not renewed
+            if not lease.cancelled.wait(5):
+                raise RuntimeError('not cancelled')
+            cancelled.append(job.dirname)
+            raise Cancelled(job.dirname)
+
+        thread = threading.Thread(target=a.run, args=(hung,), kwargs={'poll_seconds': 0.05})
+        thread.start()
+        job = None
+        while job is None:
+            time.sleep(0.05)
+            job = b.lease()
+        self.assertEqual(('dog', 2), (job.dirname, job.attempts))
+        self.assertTrue(b.complete(job))
+        # "a" waits for the lease of "b" before returning
+        thread.join()
+        self.assertEqual(['dog'], cancelled)
+        self.assertEqual({DONE: 1}, b.stats())
+
+    def testRun(self):
+        queries = [('q{}'.format(i), 'q{}'.format(i)) for i in range(20)]
+        ran = []
+        lock = threading.Lock()
+
+        def run(job, lease):
+            if job.dirname == 'q3' and job.attempts == 1:
+                raise RuntimeError('retry me')
+            with lock:
+                ran.append(job.dirname)
+
+        def worker(worker_id):
+            q = self.queue(worker_id)
+            q.add(queries)
+            q.run(run, workers=2, poll_seconds=0.01)
+
+        threads = [threading.Thread(target=worker, args=(str(i),)) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(d for _, d in queries), sorted(ran))
+        self.assertEqual({DONE: 20}, self.queues[0].stats())
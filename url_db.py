@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+'''
+Database of image urls shared by all the queries and runs, "[save dir]/urls.sqlite3"
+
+The url manifest of a class only knows its own urls, so the same url found
+by several queries, or by another run, would be downloaded again, and dead
+urls would be retried every time. This keeps, for each url:
+  status: "ok", "failed" or "invalid" (downloaded but not an image, see validate_images.py)
+  sha256, size: content of the last successful download
+  path: file of the image, relative to the save dir
+  failures: the no. of consecutive failures
+  last_attempt: unix time of the last download
+  classes: classes the url was found for (table url_classes)
+
+image_collector_cui.py checks it before downloading:
+- urls downloaded before are linked from the saved file without a request
+- urls failed `dead_after` times in a row are skipped for `retry_after` seconds
+- invalid urls are skipped
+
+Writes are buffered and committed in batches. SQLite runs in WAL mode,
+so queries from other processes (e.g. `python3 url_db.py [save dir]`) do
+not block the downloads.
+'''
+
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Text
+
+OK = 'ok'
+FAILED = 'failed'
+INVALID = 'invalid'
+
+DB_FILE = 'urls.sqlite3'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS urls (
+    url TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    sha256 TEXT,
+    size INTEGER,
+    path TEXT,
+    failures INTEGER NOT NULL DEFAULT 0,
+    last_attempt REAL
+);
+CREATE TABLE IF NOT EXISTS url_classes (
+    url TEXT NOT NULL,
+    class TEXT NOT NULL,
+    PRIMARY KEY (url, class)
+);
+CREATE INDEX IF NOT EXISTS urls_sha256 ON urls (sha256);
+CREATE INDEX IF NOT EXISTS url_classes_class ON url_classes (class);
+'''
+
+UPSERT = '''
+INSERT INTO urls (url, status, sha256, size, path, failures, last_attempt)
+VALUES (:url, :status, :sha256, :size, :path, :failures, :last_attempt)
+ON CONFLICT (url) DO UPDATE SET
+    status = excluded.status,
+    sha256 = COALESCE(excluded.sha256, urls.sha256),
+    size = COALESCE(excluded.size, urls.size),
+    path = COALESCE(excluded.path, urls.path),
+    failures = CASE WHEN excluded.status = 'failed' THEN urls.failures + 1 ELSE 0 END,
+    last_attempt = COALESCE(excluded.last_attempt, urls.last_attempt)
+'''
+
+class UrlDB:
+    def __init__(self, path: Text, batch_size: int=200, dead_after: int=3, retry_after: float=30 * 24 * 3600,
+                 clock=time.time):
+        '''
+        :param path: SQLite file, paths of images are relative to its directory
+        :param batch_size: the no. of writes committed at once
+        :param dead_after: skip urls failed this no. of times in a row
+        :param retry_after: seconds to skip dead urls
+        '''
+        self.path = path
+        self.root = os.path.dirname(os.path.abspath(path))
+        self.batch_size = batch_size
+        self.dead_after = dead_after
+        self.retry_after = retry_after
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.pending: List[Dict] = []
+        self.pending_classes: List[tuple] = []
+        os.makedirs(self.root, exist_ok=True)
+        # shared by the download threads, serialized by `lock`
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+
+    def lookup(self, url: Text) -> Optional[Dict]:
+        '''
+        :return: the record of the url, None if unknown
+        '''
+        with self.lock:
+            if any(r['url'] == url for r in self.pending):
+                self._flush()
+            row = self.conn.execute('SELECT * FROM urls WHERE url = ?', (url,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def is_dead(self, record: Optional[Dict]) -> bool:
+        '''whether to skip the url of `record` without a request
+        '''
+        if record is None:
+            return False
+        if record['status'] == INVALID:
+            return True
+        return (record['status'] == FAILED and record['failures'] >= self.dead_after
+                and self.clock() - (record['last_attempt'] or 0) < self.retry_after)
+
+    def saved_file(self, record: Optional[Dict]) -> Optional[Text]:
+        '''
+        :return: path of the image downloaded before if it still exists, otherwise None
+        '''
+        if record is None or record['status'] != OK or not record['path']:
+            return None
+        path = os.path.join(self.root, record['path'])
+        return path if os.path.isfile(path) else None
+
+    def record(self, url: Text, class_name: Optional[Text]=None, status: Text=OK,
+               sha256: Optional[Text]=None, size: Optional[int]=None, path: Optional[Text]=None,
+               attempted: bool=True):
+        '''buffer a result, committed with the next batch
+        :param path: path of the saved image
+        :param attempted: whether a request was sent, otherwise the last attempt time is kept
+        '''
+        rel_path = os.path.relpath(os.path.abspath(path), self.root) if path is not None else None
+        with self.lock:
+            self.pending.append({
+                'url': url, 'status': status, 'sha256': sha256, 'size': size, 'path': rel_path,
+                'failures': 1 if status == FAILED else 0, 'last_attempt': self.clock() if attempted else None})
+            if class_name is not None:
+                self.pending_classes.append((url, class_name))
+            if len(self.pending) >= self.batch_size:
+                self._flush()
+
+    def add_class(self, url: Text, class_name: Text):
+        '''buffer a class the url is found for, without a download
+        '''
+        with self.lock:
+            self.pending_classes.append((url, class_name))
+            if len(self.pending_classes) >= self.batch_size:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.pending and not self.pending_classes:
+            return
+        with self.conn:
+            self.conn.executemany(UPSERT, self.pending)
+            self.conn.executemany('INSERT OR IGNORE INTO url_classes (url, class) VALUES (?, ?)', self.pending_classes)
+        self.pending = []
+        self.pending_classes = []
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.conn.close()
+
+    def stats(self) -> Dict[Text, int]:
+        '''the no. of urls of each status
+        '''
+        self.flush()
+        with self.lock:
+            return {row[0]: row[1] for row in self.conn.execute('SELECT status, COUNT(*) FROM urls GROUP BY status')}
+
+    def classes(self, url: Text) -> List[Text]:
+        self.flush()
+        with self.lock:
+            return [row[0] for row in self.conn.execute('SELECT class FROM url_classes WHERE url = ? ORDER BY class', (url,))]
+
+    def shared_urls(self, min_classes: int=2) -> List[tuple]:
+        '''urls found for several classes, e.g. to find ambiguous queries
+        :return: [(url, no. of classes)]
+        '''
+        self.flush()
+        with self.lock:
+            return [tuple(row) for row in self.conn.execute(
+                'SELECT url, COUNT(*) AS n FROM url_classes GROUP BY url HAVING n >= ? ORDER BY n DESC, url', (min_classes,))]
+
+
+if __name__ == '__main__':
+    import argparse
+    psr = argparse.ArgumentParser()
+    psr.add_argument('save_dir', help='save dir of image_collector_cui.py')
+    psr.add_argument('--shared', help='list urls found for several classes', action='store_true')
+    a = psr.parse_args()
+    db = UrlDB(os.path.join(a.save_dir, DB_FILE))
+    print(db.stats())
+    if a.shared:
+        for url, n in db.shared_urls():
+            print(n, url, ' '.join(db.classes(url)))
+    db.close()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+'''
+Validate downloaded images and detect their true format
+
+Every response is saved as "NNNN.jpg" whatever it actually is. This stage
+- sniffs the magic bytes to get the true format (HTML error pages are invalid)
+- checks the header can be decoded and the file is not truncated, without
+  decoding pixels (header decode needs Pillow, skipped if not installed)
+- renames files to the extension of their true format
+- moves invalid files to "[save dir]/quarantine/[class]/"
+- records file, format, width, height and is_valid in the url manifest,
+  so that later tools do not need to open the files again
+
+It runs in a process pool after the downloads of each query in
+image_collector_cui.py (--validate), or over a collected dataset:
+
+> python3 validate_images.py [save dir]
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import multiprocessing
+import os
+import shutil
+from typing import Dict, List, Optional, Text, Tuple
+
+from manifest import Manifest, row_file_name
+
+# format -> extension
+EXTENSIONS = {
+    'JPEG': '.jpg',
+    'PNG': '.png',
+    'GIF': '.gif',
+    'WEBP': '.webp',
+    'BMP': '.bmp',
+    'TIFF': '.tif',
+    }
+
+# bytes read to sniff the format
+HEAD_SIZE = 32
+
+def sniff_format(head: bytes) -> Optional[Text]:
+    '''image format from the magic bytes at the head of a file
+    :return: one of `EXTENSIONS` keys, None if not an image
+    '''
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'JPEG'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'PNG'
+    if head.startswith((b'GIF87a', b'GIF89a')):
+        return 'GIF'
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return 'WEBP'
+    if head.startswith(b'BM'):
+        return 'BMP'
+    if head.startswith((b'II*\x00', b'MM\x00*')):
+        return 'TIFF'
+    return None
+
+def is_truncated(path: Text, fmt: Text) -> bool:
+    '''check the end marker of formats that have one
+    '''
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - 16))
+        tail = f.read()
+    if fmt == 'JPEG':
+        # some encoders pad after EOI
+        return b'\xff\xd9' not in tail
+    if fmt == 'PNG':
+        return b'IEND' not in tail
+    if fmt == 'GIF':
+        return not tail.rstrip(b'\x00').endswith(b'\x3b')
+    return False
+
+def read_header(path: Text) -> Tuple[Optional[int], Optional[int]]:
+    '''decode only the header
+    :return: (width, height), (None, None) if Pillow is not installed
+    :raises Exception: if the header cannot be decoded
+    '''
+    try:
+        from PIL import Image
+    except ImportError:
+        return None, None
+    with Image.open(path) as img:
+        # Image.open reads only the header, pixels are decoded lazily
+        return img.size
+
+def validate_file(path: Text) -> Dict:
+    '''
+    :param path: image file path
+    :return: {'format', 'width', 'height', 'is_valid', 'reason'}
+    '''
+    result = {'format': '', 'width': '', 'height': '', 'is_valid': 0, 'reason': ''}
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(HEAD_SIZE)
+        fmt = sniff_format(head)
+        if fmt is None:
+            result['reason'] = 'unknown format'
+            return result
+        result['format'] = fmt
+        if is_truncated(path, fmt):
+            result['reason'] = 'truncated'
+            return result
+        width, height = read_header(path)
+    except Exception as e:
+        result['reason'] = 'broken: {}'.format(e)
+        return result
+    if width is not None:
+        result['width'], result['height'] = width, height
+    result['is_valid'] = 1
+    return result
+
+def process_pool(workers: Optional[int]=None) -> ProcessPoolExecutor:
+    '''process pool that can be created by a process running threads
+
+    Forked processes would inherit locks held by the download threads,
+    so processes are started by a fork server (spawned where it is not available).
+    Create one pool for a run and pass it to each query, starting processes is slow.
+
+    :param workers: the no. of processes, the no. of CPUs if None
+    '''
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
+
+def validate_files(paths: List[Text], workers: Optional[int]=None,
+                   pool: Optional[ProcessPoolExecutor]=None) -> List[Dict]:
+    '''validate files in a process pool
+    :param workers: the no. of processes, the no. of CPUs if None, no pool if 1
+    :param pool: pool to use instead of creating one (see `process_pool`), `workers` is ignored
+    '''
+    if len(paths) <= 1 or (pool is None and workers == 1):
+        return [validate_file(p) for p in paths]
+    if pool is not None:
+        return list(pool.map(validate_file, paths, chunksize=64))
+    with process_pool(workers) as executor:
+        return list(executor.map(validate_file, paths, chunksize=64))
+
+def validate_class(
+        dest_dir_path: Text,
+        rows: List[Dict],
+        quarantine_dir: Text,
+        workers: Optional[int]=None,
+        content_index=None,
+        pool: Optional[ProcessPoolExecutor]=None) -> List[Dict]:
+    '''validate images of a class, rename or quarantine them, and update the manifest rows
+    :param dest_dir_path: image directory of the class
+    :param rows: rows of the url manifest of the class
+    :param quarantine_dir: directory to move invalid files to
+    :param workers: the no. of processes
+    :param content_index: `dedup.ContentIndex` to update paths of renamed files
+    :param pool: process pool shared by the classes, see `process_pool`
+    :return: updated rows
+    '''
+    targets = []
+    for row in rows:
+        if not row['is_downloaded'] or row.get('is_valid') not in (None, ''):
+            # not downloaded, or validated already
+            continue
+        file_name = row_file_name(row)
+        if os.path.isfile(os.path.join(dest_dir_path, file_name)):
+            targets.append((row, file_name))
+
+    results = validate_files([os.path.join(dest_dir_path, f) for _, f in targets], workers=workers, pool=pool)
+    renamed = {}
+    for (row, file_name), result in zip(targets, results):
+        path = os.path.join(dest_dir_path, file_name)
+        row.update((k, result[k]) for k in ['format', 'width', 'height', 'is_valid'])
+        if not result['is_valid']:
+            os.makedirs(quarantine_dir, exist_ok=True)
+            shutil.move(path, os.path.join(quarantine_dir, file_name))
+            row['file'] = ''
+            continue
+        new_name = os.path.splitext(file_name)[0] + EXTENSIONS[result['format']]
+        if new_name != file_name:
+            os.replace(path, os.path.join(dest_dir_path, new_name))
+            renamed[file_name] = new_name
+        row['file'] = new_name
+
+    if renamed:
+        # keep references to the renamed originals
+        class_dir = os.path.basename(os.path.normpath(dest_dir_path))
+        rel = {os.path.join('images', class_dir, old): os.path.join('images', class_dir, new) for old, new in renamed.items()}
+        for row in rows:
+            if row.get('duplicate_of') in rel:
+                row['duplicate_of'] = rel[row['duplicate_of']]
+        if content_index is not None:
+            content_index.rename(rel)
+    return rows
+
+def main(data_dir: Text, workers: Optional[int]=None):
+    '''validate all the classes of a dataset collected by image_collector_cui.py
+    :param data_dir: save dir, including "images" and "urls"
+    :param workers: the no. of processes
+    '''
+    if not os.path.isdir(os.path.join(data_dir, 'images')):
+        raise RuntimeError('invalid save directory, "{}" has no images directory'.format(data_dir))
+    pool = process_pool(workers) if workers != 1 else None
+    try:
+        for urls_file in sorted(glob.glob(os.path.join(data_dir, 'urls', '*.csv'))):
+            class_name = os.path.splitext(os.path.basename(urls_file))[0]
+            manifest = Manifest(urls_file)
+            rows = validate_class(
+                os.path.join(data_dir, 'images', class_name),
+                manifest.read(),
+                os.path.join(data_dir, 'quarantine', class_name),
+                workers=workers, pool=pool)
+            manifest.write(rows)
+            invalid = [row['No.'] for row in rows if row.get('is_valid') == 0]
+            print('{}: {} valid, {} quarantined'.format(
+                class_name, sum(1 for row in rows if row.get('is_valid') == 1), len(invalid)))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+if __name__ == '__main__':
+    import argparse
+    psr = argparse.ArgumentParser()
+    psr.add_argument('data', help='save dir of image_collector_cui.py')
+    psr.add_argument('-w', '--workers', help='the no. of processes, the no. of CPUs by default', type=int, default=None)
+    a = psr.parse_args()
+    main(a.data, workers=a.workers)
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+
+'''
+Queue of queries shared by collector processes, on one host or several hosts sharing a file system
+
+Each process adds the queries of its query file or directory glob (adding
+a query already in the queue does nothing), then leases them one by one:
+
+  pending --lease--> leased --complete--> done
+                       |  \\--fail-------> pending, or failed after `max_attempts`
+                       |  \\--release----> pending, the attempt is not counted (budget exhausted)
+                       \\--lease expired--> pending (the process died or hung)
+
+A leased query belongs to one worker until its lease expires. The workers
+renew their leases by heartbeats while the query makes progress (urls are
+found and images downloaded), so only the queries of workers that stopped
+or hung are leased again. A worker whose lease was lost cancels the query,
+so the query is not collected by two workers at once.
+
+The queue is a SQLite file. It uses the rollback journal, not WAL, because
+WAL needs shared memory and does not work on network file systems; file
+locks of NFS should be enabled for several hosts.
+
+> python3 image_collector_cui.py queries.txt 100 [save dir] --queue [save dir]/queue.sqlite3  # on each host
+> python3 work_queue.py [save dir]/queue.sqlite3  # progress
+'''
+
+from collections import namedtuple
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set, Text, Tuple
+
+from scheduler import BudgetExhausted, Cancelled, run_jobs
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    dirname TEXT PRIMARY KEY,
+    query TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+'''
+
+# error: why the previous attempt did not complete, None if it is the first one
+Job = namedtuple('Job', ['query', 'dirname', 'attempts', 'error'], defaults=(None,))
+
+class Lease:
+    '''a query leased by a thread of this process
+    '''
+    def __init__(self, job: Job, clock):
+        self.job = job
+        self.clock = clock
+        self.last_progress = clock()
+        # set when the lease was lost, the query should stop
+        self.cancelled = threading.Event()
+
+    def progress(self):
+        '''tell that the query is not hung, only leases of queries making progress are renewed
+        '''
+        self.last_progress = self.clock()
+
+def default_worker_id() -> Text:
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+class WorkQueue:
+    def __init__(self, path: Text, lease_seconds: float=600, max_attempts: int=3,
+                 worker_id: Optional[Text]=None, clock=time.time, stall_seconds: Optional[float]=None):
+        '''
+        :param path: SQLite file shared by the workers
+        :param lease_seconds: a leased query is leased again if not renewed in this time
+        :param stall_seconds: a lease is not renewed if its query made no progress in this time,
+            `lease_seconds` if None
+        :param max_attempts: a query failed this no. of times is not leased again
+        :param worker_id: id of this process, "[host]:[pid]" if None
+        :param clock: time shared by the hosts (wall clock)
+        '''
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = worker_id if worker_id is not None else default_worker_id()
+        self.clock = clock
+        self.stall_seconds = stall_seconds if stall_seconds is not None else lease_seconds
+        self.lock = threading.Lock()
+        # (dirname, worker) -> lease of the queries leased by the threads of this process
+        self.leases: Dict[Tuple[Text, Text], Lease] = {}
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # isolation_level=None: transactions are started explicitly by BEGIN IMMEDIATE
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+
+    def _transaction(self, func: Callable):
+        # BEGIN IMMEDIATE takes the write lock first, so two workers never lease the same query
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = func(self.conn)
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+            return result
+
+    def add(self, jobs: Iterable[Tuple[Text, Text]]) -> int:
+        '''add queries not in the queue yet
+        :param jobs: (query, class directory name)
+        :return: the no. of queries added
+        '''
+        now = self.clock()
+        rows = [(dirname, query, now) for query, dirname in jobs]
+        return self._transaction(lambda conn: conn.executemany(
+            'INSERT OR IGNORE INTO jobs (dirname, query, updated) VALUES (?, ?, ?)', rows).rowcount)
+
+    def _thread_worker_id(self) -> Text:
+        return '{}:{}'.format(self.worker_id, threading.get_ident())
+
+    def lease(self, exclude: Iterable[Text]=()) -> Optional[Job]:
+        '''lease the next pending query, expired leases are pending again
+        :param exclude: class directory names not to lease
+        :return: the query, None if no query is pending
+        '''
+        worker = self._thread_worker_id()
+        exclude = list(exclude)
+
+        def lease(conn):
+            now = self.clock()
+            conn.execute(
+                'UPDATE jobs SET status = ?, worker = NULL, lease_until = NULL, error = ?, updated = ? '
+                'WHERE status = ? AND lease_until < ?',
+                (PENDING, 'lease expired', now, LEASED, now))
+            conn.execute(
+                'UPDATE jobs SET status = ?, updated = ? WHERE status = ? AND attempts >= ?',
+                (FAILED, now, PENDING, self.max_attempts))
+            row = conn.execute(
+                'SELECT * FROM jobs WHERE status = ? AND dirname NOT IN ({}) ORDER BY rowid LIMIT 1'.format(
+                    ','.join('?' * len(exclude))), [PENDING] + exclude).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                'UPDATE jobs SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1, updated = ? '
+                'WHERE dirname = ?',
+                (LEASED, worker, now + self.lease_seconds, now, row['dirname']))
+            return Job(row['query'], row['dirname'], row['attempts'] + 1, row['error'])
+
+        job = self._transaction(lease)
+        if job is not None:
+            with self.lock:
+                self.leases[(job.dirname, worker)] = Lease(job, self.clock)
+        return job
+
+    def lease_of(self, job: Job) -> Optional[Lease]:
+        '''lease of a query leased by this thread, None if finished or not leased
+        '''
+        with self.lock:
+            return self.leases.get((job.dirname, self._thread_worker_id()))
+
+    def heartbeat(self) -> List[Text]:
+        '''renew the leases of this process whose queries made progress in `stall_seconds`,
+        and cancel the queries whose leases were lost
+        :return: class directory names of the queries whose leases were lost (expired and leased by others)
+        '''
+        with self.lock:
+            leases = list(self.leases.items())
+
+        def renew(conn):
+            lost = []
+            now = self.clock()
+            for (dirname, worker), lease in leases:
+                if now - lease.last_progress <= self.stall_seconds:
+                    held = conn.execute(
+                        'UPDATE jobs SET lease_until = ? WHERE dirname = ? AND worker = ? AND status = ?',
+                        (now + self.lease_seconds, dirname, worker, LEASED)).rowcount > 0
+                else:
+                    # hung: let the lease expire, and find if another worker took it
+                    held = conn.execute(
+                        'SELECT 1 FROM jobs WHERE dirname = ? AND worker = ? AND status = ?',
+                        (dirname, worker, LEASED)).fetchone() is not None
+                if not held:
+                    lost.append(dirname)
+                    lease.cancelled.set()
+            return lost
+
+        return self._transaction(renew) if leases else []
+
+    def _finish(self, job: Job, status: Text, error: Optional[Text]=None) -> bool:
+        worker = self._thread_worker_id()
+        with self.lock:
+            self.leases.pop((job.dirname, worker), None)
+        return self._transaction(lambda conn: conn.execute(
+            'UPDATE jobs SET status = ?, worker = NULL, lease_until = NULL, error = ?, updated = ? '
+            'WHERE dirname = ? AND worker = ? AND status = ?',
+            (status, error, self.clock(), job.dirname, worker, LEASED)).rowcount > 0)
+
+    def complete(self, job: Job) -> bool:
+        '''
+        :return: False if the lease was lost before
+        '''
+        return self._finish(job, DONE)
+
+    def fail(self, job: Job, error: Text) -> bool:
+        '''put the query back to be leased again, or mark it failed after `max_attempts`
+        :return: False if the lease was lost before
+        '''
+        return self._finish(job, FAILED if job.attempts >= self.max_attempts else PENDING, error)
+
+    def release(self, job: Job, reason: Text) -> bool:
+        '''put the query back to be leased again without counting the attempt, e.g. out of budget
+        :return: False if the lease was lost before
+        '''
+        worker = self._thread_worker_id()
+        with self.lock:
+            self.leases.pop((job.dirname, worker), None)
+        return self._transaction(lambda conn: conn.execute(
+            'UPDATE jobs SET status = ?, worker = NULL, lease_until = NULL, attempts = attempts - 1, error = ?, '
+            'updated = ? WHERE dirname = ? AND worker = ? AND status = ?',
+            (PENDING, reason, self.clock(), job.dirname, worker, LEASED)).rowcount > 0)
+
+    def stats(self) -> Dict[Text, int]:
+        '''the no. of queries of each status
+        '''
+        with self.lock:
+            return {row[0]: row[1] for row in self.conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status')}
+
+    def reset(self, statuses: Iterable[Text]=(FAILED,)) -> int:
+        '''make queries of `statuses` pending again with no attempts
+        :return: the no. of queries reset
+        '''
+        statuses = list(statuses)
+        return self._transaction(lambda conn: conn.execute(
+            'UPDATE jobs SET status = ?, worker = NULL, lease_until = NULL, attempts = 0, error = NULL '
+            'WHERE status IN ({})'.format(','.join('?' * len(statuses))), [PENDING] + statuses).rowcount)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def run(self, func: Callable, workers: int=1, poll_seconds: float=10.0, on_lost: Callable=None):
+        '''lease and run queries until all the queries are done or failed
+
+        While other workers hold leases, this waits for them to complete or
+        expire, so the queries of stopped workers are taken over.
+
+        A query stopped by `scheduler.BudgetExhausted` is released. If the budget
+        of the run ran out, this process stops leasing, otherwise the query is
+        left to other processes or the next run.
+
+        When a lease is lost, `Lease.cancelled` is set. `func` should then stop
+        and raise `scheduler.Cancelled`, the query is left to its new worker.
+
+        :param func: called with each `Job` and its `Lease`, an exception fails the query.
+            It should call `Lease.progress` as the query makes progress, otherwise the lease
+            is not renewed after `stall_seconds`.
+        :param workers: the no. of queries run at the same time in this process
+        :param poll_seconds: interval of checking leases of other workers
+        :param on_lost: called with class directory names whose leases were lost
+        '''
+        stop = threading.Event()
+        stop_leasing = threading.Event()
+        # queries out of their budgets in this process
+        released: Set[Text] = set()
+
+        def heartbeats():
+            while not stop.wait(self.lease_seconds / 3):
+                lost = self.heartbeat()
+                if lost and on_lost is not None:
+                    on_lost(lost)
+
+        def worker(_):
+            while not stop_leasing.is_set():
+                with self.lock:
+                    exclude = list(released)
+                job = self.lease(exclude=exclude)
+                if job is None:
+                    if not self.stats().get(LEASED):
+                        return
+                    time.sleep(poll_seconds)
+                    continue
+                lease = self.lease_of(job)
+                try:
+                    func(job, lease)
+                except Cancelled:
+                    with self.lock:
+                        self.leases.pop((job.dirname, self._thread_worker_id()), None)
+                except BudgetExhausted as e:
+                    self.release(job, 'budget exhausted: {}'.format(e.reason))
+                    if e.run:
+                        stop_leasing.set()
+                    else:
+                        with self.lock:
+                            released.add(job.dirname)
+                except Exception as e:
+                    self.fail(job, '{}: {}'.format(type(e).__name__, e))
+                else:
+                    self.complete(job)
+
+        heartbeat_thread = threading.Thread(target=heartbeats, daemon=True)
+        heartbeat_thread.start()
+        try:
+            run_jobs(worker, range(max(1, workers)), max_workers=workers)
+        finally:
+            stop.set()
+            heartbeat_thread.join()
+
+
+if __name__ == '__main__':
+    import argparse
+    psr = argparse.ArgumentParser()
+    psr.add_argument('queue', help='queue file of image_collector_cui.py --queue')
+    psr.add_argument('--reset', help='make failed queries pending again', action='store_true')
+    psr.add_argument('--list', help='list queries of the status', choices=[PENDING, LEASED, DONE, FAILED])
+    a = psr.parse_args()
+    q = WorkQueue(a.queue)
+    if a.reset:
+        print(q.reset(), 'queries reset')
+    print(q.stats())
+    if a.list:
+        for row in q.conn.execute('SELECT * FROM jobs WHERE status = ? ORDER BY rowid', (a.list,)):
+            print(row['dirname'], row['attempts'], row['worker'] or '', row['error'] or '', sep='\t')
+    q.close()